@@ -1,26 +1,22 @@
 import os
-from flask import Flask, url_for
+from flask import Flask
 from flask_admin import Admin, AdminIndexView, BaseView, expose
 from flask_admin.contrib.sqla import ModelView
 from flask_login import LoginManager, current_user, login_required
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from flask_migrate import Migrate
 from flask_mail import Mail
-from flask_msearch import Search
 
 
 db = SQLAlchemy()
-bcrypt = Bcrypt()
 migrate = Migrate()
 
 login_manager = LoginManager()
-login_manager.login_view = 'user.login'
+login_manager.login_view = 'users.login'
 login_manager.login_message_category = 'info'
 login_manager.login_message = 'Please login to enter the page!'
 
 mail = Mail()
-search = Search(db=db)
 
 
 
@@ -29,11 +25,10 @@ class DashBoardView(AdminIndexView):
     @login_required
     @expose('/')
     def admin_panel(self):
+        from blog.images import media_url
         from blog.models import User
         all_users = User.query.all()
-        image_file = url_for('static',
-                             filename=f'profile_pics' + '/users/' + current_user.username + '/profile_img/' +
-                                      current_user.image_file)
+        image_file = media_url(current_user.id, 'profile_img', current_user.image_file)
         return self.render('admin/index_admin.html', all_users=all_users, image_file=image_file)
 
 
@@ -55,13 +50,38 @@ def create_app():
 
     # app.config.from_pyfile('settings.py')
     db.init_app(app)
-    bcrypt.init_app(app)
     login_manager.init_app(app)
     migrate.init_app(app, db, render_as_batch=True)
     mail.init_app(app)
-    search.init_app(app)
 
-    from blog.models import User, Post, Comment, Tag, PostLike, CommentLike
+    from blog.models import User, Post, Comment, Tag, PostLike, CommentLike, ImageJob, Blob, OutboxMessage
+    from blog.counts import post_counts
+    from blog.view_counter import view_counter
+    from blog.search import post_search
+    from blog.storage import storage
+    from blog.blobs import blob_store
+    from blog.images import image_queue
+    from blog.assets import assets
+    from blog.outbox import mail_outbox
+    from blog.passwords import password_hasher
+    from blog.identity import user_cache
+    from blog.fragments import fragment_cache
+    from blog.page_cache import page_cache
+    from blog.likes import like_counts
+
+    post_counts.init_app(app)
+    view_counter.init_app(app)
+    post_search.init_app(app)
+    storage.init_app(app)
+    blob_store.init_app(app)
+    image_queue.init_app(app)
+    assets.init_app(app)
+    mail_outbox.init_app(app)
+    password_hasher.init_app(app)
+    user_cache.init_app(app)
+    fragment_cache.init_app(app)
+    page_cache.init_app(app)
+    like_counts.init_app(app)
 
     admin.add_view(AnyPageView(name='to Blog'))
     admin.add_view(ModelView(User, db.session, name='Users'))
@@ -70,16 +90,21 @@ def create_app():
     admin.add_view(ModelView(Comment, db.session, name='Comments'))
     admin.add_view(ModelView(CommentLike, db.session, name='CommentLikes'))
     admin.add_view(ModelView(Tag, db.session, name='Tags'))
+    admin.add_view(ModelView(ImageJob, db.session, name='ImageJobs'))
+    admin.add_view(ModelView(Blob, db.session, name='Blobs'))
+    admin.add_view(ModelView(OutboxMessage, db.session, name='Outbox'))
 
     from blog.main.routes import main
     from blog.user.routes import users
     from blog.post.routes import posts
     from blog.errors.handlers import errors
+    from blog.api.routes import api
 
     app.register_blueprint(main)
     app.register_blueprint(users)
     app.register_blueprint(posts)
     app.register_blueprint(errors)
+    app.register_blueprint(api)
 
     return app
 
@@ -0,0 +1,113 @@
+from flask import Blueprint, abort, jsonify, request
+from sqlalchemy import func, select
+
+from blog import db
+from blog.api.utils import field, image_field, isoformat, selected_fields, projection, serialize, page_size, \
+    keyset_page, json_response, login_required
+from blog.models import Post, Comment, Tag, User, post_tags
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+POST_FIELDS = {
+    'id': field(Post.id),
+    'slug': field(Post.slug),
+    'title': field(Post.title),
+    'content': field(Post.content),
+    'category': field(Post.category),
+    'date_posted': field(Post.date_posted, convert=isoformat),
+    'author': field(User.username),
+    'image': image_field(Post.user_id, Post.image_post, 'post_images'),
+    'image_processing': field(Post.image_processing),
+    'views': field(Post.views),
+    'like_count': field(Post.like_count),
+}
+# a listing leaves the content out unless it is asked for
+POST_LIST_FIELDS = ('id', 'slug', 'title', 'category', 'date_posted', 'author', 'image', 'like_count')
+
+COMMENT_FIELDS = {
+    'id': field(Comment.id),
+    'username': field(Comment.username),
+    'body': field(Comment.body),
+    'date_posted': field(Comment.date_posted, convert=isoformat),
+    'like_count': field(Comment.like_count),
+}
+
+TAG_FIELDS = {
+    'id': field(Tag.id),
+    'name': field(Tag.name),
+    'post_count': field(func.count(post_tags.c.post_id)),
+}
+
+
+@api.record_once
+def configure(state):
+    state.app.config.setdefault('API_PAGE_SIZE', 20)
+    state.app.config.setdefault('API_MAX_PAGE_SIZE', 100)
+
+
+@api.errorhandler(400)
+@api.errorhandler(401)
+@api.errorhandler(404)
+def error(error):
+    return jsonify(error=error.description), error.code
+
+
+def post_statement(names):
+    statement = select(*projection(POST_FIELDS, names)).select_from(Post)
+    if 'author' in names:
+        statement = statement.join(User, User.id == Post.user_id)
+    return statement
+
+
+@api.route('/posts')
+def list_posts():
+    """Newest posts first; ?category=, ?tag= and ?author= narrow them down, ?cursor= goes on."""
+    # the content is only for those who may open the post
+    names = selected_fields(POST_FIELDS, POST_LIST_FIELDS, public=POST_LIST_FIELDS)
+    category, tag, author = (request.args.get(name) for name in ('category', 'tag', 'author'))
+    statement = post_statement(names)
+    if category:
+        statement = statement.where(Post.category == category)
+    if tag:
+        statement = statement.where(Post.id.in_(select(post_tags.c.post_id)
+                                                .join(Tag, Tag.id == post_tags.c.tag_id)
+                                                .where(Tag.name == tag)))
+    if author:
+        statement = statement.where(Post.user_id.in_(select(User.id).where(User.username == author)))
+    rows, next_cursor = keyset_page(statement, Post.date_posted, Post.id, page_size())
+    return json_response({'items': serialize(rows, POST_FIELDS, names), 'next_cursor': next_cursor})
+
+
+@api.route('/posts/<string:slug>')
+@login_required
+def get_post(slug):
+    names = selected_fields(POST_FIELDS, tuple(POST_FIELDS))
+    row = db.session.execute(post_statement(names).where(Post.slug == slug)).first()
+    if row is None:
+        abort(404, 'No such post.')
+    return json_response(serialize([row], POST_FIELDS, names)[0])
+
+
+@api.route('/posts/<string:slug>/comments')
+@login_required
+def list_comments(slug):
+    """Newest comments of a post first, ?cursor= goes on."""
+    names = selected_fields(COMMENT_FIELDS, tuple(COMMENT_FIELDS))
+    post_id = db.session.execute(select(Post.id).where(Post.slug == slug)).scalar()
+    if post_id is None:
+        abort(404, 'No such post.')
+    statement = select(*projection(COMMENT_FIELDS, names)).where(Comment.post_id == post_id)
+    rows, next_cursor = keyset_page(statement, Comment.date_posted, Comment.id, page_size())
+    return json_response({'items': serialize(rows, COMMENT_FIELDS, names), 'next_cursor': next_cursor})
+
+
+@api.route('/tags')
+def list_tags():
+    names = selected_fields(TAG_FIELDS, tuple(TAG_FIELDS))
+    statement = select(*projection(TAG_FIELDS, names)).select_from(Tag).order_by(Tag.name)
+    if 'post_count' in names:
+        statement = statement.outerjoin(post_tags, post_tags.c.tag_id == Tag.id).group_by(Tag.id)
+    rows = db.session.execute(statement).all()
+    return json_response({'items': serialize(rows, TAG_FIELDS, names)})
@@ -0,0 +1,120 @@
+import functools
+import hashlib
+import json
+
+from flask import abort, current_app, request
+from flask_login import current_user
+from sqlalchemy import and_, or_
+
+from blog import db
+from blog.images import media_url
+from blog.pagination import decode_cursor, encode_cursor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def require_login():
+    # the rule of the post page for what mirrors it, answered with a JSON 401 instead of the login page
+    if not current_user.is_authenticated:
+        abort(401, 'Log in to read posts and comments.')
+
+
+def login_required(view):
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        require_login()
+        return view(**kwargs)
+    return wrapper
+
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def field(*columns, convert=None):
+    # the columns a field is read from and how their values become the JSON value
+    return columns, convert
+
+
+def image_field(user_id_column, filename_column, folder):
+    return field(user_id_column, filename_column,
+                 convert=lambda user_id, filename: media_url(user_id, folder, filename) if filename else None)
+
+
+def selected_fields(available, default, public=None):
+    """The names in ?fields=, in order, or `default`; unknown names are a 400.
+
+    When `public` is given, names outside it are a 401 for a visitor who is not logged in.
+    """
+    requested = request.args.get('fields')
+    if not requested:
+        return default
+    names = list(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    unknown = [name for name in names if name not in available]
+    if not names or unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}.")
+    if public is not None and not set(names) <= set(public):
+        require_login()
+    return names
+
+
+def projection(available, names):
+    """Labelled columns for the selected fields - only what the response shows is read."""
+    return [column.label(f'{name}_{index}')
+            for name in names for index, column in enumerate(available[name][0])]
+
+
+def serialize(rows, available, names):
+    items = []
+    for row in rows:
+        values = iter(row)
+        item = {}
+        for name in names:
+            columns, convert = available[name]
+            arguments = [next(values) for _ in columns]
+            item[name] = convert(*arguments) if convert else arguments[0]
+        items.append(item)
+    return items
+
+
+def page_size():
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    return min(max(limit, 1), current_app.config['API_MAX_PAGE_SIZE'])
+
+
+def keyset_page(statement, date_column, id_column, limit):
+    """One page of `statement`, newest first, and the cursor of the next one.
+
+    The cursor is the one of the HTML pages, keyed on (date_posted, id).
+    """
+    cursor = request.args.get('cursor')
+    if cursor:
+        date_posted, item_id, direction = decode_cursor(cursor)
+        if direction != 'next':
+            abort(400, 'Only next cursors are supported.')
+        statement = statement.where(or_(date_column < date_posted,
+                                        and_(date_column == date_posted, id_column < item_id)))
+    # the keys come last, after the fields, under their own names
+    rows = db.session.execute(statement.add_columns(date_column, id_column)
+                              .order_by(date_column.desc(), id_column.desc())
+                              .limit(limit + 1)).all()
+    next_cursor = encode_cursor(rows[limit - 1], 'next') if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(payload):
+    """The payload as JSON with an ETag of its bytes, or a 304 when the client has them already."""
+    body = dumps(payload)
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -0,0 +1,218 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+FINGERPRINTED = re.compile(r'^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<extension>\.[^./]+)$')
+
+# text formats worth storing compressed; pictures and fonts are compressed already
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSED = tuple(suffix for _, suffix in ENCODINGS)
+
+
+class Assets:
+    """Fingerprinted URLs and long-lived caching for the static folder.
+
+    url_for('static', filename='css/style.css') resolves to
+    /static/css/style.<digest>.css, where the digest is taken from the file
+    content, and such URLs are served with a one year immutable
+    Cache-Control. `flask assets build` writes the digests to ASSETS_MANIFEST,
+    so nothing is hashed or stat'ed at request time, and stores .gz (and .br,
+    with the brotli package) copies of the text files next to them, picked by
+    Accept-Encoding. Without a manifest, or with DEBUG, digests are computed
+    on first use and follow the file's mtime. Paths under ASSETS_EXCLUDE keep
+    their URLs; files in the blob store are immutable by name already.
+    """
+
+    def __init__(self, app=None):
+        self._digests = {}
+        self._manifest = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_MANIFEST', os.path.join(app.static_folder, 'assets-manifest.json'))
+        app.config.setdefault('ASSETS_EXCLUDE', ('profile_pics/',))
+        app.config.setdefault('ASSETS_MAX_AGE', 31536000)
+        app.extensions['assets'] = self
+        self._manifest = None
+
+        app.url_defaults(self._fingerprint_url)
+        app.view_functions['static'] = self.send_static
+
+        @app.cli.group('assets')
+        def assets_cli():
+            """Static asset fingerprints and compressed copies."""
+
+        @assets_cli.command('build')
+        def build_command():
+            """Hash the static files and write their compressed copies."""
+            digests, compressed = self.build()
+            click.echo(f'{digests} files fingerprinted, {compressed} compressed copies written.')
+
+        @assets_cli.command('clean')
+        def clean_command():
+            """Remove the manifest and the compressed copies."""
+            click.echo(f'{self.clean()} files removed.')
+
+    def digest(self, filename):
+        manifest = self._load_manifest()
+        if manifest is not None:
+            return manifest.get(filename)
+
+        path = self._path(filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._digests.get(filename)
+        if cached is None or cached[0] != mtime:
+            cached = mtime, _hash_file(path)
+            self._digests[filename] = cached
+        return cached[1]
+
+    def url_filename(self, filename):
+        if self._excluded(filename) or self._immutable(filename):
+            return filename
+        digest = self.digest(filename)
+        if digest is None:
+            return filename
+        stem, extension = os.path.splitext(filename)
+        return f'{stem}.{digest}{extension}'
+
+    def send_static(self, filename):
+        immutable = self._immutable(filename)
+        match = FINGERPRINTED.match(filename)
+        if match:
+            original = match['stem'] + match['extension']
+            # an old fingerprint still gets the current file, just not for a year
+            immutable = self.digest(original) == match['digest']
+            filename = original
+
+        folder = current_app.static_folder
+        mimetype, _ = mimetypes.guess_type(filename)
+        encoding, served = None, filename
+        if filename.endswith(COMPRESSIBLE):
+            for name, suffix in ENCODINGS:
+                if request.accept_encodings[name] and os.path.isfile(self._path(filename + suffix)):
+                    encoding, served = name, filename + suffix
+                    break
+
+        if immutable:
+            response = send_from_directory(folder, served, mimetype=mimetype,
+                                           max_age=current_app.config['ASSETS_MAX_AGE'])
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        else:
+            response = send_from_directory(folder, served, mimetype=mimetype,
+                                           max_age=current_app.get_send_file_max_age(filename))
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if filename.endswith(COMPRESSIBLE):
+            response.vary.add('Accept-Encoding')
+        return response
+
+    def build(self):
+        digests, compressed = {}, 0
+        for filename in self._files():
+            path = self._path(filename)
+            with open(path, 'rb') as file:
+                data = file.read()
+            digests[filename] = hashlib.sha256(data).hexdigest()[:12]
+            if filename.endswith(COMPRESSIBLE):
+                compressed += _write_compressed(path, data)
+
+        manifest = current_app.config['ASSETS_MANIFEST']
+        with open(manifest + '.part', 'w') as file:
+            json.dump(digests, file, indent=1, sort_keys=True)
+        os.replace(manifest + '.part', manifest)
+        self._manifest = None
+        return len(digests), compressed
+
+    def clean(self):
+        removed = 0
+        for filename in self._files(compressed=True):
+            if filename.endswith(COMPRESSED):
+                os.remove(self._path(filename))
+                removed += 1
+        manifest = current_app.config['ASSETS_MANIFEST']
+        if os.path.isfile(manifest):
+            os.remove(manifest)
+            removed += 1
+        self._manifest = None
+        return removed
+
+    def _files(self, compressed=False):
+        root = current_app.static_folder
+        manifest = os.path.abspath(current_app.config['ASSETS_MANIFEST'])
+        for directory, _, names in os.walk(root):
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                filename = os.path.relpath(path, root).replace(os.sep, '/')
+                if path == manifest or self._excluded(filename) or self._immutable(filename):
+                    continue
+                if not compressed and filename.endswith(COMPRESSED):
+                    continue
+                yield filename
+
+    def _load_manifest(self):
+        if current_app.debug:
+            return None
+        if self._manifest is None:
+            try:
+                with open(current_app.config['ASSETS_MANIFEST']) as file:
+                    self._manifest = json.load(file)
+            except FileNotFoundError:
+                self._manifest = False
+        return self._manifest or None
+
+    def _path(self, filename):
+        return os.path.join(current_app.static_folder, *filename.split('/'))
+
+    def _excluded(self, filename):
+        return filename.startswith(tuple(current_app.config['ASSETS_EXCLUDE']))
+
+    def _immutable(self, filename):
+        return filename.startswith(current_app.config['BLOB_STORE_FOLDER'] + '/')
+
+    def _fingerprint_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.url_filename(values['filename'])
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def _write_compressed(path, data):
+    written = 0
+    copies = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        copies.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, compressed in copies:
+        # only kept when it actually saves bytes
+        if len(compressed) < len(data):
+            with open(path + suffix + '.part', 'wb') as file:
+                file.write(compressed)
+            os.replace(path + suffix + '.part', path + suffix)
+            written += 1
+    return written
+
+
+assets = Assets()
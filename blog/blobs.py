@@ -0,0 +1,234 @@
+import hashlib
+import os
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import case, delete, event, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+
+from blog import db
+from blog.storage import storage
+
+
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}\.[0-9a-z]+$')
+
+# (model, column) pairs whose values name blobs
+REFERENCES = (('User', 'image_file'), ('Post', 'image_post'))
+
+
+def is_blob_name(name):
+    return bool(name) and BLOB_NAME.match(name) is not None
+
+
+class BlobStore:
+    """Files stored once, under the SHA-256 of their content.
+
+    A blob is kept in the media storage as BLOB_STORE_FOLDER/<two hex
+    digits>/<sha256>.<extension> and never changes, so identical
+    uploads and the stock avatars share one file. Blob.refcount counts the
+    columns in REFERENCES that name the blob and is kept in step on every
+    flush; a blob left unreferenced for BLOB_STORE_GC_GRACE seconds is
+    deleted together with the files derived from it (<sha256>-*). A rolled
+    back upload only removes its file while no committed row references it.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._timer = None
+        self._app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLOB_STORE_FOLDER', 'media')
+        app.config.setdefault('BLOB_STORE_GC_GRACE', 300)
+        app.extensions['blob_store'] = self
+        self._app = app
+
+        if not event.contains(db.session, 'after_flush', self._collect):
+            event.listen(db.session, 'after_flush', self._collect)
+            event.listen(db.session, 'after_commit', self._committed)
+            event.listen(db.session, 'after_rollback', self._rolled_back)
+
+        @app.cli.group('blobs')
+        def blobs_cli():
+            """Content-addressed file store."""
+
+        @blobs_cli.command('gc')
+        @click.option('--grace', type=int, default=None, help='Seconds a blob must have been unreferenced.')
+        def gc_command(grace):
+            """Delete the blobs nothing references."""
+            click.echo(f'{self.collect(grace)} blobs deleted.')
+
+        @blobs_cli.command('recount')
+        def recount_command():
+            """Recount the references of every blob."""
+            click.echo(f'{self.recount()} blobs recounted.')
+
+    def key(self, name):
+        return f"{current_app.config['BLOB_STORE_FOLDER']}/{name[:2]}/{name}"
+
+    def put(self, data, extension):
+        from blog.models import Blob
+
+        digest = hashlib.sha256(data).hexdigest()
+        extension = extension.lower().lstrip('.')
+        name = f'{digest}.{extension}'
+
+        blob = db.session.get(Blob, digest)
+        if blob is None:
+            try:
+                with db.session.begin_nested():
+                    db.session.add(Blob(hash=digest, extension=extension, size=len(data),
+                                        released_at=datetime.utcnow()))
+                db.session.info.setdefault('new_blobs', []).append(name)
+            except IntegrityError:
+                pass
+        elif blob.refcount <= 0:
+            # about to be referenced again, keep the collector away for another grace period
+            blob.released_at = datetime.utcnow()
+
+        with self._lock:
+            if not storage.exists(self.key(name)):
+                storage.write(self.key(name), data)
+        # kept until the commit, which puts the file back if a concurrent rollback removed it
+        db.session.info.setdefault('put_blobs', {})[name] = data
+        return name
+
+    def remove(self, name):
+        stem, _ = os.path.splitext(self.key(name))
+        storage.delete_prefix(stem + '-')
+        storage.delete(self.key(name))
+
+    def collect(self, grace=None):
+        from blog.models import Blob
+
+        if grace is None:
+            grace = current_app.config['BLOB_STORE_GC_GRACE']
+        cutoff = datetime.utcnow() - timedelta(seconds=grace)
+        removed = []
+        with db.engine.begin() as connection:
+            for digest, extension in connection.execute(select(Blob.hash, Blob.extension)
+                                                        .where(Blob.released_at <= cutoff)).all():
+                # checked again row by row, an upload may have picked the blob up meanwhile
+                if connection.execute(delete(Blob).where(Blob.hash == digest, Blob.refcount <= 0,
+                                                         Blob.released_at <= cutoff)).rowcount:
+                    removed.append(f'{digest}.{extension}')
+        for name in removed:
+            self.remove(name)
+        return len(removed)
+
+    def recount(self):
+        from blog import models
+        from blog.models import Blob
+
+        counts = Counter()
+        for model, column in REFERENCES:
+            model = getattr(models, model)
+            for name, in db.session.query(getattr(model, column)):
+                if is_blob_name(name):
+                    counts[name.split('.')[0]] += 1
+
+        blobs = Blob.query.all()
+        now = datetime.utcnow()
+        for blob in blobs:
+            blob.refcount = counts[blob.hash]
+            if blob.refcount:
+                blob.released_at = None
+            elif blob.released_at is None:
+                blob.released_at = now
+        db.session.commit()
+        return len(blobs)
+
+    def _collect(self, session, flush_context):
+        from blog import models
+
+        deltas = Counter()
+        for model, column in REFERENCES:
+            model = getattr(models, model)
+            for obj in session.new:
+                if isinstance(obj, model) and is_blob_name(inspect(obj).dict.get(column)):
+                    deltas[inspect(obj).dict[column]] += 1
+            for obj in session.deleted:
+                if isinstance(obj, model):
+                    # an expired column cannot be loaded for a deleted row; the blob then outlives
+                    # its last reference until `flask blobs recount`
+                    history = inspect(obj).attrs[column].history
+                    for name in history.deleted or history.unchanged:
+                        if is_blob_name(name):
+                            deltas[name] -= 1
+            for obj in session.dirty:
+                if isinstance(obj, model):
+                    history = inspect(obj).attrs[column].history
+                    for name in history.deleted:
+                        if is_blob_name(name):
+                            deltas[name] -= 1
+                    for name in history.added:
+                        if is_blob_name(name):
+                            deltas[name] += 1
+
+        deltas = {name: delta for name, delta in deltas.items() if delta}
+        if deltas:
+            self._adjust(session.connection(), deltas)
+            if any(delta < 0 for delta in deltas.values()):
+                session.info['released_blobs'] = True
+
+    def _adjust(self, connection, deltas):
+        from blog.models import Blob
+
+        now = datetime.utcnow()
+        for name, delta in deltas.items():
+            refcount = Blob.refcount + delta
+            connection.execute(update(Blob).where(Blob.hash == name.split('.')[0])
+                               .values(refcount=refcount, released_at=case((refcount <= 0, now), else_=None)))
+
+    def _committed(self, session):
+        session.info.pop('new_blobs', None)
+        put = session.info.pop('put_blobs', None)
+        if put:
+            with self._lock:
+                for name, data in put.items():
+                    if not storage.exists(self.key(name)):
+                        storage.write(self.key(name), data)
+        if not session.info.pop('released_blobs', False):
+            return
+        grace = current_app.config['BLOB_STORE_GC_GRACE']
+        if grace <= 0:
+            self.collect(0)
+            return
+        with self._lock:
+            if self._timer is None or not self._timer.is_alive():
+                self._timer = threading.Timer(grace + 1, self._run_collect)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _rolled_back(self, session):
+        from blog.models import Blob
+
+        session.info.pop('released_blobs', None)
+        session.info.pop('put_blobs', None)
+        # the rows of these blobs were never saved, but another transaction that uploaded the
+        # same content may have committed its own reference meanwhile
+        names = session.info.pop('new_blobs', [])
+        if not names:
+            return
+        with self._lock, db.engine.connect() as connection:
+            for name in names:
+                refcount = connection.execute(select(Blob.refcount)
+                                              .where(Blob.hash == name.split('.')[0])).scalar()
+                if not refcount:
+                    self.remove(name)
+
+    def _run_collect(self):
+        with self._app.app_context():
+            try:
+                self.collect()
+            except Exception:
+                current_app.logger.exception('Blob garbage collection failed')
+
+
+blob_store = BlobStore()
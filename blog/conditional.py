@@ -0,0 +1,62 @@
+import functools
+import hashlib
+import time
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+from blog.fragments import fragment_cache
+
+
+def page_etag(*parts, versions=()):
+    """An ETag for what the current visitor sees at this URL, from values known before rendering.
+
+    `parts` are cheap values the page depends on and `versions` names of
+    fragment_cache versions. Returns None when the page cannot be reused: a
+    request that is not a GET, or pending flash messages.
+    """
+    if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        return None
+    user = (current_user.id, current_user.username, current_user.image_file, current_user.role) \
+        if current_user.is_authenticated else None
+    parts = [request.full_path, user, *parts, *fragment_cache.versions(*versions)]
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if current_app.config.get('WTF_CSRF_ENABLED', True) and limit:
+        # a reused page must not outlive the CSRF tokens of its forms
+        parts.append(int(time.time() // limit))
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """A 304 when the client already holds the page tagged `etag`, otherwise None."""
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    return _validated(current_app.response_class(status=304), etag)
+
+
+def tagged(response, etag):
+    """The response with `etag`, unless it already has a validator of its own."""
+    response = make_response(response)
+    if etag is not None and response.status_code == 200 and response.get_etag()[0] is None:
+        _validated(response, etag)
+    return response
+
+
+def conditional(*versions):
+    """Answer a GET with 304 before the view runs when nothing in `versions` changed."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            etag = page_etag(versions=versions)
+            return not_modified(etag) or tagged(view(**kwargs), etag)
+        return wrapper
+    return decorator
+
+
+def _validated(response, etag):
+    response.set_etag(etag)
+    # the page depends on who is logged in: browsers keep it but ask each time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import Counter
+
+import click
+from flask import current_app
+from sqlalchemy import event, func, inspect
+
+from blog import db
+
+
+class PostCounts:
+    """Cached post totals per scope: ('all',), ('author', user_id), ('category', name), ('tag', name).
+
+    Committed creates and deletes adjust the cached totals in place. Deleting a
+    user, whose posts go with them through ON DELETE CASCADE, or a bulk delete
+    drops the cache instead. Every POST_COUNTS_RECONCILE_INTERVAL seconds the
+    cache is recounted from the database to fix drift from other processes or
+    bulk inserts and updates.
+    """
+
+    def __init__(self, app=None):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._reconciled_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('POST_COUNTS_RECONCILE_INTERVAL', 300)
+        app.extensions['post_counts'] = self
+
+        if not event.contains(db.session, 'after_flush', self._collect):
+            event.listen(db.session, 'after_flush', self._collect)
+            event.listen(db.session, 'after_commit', self._apply)
+            event.listen(db.session, 'after_rollback', self._discard)
+            event.listen(db.session, 'do_orm_execute', self._bulk_delete)
+            # a freshly created schema has nothing in common with what was cached
+            event.listen(db.metadata, 'after_create', lambda *args, **kwargs: self.clear())
+
+        @app.cli.group('counts')
+        def counts_cli():
+            """Cached post totals."""
+
+        @counts_cli.command('reconcile')
+        def reconcile_command():
+            """Recount every scope from the database."""
+            self.reconcile()
+            click.echo(f'{len(self._counts)} scopes recounted.')
+
+    def get(self, scope):
+        if time.monotonic() - self._reconciled_at > current_app.config['POST_COUNTS_RECONCILE_INTERVAL']:
+            self.reconcile()
+        with self._lock:
+            value = self._counts.get(scope)
+        if value is None:
+            value = self._count(scope)
+            with self._lock:
+                self._counts.setdefault(scope, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+    def reconcile(self):
+        from blog.models import Post, Tag, post_tags
+
+        counts = {('all',): db.session.query(func.count(Post.id)).scalar()}
+        for user_id, total in db.session.query(Post.user_id, func.count(Post.id)).group_by(Post.user_id):
+            counts[('author', user_id)] = total
+        for category, total in db.session.query(Post.category, func.count(Post.id)).group_by(Post.category):
+            counts[('category', category)] = total
+        for name, total in db.session.query(Tag.name, func.count(post_tags.c.post_id)) \
+                .join(post_tags, post_tags.c.tag_id == Tag.id).group_by(Tag.name):
+            counts[('tag', name)] = total
+
+        with self._lock:
+            self._counts = counts
+            self._reconciled_at = time.monotonic()
+
+    def _count(self, scope):
+        from blog.models import Post, Tag, post_tags
+
+        kind = scope[0]
+        if kind == 'all':
+            return db.session.query(func.count(Post.id)).scalar()
+        if kind == 'author':
+            return db.session.query(func.count(Post.id)).filter(Post.user_id == scope[1]).scalar()
+        if kind == 'category':
+            return db.session.query(func.count(Post.id)).filter(Post.category == scope[1]).scalar()
+        if kind == 'tag':
+            return db.session.query(func.count(post_tags.c.post_id)) \
+                .join(Tag, Tag.id == post_tags.c.tag_id).filter(Tag.name == scope[1]).scalar()
+        raise ValueError(f'Unknown count scope {scope!r}')
+
+    def _collect(self, session, flush_context):
+        from blog.models import Post, User
+
+        deltas = session.info.setdefault('post_count_deltas', Counter())
+        if any(isinstance(obj, User) for obj in session.deleted):
+            # their posts are removed by the database, out of sight of the session
+            session.info['post_count_stale'] = True
+
+        def scopes(obj, pending=False):
+            # only what is already loaded - a deleted row cannot be refreshed
+            values = inspect(obj).dict
+            tags = values.get('tags', [] if pending else None)
+            if 'user_id' not in values or 'category' not in values or tags is None:
+                session.info['post_count_stale'] = True
+                return []
+            return [('all',), ('author', values['user_id']), ('category', values['category'])] + \
+                [('tag', tag.name) for tag in tags]
+
+        for obj in session.new:
+            if isinstance(obj, Post):
+                for scope in scopes(obj, pending=True):
+                    deltas[scope] += 1
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                for scope in scopes(obj):
+                    deltas[scope] -= 1
+        for obj in session.dirty:
+            if not isinstance(obj, Post):
+                continue
+            state = inspect(obj)
+            for attr, kind in (('user_id', 'author'), ('category', 'category')):
+                history = state.attrs[attr].history
+                for old in history.deleted:
+                    deltas[(kind, old)] -= 1
+                for new in history.added:
+                    deltas[(kind, new)] += 1
+            history = state.attrs.tags.history
+            for tag in history.deleted:
+                deltas[('tag', tag.name)] -= 1
+            for tag in history.added:
+                deltas[('tag', tag.name)] += 1
+
+    def _bulk_delete(self, orm_execute_state):
+        if orm_execute_state.is_delete and \
+                orm_execute_state.statement.table.name in ('posts', 'users', 'tags', 'post_tags'):
+            orm_execute_state.session.info['post_count_stale'] = True
+
+    def _apply(self, session):
+        deltas = session.info.pop('post_count_deltas', None)
+        if session.info.pop('post_count_stale', False):
+            self.clear()
+            return
+        if not deltas:
+            return
+        with self._lock:
+            for scope, delta in deltas.items():
+                if scope in self._counts:
+                    self._counts[scope] = max(self._counts[scope] + delta, 0)
+
+    def _discard(self, session):
+        session.info.pop('post_count_deltas', None)
+        session.info.pop('post_count_stale', None)
+
+
+post_counts = PostCounts()
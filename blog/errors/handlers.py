@@ -13,6 +13,11 @@ def error_403(error):
     return render_template('errors/403.html'), 403
 
 
+@errors.app_errorhandler(413)
+def error_413(error):
+    return render_template('errors/413.html'), 413
+
+
 @errors.app_errorhandler(500)
 def error_500(error):
     return render_template('errors/500.html'), 500
@@ -0,0 +1,234 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import event, inspect
+
+from blog import db
+
+
+# columns shown in cached fragments; the picture of a post is part of the fragment name instead,
+# the image queue also changes it with bulk updates
+POST_COLUMNS = ('title', 'content', 'category', 'slug', 'date_posted', 'user_id')
+USER_COLUMNS = ('username', 'image_file')
+# columns shown by the post listings
+LISTING_COLUMNS = POST_COLUMNS + ('image_post', 'image_processing')
+
+
+class LocalStore:
+    """Fragments in this process, evicted least recently used past a count or a total size."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def versions(self, names):
+        with self._lock:
+            values = []
+            for name in names:
+                values.append(self._versions.setdefault(name, time.time_ns()))
+                self._versions.move_to_end(name)
+            self._evict_versions()
+            return values
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, time.time_ns()) + 1
+                self._versions.move_to_end(name)
+            self._evict_versions()
+
+    def _evict_versions(self):
+        # a version read again after its eviction starts over from the clock, so the
+        # fragments stored under the old one are missed, never served stale
+        while len(self._versions) > self.max_entries:
+            self._versions.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes}
+
+
+class RedisStore:
+    """Fragments and versions in Redis, shared by every process; Redis evicts by its maxmemory policy."""
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, size):
+        self.client.setex(key, self.ttl, json.dumps(value))
+
+    def versions(self, names):
+        keys = [f'version:{name}' for name in names]
+        values = self.client.mget(keys)
+        for index, value in enumerate(values):
+            if value is None:
+                # a lost version starts again from the clock, never from a number already used
+                self.client.set(keys[index], time.time_ns(), nx=True)
+                values[index] = self.client.get(keys[index])
+        return [int(value) for value in values]
+
+    def bump(self, names):
+        pipeline = self.client.pipeline()
+        for name in names:
+            pipeline.set(f'version:{name}', time.time_ns(), nx=True)
+            pipeline.incr(f'version:{name}')
+        pipeline.execute()
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class FragmentCache:
+    """Rendered pieces of pages, reused until what they show changes.
+
+    A fragment is cached under its name and the current numbers of the
+    versions it depends on: 'post:<id>' (the article), 'tags:<post id>',
+    'comments:<post id>' and 'user:<id>' (a name and avatar). Committed
+    changes to those rows bump the matching versions, so edits only miss the
+    fragments that show them and stale entries simply age out of the LRU.
+    'posts' follows everything the post listings show and 'likes:<post id>'
+    the likes of a post and its comments; blog.conditional builds ETags
+    from them.
+    FRAGMENT_CACHE_REDIS_URL moves fragments and versions to Redis; the
+    default store is per process, which only suits a single process or
+    pages that may lag behind other processes' edits.
+    """
+
+    def __init__(self, app=None):
+        self.store = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+        app.config.setdefault('FRAGMENT_CACHE_MAX_ENTRIES', 10000)
+        app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.config.setdefault('FRAGMENT_CACHE_REDIS_URL', None)
+        app.config.setdefault('FRAGMENT_CACHE_TTL', 24 * 3600)
+        app.extensions['fragment_cache'] = self
+
+        if app.config['FRAGMENT_CACHE_REDIS_URL']:
+            import redis
+
+            self.store = RedisStore(redis.Redis.from_url(app.config['FRAGMENT_CACHE_REDIS_URL']),
+                                    app.config['FRAGMENT_CACHE_TTL'])
+        else:
+            self.store = LocalStore(app.config['FRAGMENT_CACHE_MAX_ENTRIES'], app.config['FRAGMENT_CACHE_MAX_BYTES'])
+
+        if not event.contains(db.session, 'after_flush', self._collect):
+            event.listen(db.session, 'after_flush', self._collect)
+            event.listen(db.session, 'after_commit', self._apply)
+            event.listen(db.session, 'after_rollback', self._discard)
+            # ids of a dropped schema belong to other rows once it is recreated
+            event.listen(db.metadata, 'after_drop', lambda *args, **kwargs: self.store.clear())
+
+    def fragment(self, name, depends_on, render):
+        """The cached value of `name`, or what render() returns; values must be JSON serializable."""
+        if not current_app.config['FRAGMENT_CACHE_ENABLED']:
+            return render()
+        versions = self.store.versions(depends_on)
+        key = f'fragment:{name}:' + '.'.join(str(version) for version in versions)
+        value = self.store.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = render()
+        self.store.set(key, value, len(json.dumps(value)))
+        return value
+
+    def versions(self, *names):
+        return self.store.versions(names)
+
+    def bump(self, *names):
+        if names:
+            self.store.bump(names)
+
+    def stats(self):
+        return dict(self.store.stats(), hits=self.hits, misses=self.misses)
+
+    def _collect(self, session, flush_context):
+        from blog.models import Post, Comment, User
+
+        stale = session.info.setdefault('stale_fragments', set())
+        for obj in session.new:
+            if isinstance(obj, Post):
+                stale.add('posts')
+            elif isinstance(obj, Comment):
+                stale.add(f'comments:{obj.post_id}')
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                stale.update((f'post:{obj.id}', f'tags:{obj.id}', f'comments:{obj.id}', 'posts'))
+            elif isinstance(obj, Comment):
+                stale.add(f'comments:{obj.post_id}')
+            elif isinstance(obj, User):
+                stale.update((f'user:{obj.id}', 'posts'))
+        for obj in session.dirty:
+            state = inspect(obj)
+            if isinstance(obj, Post):
+                if any(state.attrs[name].history.has_changes() for name in POST_COLUMNS):
+                    stale.add(f'post:{obj.id}')
+                if state.attrs.tags.history.has_changes():
+                    stale.update((f'tags:{obj.id}', 'posts'))
+                if any(state.attrs[name].history.has_changes() for name in LISTING_COLUMNS):
+                    stale.add('posts')
+            elif isinstance(obj, Comment):
+                stale.add(f'comments:{obj.post_id}')
+            elif isinstance(obj, User):
+                if any(state.attrs[name].history.has_changes() for name in USER_COLUMNS):
+                    stale.update((f'user:{obj.id}', 'posts'))
+
+    def _apply(self, session):
+        stale = session.info.pop('stale_fragments', None)
+        if stale:
+            self.bump(*stale)
+
+    def _discard(self, session):
+        session.info.pop('stale_fragments', None)
+
+
+fragment_cache = FragmentCache()
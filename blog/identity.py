@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+from sqlalchemy import event, inspect, select
+
+from blog import db
+
+
+# the columns of a user that the pages show on every request
+FIELDS = ('id', 'username', 'image_file', 'role')
+
+
+class UserIdentity(UserMixin):
+    """The logged-in user as far as most requests need it.
+
+    Holds only FIELDS. Any other attribute, and any assignment, goes to the
+    User row, which is loaded on first use within the request, so code written
+    for a User keeps working. Compares equal to the User with the same id.
+    """
+
+    def __init__(self, id, username, image_file, role):
+        object.__setattr__(self, '_values', {'id': id, 'username': username, 'image_file': image_file, 'role': role})
+        object.__setattr__(self, '_row', None)
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
+    def load(self):
+        from blog.models import User
+
+        if self._row is None:
+            object.__setattr__(self, '_row', db.session.get(User, self._values['id']))
+        return self._row
+
+    def __getattr__(self, name):
+        values = object.__getattribute__(self, '_values')
+        if name in values:
+            return values[name]
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+        if name in self._values:
+            self._values[name] = value
+
+    def __eq__(self, other):
+        from blog.models import User
+
+        if isinstance(other, (User, UserIdentity)):
+            return other.id == self.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(('User', self.id))
+
+    def __repr__(self):
+        return f'UserIdentity({self.id}, {self.username})'
+
+
+class UserCache:
+    """Resolves flask_login's user id to a UserIdentity without a query on most requests.
+
+    Identities are kept USER_CACHE_TTL seconds in an in-process LRU of
+    USER_CACHE_SIZE entries and, with USER_CACHE_REDIS_URL, for
+    USER_CACHE_SHARED_TTL seconds in Redis, shared by every process. A
+    committed change to the username, picture or role of a user, or its
+    deletion, drops the user from both; other processes may see the old
+    values until their local entry expires, which is why USER_CACHE_TTL is
+    short. A miss reads only FIELDS, never the password hash.
+    """
+
+    def __init__(self, app=None):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_TTL', 5)
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        app.config.setdefault('USER_CACHE_REDIS_URL', None)
+        app.config.setdefault('USER_CACHE_SHARED_TTL', 300)
+        app.extensions['user_cache'] = self
+        self._ttl = app.config['USER_CACHE_TTL']
+        self._size = app.config['USER_CACHE_SIZE']
+        self._shared_ttl = app.config['USER_CACHE_SHARED_TTL']
+        self._shared = None
+        if app.config['USER_CACHE_REDIS_URL']:
+            import redis
+
+            self._shared = redis.Redis.from_url(app.config['USER_CACHE_REDIS_URL'])
+
+        if not event.contains(db.session, 'after_flush', self._collect):
+            event.listen(db.session, 'after_flush', self._collect)
+            event.listen(db.session, 'after_commit', self._apply)
+            event.listen(db.session, 'after_rollback', self._discard)
+            # ids of a dropped schema belong to other users once it is recreated
+            event.listen(db.metadata, 'after_drop', lambda *args, **kwargs: self.clear())
+
+    def get(self, user_id):
+        values = self._local(user_id)
+        if values is None and self._shared is not None:
+            cached = self._shared.get(self._key(user_id))
+            if cached is not None:
+                values = json.loads(cached)
+                self._remember(user_id, values)
+        if values is None:
+            values = self._query(user_id)
+            if values is None:
+                return None
+            self._remember(user_id, values)
+            if self._shared is not None:
+                self._shared.setex(self._key(user_id), self._shared_ttl, json.dumps(values))
+        return UserIdentity(*values)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+        if self._shared is not None and user_ids:
+            self._shared.delete(*(self._key(user_id) for user_id in user_ids))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _local(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def _remember(self, user_id, values):
+        if self._ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self._ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def _query(self, user_id):
+        from blog.models import User
+
+        row = db.session.execute(select(*(getattr(User, name) for name in FIELDS))
+                                 .where(User.id == user_id)).first()
+        return list(row) if row is not None else None
+
+    def _key(self, user_id):
+        return f'blog:user:{user_id}'
+
+    def _collect(self, session, flush_context):
+        from blog.models import User
+
+        stale = session.info.setdefault('stale_users', set())
+        for obj in session.deleted:
+            if isinstance(obj, User):
+                stale.add(obj.id)
+        for obj in session.dirty:
+            if isinstance(obj, User):
+                state = inspect(obj)
+                if any(state.attrs[name].history.has_changes() for name in FIELDS):
+                    stale.add(obj.id)
+
+    def _apply(self, session):
+        stale = session.info.pop('stale_users', None)
+        if stale:
+            self.invalidate(*stale)
+
+    def _discard(self, session):
+        session.info.pop('stale_users', None)
+
+
+user_cache = UserCache()
@@ -0,0 +1,402 @@
+import io
+import os
+import re
+import secrets
+from datetime import datetime, timedelta
+
+import click
+from PIL import Image
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import event, update
+
+from blog import db
+from blog.blobs import blob_store, is_blob_name
+from blog.queues import TableQueue
+from blog.storage import storage
+from blog.uploads import discard_uploads
+
+try:
+    # AVIF for Pillow releases without built-in support
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+
+# kind -> (column that holds the file name, folder in the owner's media directory)
+TARGETS = {
+    'avatar': ('image_file', 'profile_img'),
+    'post': ('image_post', 'post_images'),
+}
+
+
+VARIANT_MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+VARIANT_NAME = re.compile(r'-\d+\.(avif|webp)$')
+
+# pictures whose variants were seen in the storage, so templates look each picture up only until it has them
+_variants_stored = set()
+
+
+def user_media_prefix(user_id):
+    # keyed on the id, so renaming a user leaves the files and their URLs alone
+    return f'profile_pics/ids/{user_id}/'
+
+
+def legacy_media_prefix(username):
+    # where `flask images relocate` finds the folders of the username layout
+    return f'profile_pics/users/{username}/'
+
+
+def media_key(user_id, folder, filename):
+    # pictures from before the blob store still live in their owner's media folder
+    if is_blob_name(filename):
+        return blob_store.key(filename)
+    return f'{user_media_prefix(user_id)}{folder}/{filename}'
+
+
+def media_url(user_id, folder, filename):
+    return storage.url(media_key(user_id, folder, filename))
+
+
+def variant_formats():
+    Image.init()
+    return [name for name in current_app.config['IMAGE_VARIANT_FORMATS'] if name.upper() in Image.SAVE]
+
+
+def variant_name(filename, width, image_format):
+    stem, _ = os.path.splitext(filename)
+    return f'{stem}-{width}.{image_format}'
+
+
+def render_file(image, key, image_format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **options)
+    storage.write(key, buffer.getvalue())
+
+
+def render_variants(image, key, widths):
+    # a copy per width, never wider than the picture itself
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.getbands() else 'RGB')
+    for width in widths:
+        variant = image.copy()
+        variant.thumbnail((width, image.height))
+        for image_format in variant_formats():
+            render_file(variant, variant_name(key, width, image_format),
+                        image_format.upper(), quality=current_app.config['IMAGE_VARIANT_QUALITY'])
+
+
+def ensure_variants(key, widths, force=False):
+    complete = all(storage.exists(variant_name(key, width, image_format))
+                   for width in widths for image_format in variant_formats())
+    if complete and not force:
+        return False
+    with Image.open(io.BytesIO(storage.read(key))) as image:
+        image.load()
+        render_variants(image, key, widths)
+    return True
+
+
+def render_image(source, extension, size):
+    image = Image.open(source)
+    # a JPEG is decoded straight at the smallest of 1/2, 1/4 or 1/8 scale that still covers the size
+    image.draft('RGB', (size, size))
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, format=Image.registered_extensions()[extension.lower()])
+    return buffer.getvalue()
+
+
+def store_picture(data, extension, folder):
+    # identical pictures come out as the same blob, which already has its variants
+    name = blob_store.put(data, extension)
+    ensure_variants(blob_store.key(name), current_app.config['IMAGE_VARIANT_WIDTHS'].get(folder, ()))
+    return name
+
+
+def remove_file(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def discard_picture(user_id, folder, filename):
+    # blobs are left to the collector, they may be shared
+    if not filename or is_blob_name(filename):
+        return
+    key = media_key(user_id, folder, filename)
+    stem, _ = os.path.splitext(key)
+    for variant in storage.list(stem + '-'):
+        if VARIANT_NAME.search(variant):
+            storage.delete(variant)
+    storage.delete(key)
+
+
+def responsive_image(user_id, folder, filename, width, **attributes):
+    """<picture> for a media file shown `width` CSS pixels wide.
+
+    Every format gets the smallest variant that covers 1x and 2x screens; the
+    original file stays the <img> fallback and is the only source until
+    `flask images variants` has rendered the variants of older pictures.
+    """
+    key = media_key(user_id, folder, filename)
+    widths = sorted(current_app.config['IMAGE_VARIANT_WIDTHS'].get(folder, ()))
+    formats = variant_formats()
+    sources = []
+    if widths and formats and _has_variants(key, widths[0], formats[-1]):
+        for image_format in formats:
+            candidates = []
+            for density in (1, 2):
+                chosen = next((w for w in widths if w >= width * density), widths[-1])
+                if chosen not in [w for w, _ in candidates]:
+                    candidates.append((chosen, density))
+            srcset = ', '.join(
+                storage.url(variant_name(key, chosen, image_format)) + f' {density}x'
+                for chosen, density in candidates)
+            sources.append(f'<source type="{VARIANT_MIME_TYPES[image_format]}" srcset="{escape(srcset)}">')
+
+    attributes = ''.join(f' {name.rstrip("_")}="{escape(value)}"' for name, value in attributes.items())
+    img = f'<img src="{escape(storage.url(key))}"{attributes}>'
+    if not sources:
+        return Markup(img)
+    return Markup('<picture>' + ''.join(sources) + img + '</picture>')
+
+
+def _has_variants(key, width, image_format):
+    if key in _variants_stored:
+        return True
+    if not storage.exists(variant_name(key, width, image_format)):
+        return False
+    if len(_variants_stored) > 10000:
+        _variants_stored.clear()
+    _variants_stored.add(key)
+    return True
+
+
+class ImageQueue(TableQueue):
+    """Resizes uploaded pictures outside the request.
+
+    An upload only stores the raw file in IMAGE_QUEUE_UPLOAD_FOLDER and adds an
+    ImageJob row. IMAGE_QUEUE_WORKERS background threads, or `flask images work`
+    in a separate process, decode, resize and encode the picture, put it in the
+    blob store and then swap its name into User.image_file or Post.image_post.
+    With IMAGE_QUEUE_EAGER the picture is processed in the request instead.
+    """
+
+    config_prefix = 'IMAGE_QUEUE'
+    thread_name = 'image-queue-worker'
+
+    def __init__(self, app=None):
+        super().__init__()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_QUEUE_EAGER', False)
+        app.config.setdefault('IMAGE_QUEUE_WORKERS', 2)
+        app.config.setdefault('IMAGE_QUEUE_POLL_INTERVAL', 5)
+        app.config.setdefault('IMAGE_QUEUE_MAX_ATTEMPTS', 3)
+        app.config.setdefault('IMAGE_QUEUE_STALE_AFTER', 300)
+        app.config.setdefault('IMAGE_QUEUE_UPLOAD_FOLDER', os.path.join(app.instance_path, 'image_uploads'))
+        app.config.setdefault('IMAGE_VARIANT_WIDTHS', {'profile_img': (64, 128, 360), 'post_images': (160, 320, 500)})
+        app.config.setdefault('IMAGE_VARIANT_FORMATS', ('avif', 'webp'))
+        app.config.setdefault('IMAGE_VARIANT_QUALITY', 80)
+        app.config.setdefault('IMAGE_UPLOAD_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('IMAGE_UPLOAD_MAX_SIDE', 10000)
+        app.config.setdefault('IMAGE_UPLOAD_MAX_PIXELS', 40000000)
+        app.extensions['image_queue'] = self
+        app.add_template_global(responsive_image)
+        app.teardown_request(discard_uploads)
+        self._app = app
+
+        if not event.contains(db.session, 'after_commit', self._committed):
+            event.listen(db.session, 'after_commit', self._committed)
+            event.listen(db.session, 'after_rollback', self._rolled_back)
+
+        @app.cli.group('images')
+        def images_cli():
+            """Uploaded image processing."""
+
+        @images_cli.command('work')
+        @click.option('--watch', is_flag=True, help='Keep waiting for new jobs.')
+        def work_command(watch):
+            """Process the pending image jobs."""
+            while True:
+                processed = self.work()
+                click.echo(f'{processed} image jobs processed.')
+                if not watch:
+                    break
+                self._wait()
+
+        @images_cli.command('variants')
+        @click.option('--force', is_flag=True, help='Render the variants again even if they exist.')
+        def variants_command(force):
+            """Render the missing variants of the avatars and post pictures."""
+            click.echo(f'{self.backfill(force)} pictures rendered.')
+
+        @images_cli.command('relocate')
+        def relocate_command():
+            """Move the media folders named after usernames to the ones named after user ids."""
+            click.echo(f'{self.relocate()} media folders moved.')
+
+        @images_cli.command('dedupe')
+        def dedupe_command():
+            """Move the pictures in the users' media folders into the blob store."""
+            click.echo(f'{self.dedupe()} pictures moved.')
+
+    def enqueue(self, target, kind, upload, size):
+        # `upload` is an Upload from blog.uploads, already checked and on disk
+        from blog.models import ImageJob
+
+        column, folder = TARGETS[kind]
+        extension = upload.extension
+
+        if current_app.config['IMAGE_QUEUE_EAGER']:
+            name = store_picture(render_image(upload.path, extension, size), extension, folder)
+            previous = getattr(target, column)
+            setattr(target, column, name)
+            if previous != name:
+                discard_picture(self._owner(target, kind), folder, previous)
+            return
+
+        uploads = current_app.config['IMAGE_QUEUE_UPLOAD_FOLDER']
+        source = secrets.token_hex(16) + extension
+        os.replace(upload.path, os.path.join(uploads, source))
+        db.session.info.setdefault('image_uploads', []).append(os.path.join(uploads, source))
+
+        if target.id is None:
+            db.session.flush()
+        db.session.add(ImageJob(kind=kind, target_id=target.id, source=source, size=size))
+        if kind == 'post':
+            target.image_processing = True
+
+    def work(self):
+        self._requeue_stale()
+        processed = 0
+        while True:
+            job_ids = self._due(1)
+            if not job_ids:
+                return processed
+            for job_id in self._claim(job_ids):
+                self._process(job_id)
+                processed += 1
+
+    def _owner(self, target, kind):
+        return target.id if kind == 'avatar' else target.user_id
+
+    def _model(self):
+        from blog.models import ImageJob
+
+        return ImageJob
+
+    def _process(self, job_id):
+        from blog.models import ImageJob, User, Post
+
+        job = db.session.get(ImageJob, job_id)
+        column, folder = TARGETS[job.kind]
+        model = User if job.kind == 'avatar' else Post
+        source = os.path.join(current_app.config['IMAGE_QUEUE_UPLOAD_FOLDER'], job.source)
+        try:
+            target = db.session.get(model, job.target_id)
+            if target is None:
+                job.status, job.error, job.finished_at = 'failed', 'The target was deleted', datetime.utcnow()
+                db.session.commit()
+                remove_file(source)
+                return
+
+            _, extension = os.path.splitext(job.source)
+            name = store_picture(render_image(source, extension, job.size), extension, folder)
+
+            owner, previous = self._owner(target, job.kind), getattr(target, column)
+            setattr(target, column, name)
+            if job.kind == 'post':
+                target.image_processing = False
+            job.filename, job.status, job.error, job.finished_at = name, 'done', None, datetime.utcnow()
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            current_app.logger.exception('Image job %s failed', job_id)
+            job = db.session.get(ImageJob, job_id)
+            job.error = str(error)
+            if job.attempts < current_app.config['IMAGE_QUEUE_MAX_ATTEMPTS']:
+                # retried later, backing off a little more after every failure
+                job.status = 'pending'
+                job.run_after = datetime.utcnow() + \
+                    timedelta(seconds=current_app.config['IMAGE_QUEUE_POLL_INTERVAL'] * 2 ** job.attempts)
+            else:
+                job.status, job.finished_at = 'failed', datetime.utcnow()
+                if job.kind == 'post':
+                    db.session.execute(update(Post).where(Post.id == job.target_id).values(image_processing=False))
+                remove_file(source)
+            db.session.commit()
+            return
+
+        if previous != name:
+            discard_picture(owner, folder, previous)
+        remove_file(source)
+
+    def backfill(self, force=False):
+        pictures = set()
+        for kind, (_, folder) in TARGETS.items():
+            for owner, filename in self._pictures(kind):
+                pictures.add((media_key(owner, folder, filename), folder))
+
+        rendered = 0
+        for key, folder in sorted(pictures):
+            if not storage.exists(key):
+                continue
+            try:
+                if ensure_variants(key, current_app.config['IMAGE_VARIANT_WIDTHS'].get(folder, ()), force):
+                    rendered += 1
+            except OSError:
+                current_app.logger.warning('Skipped %s, not a picture', key)
+        return rendered
+
+    def dedupe(self):
+        from blog.models import User, Post
+
+        moved = []
+        for kind, (column, folder) in TARGETS.items():
+            model = User if kind == 'avatar' else Post
+            for target in model.query.filter(getattr(model, column).isnot(None)):
+                filename, owner = getattr(target, column), self._owner(target, kind)
+                key = media_key(owner, folder, filename)
+                if is_blob_name(filename) or not storage.exists(key):
+                    continue
+                name = store_picture(storage.read(key), os.path.splitext(filename)[1], folder)
+                setattr(target, column, name)
+                moved.append((owner, folder, filename))
+        db.session.commit()
+
+        for owner, folder, filename in moved:
+            discard_picture(owner, folder, filename)
+        return len(moved)
+
+    def relocate(self):
+        from blog.models import User
+
+        moved = 0
+        for user_id, username in db.session.query(User.id, User.username).order_by(User.id):
+            old = legacy_media_prefix(username)
+            if storage.list(old):
+                storage.rename_prefix(old, user_media_prefix(user_id))
+                moved += 1
+        return moved
+
+    def _pictures(self, kind):
+        from blog.models import User, Post
+
+        if kind == 'avatar':
+            return db.session.query(User.id, User.image_file)
+        return db.session.query(Post.user_id, Post.image_post).filter(Post.image_post.isnot(None))
+
+    def _committed(self, session):
+        if session.info.pop('image_uploads', None):
+            self._notify()
+
+    def _rolled_back(self, session):
+        # the jobs of these uploads were never saved
+        for path in session.info.pop('image_uploads', []):
+            remove_file(path)
+
+
+image_queue = ImageQueue()
@@ -0,0 +1,49 @@
+import click
+from sqlalchemy import func, select, update
+
+from blog import db
+
+
+class LikeCounts:
+    """Maintenance of the denormalized Post.like_count and Comment.like_count.
+
+    The like endpoints, the ORM events in blog.models and user deletion keep
+    the counters in step; `flask likes recount` rebuilds them from the like
+    tables after anything that went around them, such as a bulk delete.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['like_counts'] = self
+
+        @app.cli.group('likes')
+        def likes_cli():
+            """Like counters."""
+
+        @likes_cli.command('recount')
+        def recount_command():
+            """Recount the likes of every post and comment."""
+            click.echo(f'{self.recount()} like counters corrected.')
+
+    def recount(self):
+        from blog.fragments import fragment_cache
+        from blog.models import Post, Comment, PostLike, CommentLike
+
+        post_ids = []
+        for table, like_table, column, post_column in (
+                (Post.__table__, PostLike.__table__, 'post_id', 'id'),
+                (Comment.__table__, CommentLike.__table__, 'comment_id', 'post_id')):
+            likes = select(func.count()).where(like_table.c[column] == table.c.id).scalar_subquery()
+            post_ids += db.session.execute(update(table)
+                                           .where(table.c.like_count != likes)
+                                           .values(like_count=likes)
+                                           .returning(table.c[post_column])).scalars().all()
+        db.session.commit()
+        fragment_cache.bump(*{f'likes:{post_id}' for post_id in post_ids})
+        return len(post_ids)
+
+
+like_counts = LikeCounts()
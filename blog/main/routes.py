@@ -1,6 +1,10 @@
 from flask import Blueprint, render_template, request, flash, abort
 from flask_login import  current_user
-from blog.models import Post, User
+from blog.conditional import conditional
+from blog.models import Post
+from blog.main.utils import feed_query, author_post_counts, category_listing
+from blog.page_cache import page_cache
+from blog.pagination import paginate_posts
 
 
 
@@ -8,32 +12,31 @@ main = Blueprint('main', __name__, template_folder='templates')
 
 
 @main.route('/')
+@page_cache.cached()
 def home():
     return render_template("main/index.html", title="Main")
 
 
 @main.route('/blog', methods=['GET'])
 # @login_required
+@conditional('posts')
 def blog():
     if current_user.is_authenticated:
-        all_users = User.query.all()
-        posts = Post.query.order_by(Post.date_posted.desc())
-        if posts.count() > 0:
-            page = request.args.get('page', 1, type=int)
-            posts = posts.paginate(page=page, per_page=4)
-
-            return render_template('main/blog.html', title='Blog', posts=posts,
-                                   all_users=all_users)
+        posts = paginate_posts(feed_query(), per_page=4, scope=('all',))
+        author_counts = author_post_counts()
+        if posts.items:
+            return render_template('main/blog.html', title='Blog', posts=posts, author_counts=author_counts)
         else:
             flash('No articles yet', 'info')
-            return render_template('main/blog.html', title='Blog',  posts=posts, nothing=' ')
+            return render_template('main/blog.html', title='Blog', posts=posts, author_counts=author_counts,
+                                   nothing=' ')
     else:
         abort(500)
 
 @main.route('/category/<string:category_name>/')
 # @login_required
+@conditional('posts')
+@page_cache.cached(newest=lambda category_name: Post.category == category_name)
 def category_page(category_name):
-    posts_category = Post.query.filter_by(category=category_name).all()
-    return render_template('main/category_page.html', post_category=posts_category, category_name=category_name,
-                           title='Category ' + category_name)
+    return category_listing(category_name)
 
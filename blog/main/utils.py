@@ -0,0 +1,29 @@
+from flask import render_template
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from blog import db
+from blog.models import Post, User
+from blog.pagination import paginate_posts
+
+
+def feed_query():
+    # authors are joined into the page query, so the template does not lazy-load them post by post
+    return Post.query.options(joinedload(Post.author))
+
+
+def author_post_counts():
+    # one grouped aggregate instead of loading user.posts for every user of the sidebar
+    return db.session.query(User.username, func.count(Post.id)) \
+        .join(Post, Post.user_id == User.id) \
+        .group_by(User.id, User.username) \
+        .order_by(User.username) \
+        .all()
+
+
+def category_listing(category_name):
+    # shared by main.category_page and posts.category: one page of posts with their authors per request
+    posts = paginate_posts(feed_query().filter(Post.category == category_name), per_page=10,
+                           scope=('category', category_name))
+    return render_template('main/category_page.html', posts=posts, category_name=category_name,
+                           title='Category ' + category_name)
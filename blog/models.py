@@ -1,6 +1,7 @@
 from datetime import datetime, timezone, timedelta
 from flask import current_app
 import jwt
+from sqlalchemy import delete, event, select, update
 
 from blog import db, login_manager
 from flask_login import UserMixin
@@ -8,7 +9,9 @@ from flask_login import UserMixin
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    from blog.identity import user_cache
+
+    return user_cache.get(int(user_id))
 
 
 class User(db.Model, UserMixin):
@@ -18,7 +21,7 @@ class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    image_file = db.Column(db.String(20), nullable=False, default='default.jpg')
+    image_file = db.Column(db.String(80), nullable=False, default='default.jpg')
     password = db.Column(db.String(60), nullable=False)
     role = db.Column(db.String(20), index=True)
     last_seen = db.Column(db.DateTime)
@@ -90,20 +93,26 @@ class User(db.Model, UserMixin):
 
 class Post(db.Model):
     __tablename__ = "posts"
-    __searchable__ = ['title', 'content']
+    # newest-first listings: the feed, a category, an author
+    __table_args__ = (db.Index('ix_posts_date_posted_id', 'date_posted', 'id'),
+                      db.Index('ix_posts_category_date_posted_id', 'category', 'date_posted', 'id'),
+                      db.Index('ix_posts_user_id_date_posted_id', 'user_id', 'date_posted', 'id'))
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
 
     content = db.Column(db.Text(60), nullable=False)
     category = db.Column(db.String(100), nullable=False)
-    image_post = db.Column(db.String(30), nullable=True)
+    image_post = db.Column(db.String(80), nullable=True)
+    # an uploaded image is waiting in the image queue; templates show a placeholder meanwhile
+    image_processing = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
 
     views = db.Column(db.Integer, default=0)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     likes = db.relationship('PostLike', backref='post', lazy=True, passive_deletes=True)
 
     slug = db.Column(db.String(), unique=True, index=True)
-    tags = db.relationship('Tag', backref='tag_post', lazy=True, cascade="all, delete-orphan")
+    tags = db.relationship('Tag', secondary='post_tags', backref='posts', lazy=True)
     comments = db.relationship('Comment', backref='comment_post', lazy=True, cascade='all, delete-orphan')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -114,6 +123,8 @@ class Post(db.Model):
 
 class PostLike(db.Model):
     __tablename__ = "post_likes"
+    __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='uq_post_likes_user_post'),
+                      db.Index('ix_post_likes_post_id', 'post_id'))
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey(
         'users.id', ondelete="CASCADE"), nullable=False)
@@ -122,6 +133,8 @@ class PostLike(db.Model):
 
 class CommentLike(db.Model):
     __tablename__ = "comment_likes"
+    __table_args__ = (db.UniqueConstraint('user_id', 'comment_id', name='uq_comment_likes_user_comment'),
+                      db.Index('ix_comment_likes_comment_id', 'comment_id'))
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey(
         'users.id', ondelete="CASCADE"), nullable=False)
@@ -130,22 +143,129 @@ class CommentLike(db.Model):
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    __table_args__ = (db.Index('ix_comments_post_id_date_posted', 'post_id', 'date_posted'),)
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
     body = db.Column(db.Text(200), nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     # author = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
     likes = db.relationship('CommentLike', backref='comment', lazy=True, passive_deletes=True)
     def __repr__(self):
         return f'Comment({self.body}, {self.date_posted.strftime("%d.%m.%Y-%H.%M")}, {self.post_id})'
 
 
+post_tags = db.Table('post_tags',
+                     db.Column('post_id', db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True),
+                     db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+                     db.Index('ix_post_tags_tag_id_post_id', 'tag_id', 'post_id'))
+
+
 class Tag(db.Model):
     __tablename__ = 'tags'
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(20), unique=False, nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    name = db.Column(db.String(20), unique=True, nullable=False, index=True)
 
     def __repr__(self):
-        return f'Tag({self.id}, {self.name}, {self.post_id})'
\ No newline at end of file
+        return f'Tag({self.id}, {self.name})'
+
+
+class ImageJob(db.Model):
+    __tablename__ = 'image_jobs'
+    __table_args__ = (db.Index('ix_image_jobs_status_id', 'status', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    source = db.Column(db.String(100), nullable=False)
+    filename = db.Column(db.String(100))
+    size = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    run_after = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'ImageJob({self.id}, {self.kind}, {self.target_id}, {self.status})'
+
+
+class OutboxMessage(db.Model):
+    __tablename__ = 'mail_outbox'
+    __table_args__ = (db.Index('ix_mail_outbox_status_id', 'status', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    sender = db.Column(db.String(120), nullable=False)
+    recipients = db.Column(db.Text, nullable=False)
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    run_after = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'OutboxMessage({self.id}, {self.subject}, {self.status})'
+
+
+class Blob(db.Model):
+    __tablename__ = 'blobs'
+    hash = db.Column(db.String(64), primary_key=True)
+    extension = db.Column(db.String(10), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # set while nothing references the blob; garbage collected once it is old enough
+    released_at = db.Column(db.DateTime, index=True)
+
+    @property
+    def name(self):
+        return f'{self.hash}.{self.extension}'
+
+    def __repr__(self):
+        return f'Blob({self.hash}, {self.extension}, {self.refcount})'
+
+
+# likes added or removed through the ORM (admin views, fixtures) keep the counters in step;
+# the like endpoints write the like tables directly and adjust the counters themselves
+def _bump_like_count(table, column, delta):
+    def listener(mapper, connection, target):
+        connection.execute(update(table)
+                           .where(table.c.id == getattr(target, column))
+                           .values(like_count=table.c.like_count + delta))
+    return listener
+
+
+event.listen(PostLike, 'after_insert', _bump_like_count(Post.__table__, 'post_id', 1))
+event.listen(PostLike, 'after_delete', _bump_like_count(Post.__table__, 'post_id', -1))
+event.listen(CommentLike, 'after_insert', _bump_like_count(Comment.__table__, 'comment_id', 1))
+event.listen(CommentLike, 'after_delete', _bump_like_count(Comment.__table__, 'comment_id', -1))
+
+
+def _release_likes(mapper, connection, target):
+    # a deleted user's likes would only go with the database cascade (which SQLite leaves off),
+    # bypassing the events above: take them off the counters, one UPDATE per table since a user
+    # likes an item at most once, and delete them here
+    from sqlalchemy.orm import object_session
+
+    post_ids = set()
+    for table, like_table, column, post_column in (
+            (Post.__table__, PostLike.__table__, 'post_id', 'id'),
+            (Comment.__table__, CommentLike.__table__, 'comment_id', 'post_id')):
+        liked = select(like_table.c[column]).where(like_table.c.user_id == target.id)
+        post_ids.update(connection.execute(update(table)
+                                           .where(table.c.id.in_(liked))
+                                           .values(like_count=table.c.like_count - 1)
+                                           .returning(table.c[post_column])).scalars())
+        connection.execute(delete(like_table).where(like_table.c.user_id == target.id))
+    # the pages showing those counts are revalidated once this commits, see blog.fragments
+    object_session(target).info.setdefault('stale_fragments', set()).update(f'likes:{post_id}'
+                                                                           for post_id in post_ids)
+
+
+event.listen(User, 'before_delete', _release_likes)
@@ -0,0 +1,202 @@
+import json
+import smtplib
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from email.utils import formataddr
+
+import click
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import event, func
+
+from blog import db, mail
+from blog.queues import TableQueue
+
+
+class MailOutbox(TableQueue):
+    """Sends mail from a table instead of from the request.
+
+    enqueue() stores a flask_mail.Message as an OutboxMessage row in the
+    caller's transaction, so a mail goes out only if that transaction commits
+    and is not lost when the process dies. MAIL_OUTBOX_WORKERS background
+    threads, or `flask outbox send` in a separate process, claim up to
+    MAIL_OUTBOX_BATCH_SIZE due messages at a time and send them over one SMTP
+    connection that stays open until the outbox is empty. A failed message is
+    retried after MAIL_OUTBOX_RETRY_DELAY seconds, doubled on every attempt,
+    up to MAIL_OUTBOX_MAX_ATTEMPTS attempts.
+    """
+
+    claimed_status = 'sending'
+    config_prefix = 'MAIL_OUTBOX'
+    thread_name = 'mail-outbox-sender'
+
+    def __init__(self, app=None):
+        super().__init__()
+        # seconds per SMTP transaction and seconds from enqueue to sent, of the latest sends of this process
+        self._latencies = deque(maxlen=1000)
+        self._waits = deque(maxlen=1000)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_OUTBOX_WORKERS', 1)
+        app.config.setdefault('MAIL_OUTBOX_BATCH_SIZE', 50)
+        app.config.setdefault('MAIL_OUTBOX_POLL_INTERVAL', 30)
+        app.config.setdefault('MAIL_OUTBOX_MAX_ATTEMPTS', 5)
+        app.config.setdefault('MAIL_OUTBOX_RETRY_DELAY', 60)
+        app.config.setdefault('MAIL_OUTBOX_STALE_AFTER', 300)
+        app.extensions['mail_outbox'] = self
+        self._app = app
+
+        if not event.contains(db.session, 'after_commit', self._committed):
+            event.listen(db.session, 'after_commit', self._committed)
+            event.listen(db.session, 'after_rollback', self._rolled_back)
+
+        @app.cli.group('outbox')
+        def outbox_cli():
+            """Outgoing mail queue."""
+
+        @outbox_cli.command('send')
+        @click.option('--watch', is_flag=True, help='Keep waiting for new messages.')
+        def send_command(watch):
+            """Send the due messages."""
+            while True:
+                click.echo(f'{self.send_pending()} messages sent.')
+                if not watch:
+                    break
+                self._wait()
+
+        @outbox_cli.command('stats')
+        def stats_command():
+            """Show the queue depth and the send latency."""
+            for name, value in self.stats().items():
+                click.echo(f'{name}: {value}')
+
+    def enqueue(self, message):
+        from blog.models import OutboxMessage
+
+        sender = message.sender or current_app.extensions['mail'].default_sender
+        if isinstance(sender, tuple):
+            sender = formataddr(sender)
+        db.session.add(OutboxMessage(subject=message.subject, sender=sender,
+                                     recipients=json.dumps(list(message.recipients)),
+                                     body=message.body, html=message.html))
+        db.session.info['mail_outbox'] = True
+
+    def work(self):
+        return self.send_pending()
+
+    def send_pending(self):
+        self._requeue_stale()
+        sent = 0
+        connection = None
+        try:
+            while True:
+                batch = self._claim(self._due(current_app.config['MAIL_OUTBOX_BATCH_SIZE']))
+                if not batch:
+                    return sent
+                for message_id in batch:
+                    if connection is None:
+                        try:
+                            connection = self._connect()
+                        except OSError as error:
+                            current_app.logger.warning('Cannot connect to the mail server: %s', error)
+                            # the whole batch waits for the next attempt
+                            for unsent in batch[batch.index(message_id):]:
+                                self._failed(unsent, error)
+                            return sent
+                    try:
+                        self._send(connection, message_id)
+                        sent += 1
+                    except smtplib.SMTPServerDisconnected as error:
+                        self._failed(message_id, error)
+                        connection = None
+                    except smtplib.SMTPException as error:
+                        # refused by the server, the connection is still good
+                        self._failed(message_id, error)
+                    except OSError as error:
+                        self._failed(message_id, error)
+                        self._close(connection)
+                        connection = None
+        finally:
+            if connection is not None:
+                self._close(connection)
+
+    def stats(self):
+        from blog.models import OutboxMessage
+
+        counts = dict(db.session.query(OutboxMessage.status, func.count()).group_by(OutboxMessage.status).all())
+        oldest = db.session.query(func.min(OutboxMessage.created_at)) \
+            .filter(OutboxMessage.status == 'pending').scalar()
+        with self._lock:
+            latencies, waits = sorted(self._latencies), list(self._waits)
+        return {
+            'pending': counts.get('pending', 0),
+            'sending': counts.get('sending', 0),
+            'sent': counts.get('sent', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_pending_seconds': round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0,
+            'send_latency_avg': round(sum(latencies) / len(latencies), 4) if latencies else None,
+            'send_latency_p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4)
+            if latencies else None,
+            'queue_wait_avg': round(sum(waits) / len(waits), 4) if waits else None,
+        }
+
+    def _connect(self):
+        # flask_mail.Connection keeps one SMTP session open for every message sent through it
+        connection = mail.connect()
+        connection.__enter__()
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _send(self, connection, message_id):
+        from blog.models import OutboxMessage
+
+        row = db.session.get(OutboxMessage, message_id)
+        message = Message(subject=row.subject, sender=row.sender, recipients=json.loads(row.recipients),
+                          body=row.body, html=row.html)
+        started = time.perf_counter()
+        connection.send(message)
+        latency = time.perf_counter() - started
+
+        row.status, row.error, row.sent_at = 'sent', None, datetime.utcnow()
+        wait = (row.sent_at - row.created_at).total_seconds()
+        db.session.commit()
+        with self._lock:
+            self._latencies.append(latency)
+            self._waits.append(wait)
+
+    def _failed(self, message_id, error):
+        from blog.models import OutboxMessage
+
+        current_app.logger.warning('Mail %s was not sent: %s', message_id, error)
+        row = db.session.get(OutboxMessage, message_id)
+        row.error = str(error)
+        if row.attempts < current_app.config['MAIL_OUTBOX_MAX_ATTEMPTS']:
+            row.status = 'pending'
+            row.run_after = datetime.utcnow() + \
+                timedelta(seconds=current_app.config['MAIL_OUTBOX_RETRY_DELAY'] * 2 ** (row.attempts - 1))
+        else:
+            row.status = 'failed'
+        db.session.commit()
+
+    def _model(self):
+        from blog.models import OutboxMessage
+
+        return OutboxMessage
+
+    def _committed(self, session):
+        if session.info.pop('mail_outbox', None):
+            self._notify()
+
+    def _rolled_back(self, session):
+        session.info.pop('mail_outbox', None)
+
+
+mail_outbox = MailOutbox()
@@ -0,0 +1,210 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+from flask import current_app, request, session
+from flask_login import current_user
+from sqlalchemy import event, func, inspect
+from werkzeug.test import EnvironBuilder
+
+from blog import db
+
+
+Page = namedtuple('Page', 'body content_type etag last_modified stored_at')
+
+# the columns of a user that the public pages show
+USER_RENDERED = ('username', 'image_file')
+
+
+class PageCache:
+    """Whole responses of public pages for visitors without a session.
+
+    Pages are cached per path and query string. A request carrying the session
+    cookie or a logged-in user always goes to the view. An entry is served as
+    is for PAGE_CACHE_TTL seconds; for PAGE_CACHE_STALE_WHILE_REVALIDATE
+    seconds after that it is still served while one background thread
+    renders it again. Committed changes to posts, comments, tags or to the
+    names and pictures of users drop every entry of this process. Responses
+    carry an ETag of the body and a Last-Modified of the newest post they
+    depend on, so a revalidating client gets a 304 without the page being
+    rendered or sent.
+    """
+
+    def __init__(self, app=None):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = {}
+        self._generation = 0
+        # edits and deletions do not move date_posted, the last one seen bounds Last-Modified instead
+        self._changed_at = datetime.now(timezone.utc)
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PAGE_CACHE_ENABLED', True)
+        app.config.setdefault('PAGE_CACHE_TTL', 30)
+        app.config.setdefault('PAGE_CACHE_STALE_WHILE_REVALIDATE', 300)
+        app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 1000)
+        app.extensions['page_cache'] = self
+
+        if not event.contains(db.session, 'after_flush', self._collect):
+            event.listen(db.session, 'after_flush', self._collect)
+            event.listen(db.session, 'after_commit', self._apply)
+            event.listen(db.session, 'after_rollback', self._discard)
+            event.listen(db.metadata, 'after_drop', lambda *args, **kwargs: self.clear())
+
+    def cached(self, newest=None):
+        """Cache a view for anonymous visitors.
+
+        `newest` takes the view arguments and returns a filter on Post; the
+        newest date_posted it matches is the page's Last-Modified.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                if not self._cacheable():
+                    return view(**kwargs)
+                return self._serve(view, kwargs, newest)
+            return wrapper
+        return decorator
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._changed_at = datetime.now(timezone.utc)
+
+    def wait(self):
+        """Wait for the background refreshes in flight."""
+        while True:
+            with self._lock:
+                threads = list(self._refreshing.values())
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'refreshing': len(self._refreshing),
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _cacheable(self):
+        return current_app.config['PAGE_CACHE_ENABLED'] and request.method in ('GET', 'HEAD') \
+            and current_app.config['SESSION_COOKIE_NAME'] not in request.cookies \
+            and not current_user.is_authenticated
+
+    def _serve(self, view, kwargs, newest):
+        key = request.full_path
+        ttl = current_app.config['PAGE_CACHE_TTL']
+        with self._lock:
+            page = self._entries.get(key)
+            if page is not None:
+                self._entries.move_to_end(key)
+        age = time.monotonic() - page.stored_at if page is not None else None
+
+        if page is None or age > ttl + current_app.config['PAGE_CACHE_STALE_WHILE_REVALIDATE']:
+            self.misses += 1
+            page, response = self._render(key, view, kwargs, newest)
+            if page is None:
+                return response
+            state = 'MISS'
+        elif age > ttl:
+            self.hits += 1
+            self._refresh(key, view, kwargs, newest)
+            state = 'STALE'
+        else:
+            self.hits += 1
+            state = 'HIT'
+
+        response = current_app.response_class(page.body, content_type=page.content_type)
+        response.set_etag(page.etag)
+        response.last_modified = page.last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = ttl
+        response.vary.add('Cookie')
+        response.headers['X-Page-Cache'] = state
+        return response.make_conditional(request)
+
+    def _render(self, key, view, kwargs, newest):
+        with self._lock:
+            generation = self._generation
+        response = current_app.make_response(view(**kwargs))
+        # a flash or a form token gave this visitor a session: the page is theirs only
+        if response.status_code != 200 or session.modified or 'Set-Cookie' in response.headers:
+            return None, response
+
+        body = response.get_data()
+        last_modified = self._changed_at
+        if newest is not None:
+            from blog.models import Post
+
+            posted = db.session.query(func.max(Post.date_posted)).filter(newest(**kwargs)).scalar()
+            if posted is not None:
+                last_modified = max(last_modified, posted.replace(tzinfo=timezone.utc))
+        page = Page(body, response.content_type, hashlib.sha1(body).hexdigest(), last_modified, time.monotonic())
+
+        with self._lock:
+            # a commit during the render may have made it stale already
+            if generation == self._generation:
+                self._entries[key] = page
+                self._entries.move_to_end(key)
+                while len(self._entries) > current_app.config['PAGE_CACHE_MAX_ENTRIES']:
+                    self._entries.popitem(last=False)
+        return page, response
+
+    def _refresh(self, key, view, kwargs, newest):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            app = current_app._get_current_object()
+            thread = threading.Thread(target=self._rerender, args=(app, request.url_root, key, view, kwargs, newest),
+                                      daemon=True)
+            self._refreshing[key] = thread
+        thread.start()
+
+    def _rerender(self, app, base_url, key, view, kwargs, newest):
+        path, _, query_string = key.partition('?')
+        try:
+            # an anonymous request of its own, its session is removed when the context is popped
+            environ = EnvironBuilder(path, query_string=query_string, base_url=base_url).get_environ()
+            with app.request_context(environ):
+                self._render(key, view, kwargs, newest)
+        except Exception:
+            app.logger.exception('Could not refresh the cached page %s', key)
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+    def _collect(self, session, flush_context):
+        from blog.models import Post, Comment, Tag, User
+
+        if any(isinstance(obj, (Post, Comment, Tag, User)) for obj in (*session.new, *session.deleted)) \
+                or any(self._rendered_change(obj) for obj in session.dirty):
+            session.info['page_cache_stale'] = True
+
+    def _rendered_change(self, obj):
+        from blog.models import Post, Comment, Tag, User
+
+        if isinstance(obj, (Post, Comment, Tag)):
+            return True
+        if isinstance(obj, User):
+            # a login rehashing the password or a logout stamping last_seen shows on no page
+            state = inspect(obj)
+            return any(state.attrs[name].history.has_changes() for name in USER_RENDERED)
+        return False
+
+    def _apply(self, session):
+        if session.info.pop('page_cache_stale', False):
+            self.clear()
+
+    def _discard(self, session):
+        session.info.pop('page_cache_stale', None)
+
+
+page_cache = PageCache()
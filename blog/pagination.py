@@ -0,0 +1,84 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import and_, or_
+
+from blog.counts import post_counts
+from blog.models import Post
+
+
+def encode_cursor(post, direction):
+    payload = json.dumps({'d': post.date_posted.isoformat(), 'i': post.id, 'r': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        direction = payload['r']
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return datetime.fromisoformat(payload['d']), int(payload['i']), direction
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        abort(404)
+
+
+def keyset_query(query, cursor=None):
+    """The query narrowed to the posts after `cursor` and ordered from it, and the cursor's direction."""
+    if not cursor:
+        return query.order_by(Post.date_posted.desc(), Post.id.desc()), None
+    date_posted, post_id, direction = decode_cursor(cursor)
+    # the plain bound on date_posted lets the index seek to the cursor instead of walking up to it
+    if direction == 'prev':
+        query = query.filter(Post.date_posted >= date_posted,
+                             or_(Post.date_posted > date_posted,
+                                 and_(Post.date_posted == date_posted, Post.id > post_id))) \
+            .order_by(Post.date_posted.asc(), Post.id.asc())
+    else:
+        query = query.filter(Post.date_posted <= date_posted,
+                             or_(Post.date_posted < date_posted,
+                                 and_(Post.date_posted == date_posted, Post.id < post_id))) \
+            .order_by(Post.date_posted.desc(), Post.id.desc())
+    return query, direction
+
+
+class KeysetPagination:
+    """A page of posts keyed on (date_posted, id) - no COUNT(*) and no OFFSET scan."""
+
+    is_keyset = True
+    total = None
+
+    def __init__(self, query, cursor=None, per_page=20):
+        self.per_page = per_page
+        query, direction = keyset_query(query, cursor)
+
+        # one extra row tells whether there is anything beyond this page
+        items = query.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if direction == 'prev':
+            items.reverse()
+            self.has_prev, self.has_next = has_more, True
+        else:
+            self.has_prev, self.has_next = direction == 'next', has_more
+
+        self.items = items
+        self.next_cursor = encode_cursor(items[-1], 'next') if self.has_next and items else None
+        self.prev_cursor = encode_cursor(items[0], 'prev') if self.has_prev and items else None
+        self.has_next = self.next_cursor is not None
+        self.has_prev = self.prev_cursor is not None
+
+
+def paginate_posts(query, per_page, scope):
+    if current_app.config['PAGINATION_MODE'] == 'keyset':
+        return KeysetPagination(query, cursor=request.args.get('cursor'), per_page=per_page)
+    page = request.args.get('page', 1, type=int)
+    # the total comes from the count cache rather than a COUNT(*) per request
+    posts = query.order_by(Post.date_posted.desc(), Post.id.desc()).paginate(page=page, per_page=per_page,
+                                                                          count=False)
+    posts.total = post_counts.get(scope)
+    return posts
@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+import click
+from flask import current_app
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # not a bcrypt hash
+        return False
+
+
+def hash_rounds(hashed):
+    # $2b$<cost>$<salt and digest>
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """bcrypt password hashes at a configurable cost.
+
+    PASSWORD_HASH_ROUNDS is the bcrypt cost factor; every step doubles the
+    time of a hash and of a check. verify() rehashes a password whose stored
+    hash has another cost once its owner logs in, so raising or lowering the
+    cost takes effect without a reset. With PASSWORD_HASH_PROCESSES above 0,
+    hashes are computed in a pool of that many processes: a login burst then
+    uses at most that many cores and queues instead of taking the CPU away
+    from every request thread of the server.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_PROCESSES', 0)
+        app.extensions['password_hasher'] = self
+
+        @app.cli.group('passwords')
+        def passwords_cli():
+            """Password hashing."""
+
+        @passwords_cli.command('benchmark')
+        @click.option('--seconds', type=float, default=5, help='How long to keep checking passwords.')
+        @click.option('--rounds', type=int, default=None, help='Cost factor, PASSWORD_HASH_ROUNDS by default.')
+        def benchmark_command(seconds, rounds):
+            """Measure how many logins per second a core can check."""
+            result = self.benchmark(seconds, rounds)
+            click.echo(f"cost {result['rounds']}: {result['checks']} checks in {result['seconds']:.1f}s "
+                       f"on {result['cores']} cores, {result['per_core']:.1f} logins/s per core, "
+                       f"{result['milliseconds']:.0f} ms per check")
+
+    def hash(self, password, rounds=None):
+        return self._run(_hash, password, rounds or current_app.config['PASSWORD_HASH_ROUNDS'])
+
+    def check(self, hashed, password):
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != current_app.config['PASSWORD_HASH_ROUNDS']
+
+    def verify(self, user, password):
+        """Check a user's password, rehashing it at the configured cost if needed; the caller commits."""
+        if not self.check(user.password, password):
+            return False
+        if self.needs_rehash(user.password):
+            user.password = self.hash(password)
+        return True
+
+    def benchmark(self, seconds=5, rounds=None):
+        rounds = rounds or current_app.config['PASSWORD_HASH_ROUNDS']
+        hashed = _hash('benchmark password', rounds)
+        cores = current_app.config['PASSWORD_HASH_PROCESSES'] or 1
+        checks = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            # a batch per core, so a pool has every process busy
+            if self._pool_size():
+                futures = [self._executor().submit(_check, hashed, 'benchmark password') for _ in range(cores)]
+                checks += sum(future.result() for future in futures)
+            else:
+                checks += _check(hashed, 'benchmark password')
+        elapsed = time.perf_counter() - started
+        return {'rounds': rounds, 'checks': checks, 'seconds': elapsed, 'cores': cores,
+                'per_core': checks / elapsed / cores, 'milliseconds': elapsed * 1000 * cores / checks}
+
+    def _run(self, function, *args):
+        if not self._pool_size():
+            return function(*args)
+        return self._executor().submit(function, *args).result()
+
+    def _pool_size(self):
+        return current_app.config['PASSWORD_HASH_PROCESSES']
+
+    def _executor(self):
+        with self._lock:
+            # a pool does not survive a fork, a forked server worker starts its own
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(self._pool_size(), mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+
+password_hasher = PasswordHasher()
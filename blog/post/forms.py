@@ -5,6 +5,8 @@ from flask_wtf.file import FileAllowed
 from wtforms import StringField, TextAreaField, SubmitField, FileField, SelectField
 from wtforms.validators import InputRequired
 from flask import flash
+
+from blog.uploads import PictureUpload
 # from flask_ckeditor import CKEditorField
 
 
@@ -17,7 +19,7 @@ class PostForm(FlaskForm):
                                                  ('Dangerous ingredients', 'Dangerous ingredients'), ('Cosmetics procedures', 'Cosmetics procedures'),
                                                 ('Recipes for youth', 'Recipes for youth')])
     tag_form = StringField('Tag')
-    picture = FileField('Image (png, jpg)', validators=[FileAllowed(['jpg', 'png'])])
+    picture = FileField('Image (png, jpg)', validators=[FileAllowed(['jpg', 'png']), PictureUpload()])
 
     submit = SubmitField('Submit')
 
@@ -38,7 +40,7 @@ class PostUpdateForm(FlaskForm):
                                                 ( 'Hand-made', 'Hand-made'),
                                                  ('Dangerous ingredients', 'Dangerous ingredients'), ('Cosmetics procedures', 'Cosmetics procedures'),
                                                 ('Recipes for youth', 'Recipes for youth')])
-    picture = FileField('Image (png, jpg)', validators=[FileAllowed(['jpg', 'png'])])
+    picture = FileField('Image (png, jpg)', validators=[FileAllowed(['jpg', 'png']), PictureUpload()])
     submit = SubmitField('Submit')
 
 
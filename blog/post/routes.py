@@ -4,11 +4,20 @@ import sqlalchemy
 from flask import Blueprint, render_template, redirect, url_for, flash, abort, request, current_app, jsonify
 from flask_login import current_user, login_required
 from slugify import slugify
+from sqlalchemy.orm import defer, load_only
 
 from blog import db
-from blog.models import Post, Comment, Tag, PostLike, CommentLike
+from blog.conditional import conditional, page_etag, not_modified, tagged
+from blog.images import discard_picture, media_url
+from blog.main.utils import feed_query, category_listing
+from blog.models import Post, Comment, Tag, PostLike, CommentLike, post_tags
+from blog.page_cache import page_cache
+from blog.pagination import paginate_posts
 from blog.post.forms import PostForm, PostUpdateForm, CommentUpdateForm, AddCommentForm
-from blog.post.utils import save_picture_post_author
+from blog.post.utils import save_picture_post_author, toggle_like, page_likes, add_tags, delete_orphan_tags, \
+    post_fragments, comment_fragments
+from blog.search import post_search
+from blog.view_counter import view_counter
 
 
 posts = Blueprint('posts', __name__, template_folder='templates')
@@ -21,25 +30,16 @@ def new_post():
     try:
         if form.validate_on_submit():
             post = Post(title=form.title.data, content=form.content.data, category=form.category.data,
-                        image_post=form.picture.data, author=current_user)
-            if form.picture.data:
-                picture_file = save_picture_post_author(form.picture.data, post)
-                post.image_post = picture_file
-            else:
-                post.image_post = None
-            # post.image_post = save_picture_post_author(form.picture.data, post)
-
+                        image_post=None, user_id=current_user.id)
             db.session.add(post)
             post.slug = slugify(post.title)
             db.session.flush()
 
-            name = form.tag_form.data
-            if name:
-                name = name.split('/')
-                for i in name:
-                    tag_post = Tag(name=i)  # creating a tag
-                    tag_post.post_id = post.id
-                    db.session.add(tag_post)
+            if form.picture.data:
+                save_picture_post_author(form.picture.data, post)
+
+            if form.tag_form.data:
+                add_tags(post, form.tag_form.data)
             db.session.commit()
             flash('The article was published!', 'success')
             return redirect(url_for('main.blog'))
@@ -58,9 +58,7 @@ def new_post():
         db.session.rollback()
 
     if form.picture.data:
-        image_file = url_for('static',
-                             filename=f'profile_pics/' + 'users/' + current_user.username + '/post_images/'
-                                      + current_user.image_file)
+        image_file = media_url(current_user.id, 'profile_img', current_user.image_file)
         return render_template('post/create_post.html', title='New article',
                         form_new_post=form, legend='New article', image_file=image_file)
 
@@ -72,21 +70,18 @@ def new_post():
 @posts.route('/post/<string:slug>', methods=['GET', 'POST'])
 @login_required
 def post(slug):
-    post = Post.query.filter_by(slug=slug).first()
-    comment = Comment.query.filter_by(post_id=post.id).order_by(db.desc(Comment.date_posted)).all()
+    # the content is only read when the article fragment is rendered
+    post = Post.query.options(defer(Post.content)).filter_by(slug=slug).first()
+    is_author = current_user.is_authenticated and post.user_id == current_user.id
 
     form_post = PostForm()
     form_comment = AddCommentForm()
 
-    if request.method == 'POST' and post.author == current_user:
+    if request.method == 'POST' and is_author:
         # def add_tag():
         name = form_post.tag_form.data
         if name:
-            name = name.split('/')
-            for i in name:
-                tag_post = Tag(name=i)  # создаю тег
-                tag_post.post_id = post.id
-                db.session.add(tag_post)
+            add_tags(post, name)
             db.session.commit()
             flash('The tag has been added to the post.', "success")
             return redirect(url_for('posts.post', slug=post.slug))
@@ -102,26 +97,51 @@ def post(slug):
         flash("The comment to the article was added", "success")
         return redirect(url_for('posts.post', slug=post.slug))
 
-    post.views += 1
-    db.session.commit()
+    view_counter.record(post.id)
+    # a revalidated page is still a view, but its view count may lag behind
+    etag = page_etag(post.image_post, post.image_processing,
+                     versions=(f'post:{post.id}', f'tags:{post.id}', f'comments:{post.id}', f'user:{post.user_id}',
+                               f'likes:{post.id}'))
+    response = not_modified(etag)
+    if response is not None:
+        return response
 
-    if post.image_post:
-        image_file = url_for('static',
-                         filename=f'profile_pics/'+'users/' + post.author.username + '/post_images/' + post.image_post)
-        return render_template('post/post.html', title=post.title, post=post, image_file=image_file,
-                               form_add_comment=form_comment, comment=comment, form_add_tag=form_post)
+    views = (post.views or 0) + view_counter.pending(post.id)
+    fragments = post_fragments(post)
+    likes = page_likes([post.id], [i['id'] for i in fragments.comments['comments']])
 
-    else:
-        return render_template('post/post.html', title=post.title, post=post,  form_add_comment=form_comment, comment=comment, form_add_tag=form_post)
+    return tagged(render_template('post/post.html', title=post.title, post=post, fragments=fragments,
+                                  comments=fragments.comments, is_author=is_author, form_add_comment=form_comment,
+                                  form_add_tag=form_post, views=views, likes=likes), etag)
+
+
+@posts.route('/post/<string:slug>/comments')
+@login_required
+def comments(slug):
+    # the chunks of comments after the one inlined in the post page, fetched by index.js
+    post = Post.query.options(load_only(Post.id, Post.slug, Post.user_id)).filter_by(slug=slug).first_or_404()
+    is_author = current_user.is_authenticated and post.user_id == current_user.id
+    etag = page_etag(versions=(f'comments:{post.id}', f'likes:{post.id}'))
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    chunk = comment_fragments(post.id, request.args.get('cursor'))
+    likes = page_likes([], [i['id'] for i in chunk['comments']])
+    return tagged(render_template('post/_comments.html', post=post, comments=chunk, is_author=is_author,
+                                  likes=likes), etag)
 
 
 @posts.route('/post/search')
 # @login_required
 def search():
     # try:
-    keyword = request.args.get('q')
-    search_posts = Post.query.msearch(keyword, fields=['title', 'content'], limit=20)
-    return render_template('post/search.html', search_posts=search_posts, title='Search')
+    keyword = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(404)
+    results = post_search.search(keyword, page=page, per_page=10)
+    return render_template('post/search.html', results=results, keyword=keyword, title='Search')
     # except AttributeError:
     #     return redirect(url_for('users.account'))
 
@@ -152,7 +172,7 @@ def update_post(slug):
         db.session.commit()
 
         if form.picture.data:
-            post.image_post = save_picture_post_author(form.picture.data, post)
+            save_picture_post_author(form.picture.data, post)
         db.session.commit()
         flash('The article was updated', 'success')
 
@@ -163,8 +183,7 @@ def update_post(slug):
                 for error in errors:
                     flash(f'Error: {error}')
             # flash('The image format must be "jpg", "png"', 'success')
-    image_file = url_for('static',
-                         filename=f'profile_pics/user/{current_user.username}/post_images/{post.image_post}')
+    image_file = media_url(current_user.id, 'post_images', post.image_post)
 
     return render_template('post/update_post.html', title='Update the article',
                            form_post_update=form, legend='Update the article', image_file=image_file, post=post)
@@ -194,19 +213,21 @@ def update_comment(comment_id):
 
 @posts.route('/posts/<string:category_str>/', methods=['GET'])
 # @login_required
+@conditional('posts')
+@page_cache.cached(newest=lambda category_str: Post.category == category_str)
 def category(category_str):
-    current_category = Post.query.filter_by(category=category_str).first()
-    posts_category = Post.query.filter_by(category=category_str).all()
-    return render_template('post/all_posts_category.html', post_category=posts_category,
-                           current_category=current_category, title='Category ' + category_str)
+    return category_listing(category_str)
 
 
 @posts.route('/tags/<string:tag_str>', methods=['GET'])
 # @login_required
+@conditional('posts')
+@page_cache.cached(newest=lambda tag_str: Post.tags.any(Tag.name == tag_str))
 def tag(tag_str):
     current_tag = Tag.query.filter_by(name=tag_str).first_or_404()
-    name_tags = Tag.query.filter(Tag.name == current_tag.name).all()
-    return render_template('post/all_post_tag.html', name_tags=name_tags,
+    query = feed_query().join(post_tags, post_tags.c.post_id == Post.id).filter(post_tags.c.tag_id == current_tag.id)
+    posts = paginate_posts(query, per_page=10, scope=('tag', current_tag.name))
+    return render_template('post/all_post_tag.html', posts=posts,
                            current_tag=current_tag, title='Tag articles ' + current_tag.name)
 
 
@@ -216,12 +237,12 @@ def delete_post(slug):
     post = Post.query.filter_by(slug=slug).first_or_404()
     if post.author != current_user:
         abort(403)
-    if post.image_post:
-        os.unlink(
-            os.path.join(current_app.root_path,
-                         f'static/profile_pics/users/{current_user.username}/post_images/{post.image_post}'))
+    discard_picture(post.user_id, 'post_images', post.image_post)
 
+    tags = list(post.tags)
     db.session.delete(post)
+    db.session.flush()
+    delete_orphan_tags(tags)
     db.session.commit()
     flash('The post has been deleted', 'success')
     return redirect(url_for('users.profile'))
@@ -243,47 +264,30 @@ def delete_comment(comment_id):
     return redirect(url_for('posts.post', slug=return_to_post))
 
 
-@posts.route('/post/tag/<int:tag_id>/delete')
+@posts.route('/post/<string:slug>/tag/<int:tag_id>/delete')
 @login_required
-def delete_tag(tag_id):
+def delete_tag(slug, tag_id):
+    post = Post.query.filter_by(slug=slug).first_or_404()
     tag = Tag.query.filter_by(id=tag_id).first_or_404()
-    if tag.tag_post.author != current_user:
+    if tag not in post.tags:
+        abort(404)
+    if post.author != current_user:
         abort(403)
-    db.session.delete(tag)
+    post.tags.remove(tag)
+    db.session.flush()
+    delete_orphan_tags([tag])
     db.session.commit()
     flash('The tag has been deleted', 'success')
-    return redirect(url_for('posts.post', slug=tag.tag_post.slug))
+    return redirect(url_for('posts.post', slug=post.slug))
 
 
 @posts.route("/like-post/<int:post_id>", methods=['POST', 'GET'])
 @login_required
 def like(post_id):
-    post = Post.query.filter_by(id=post_id).first_or_404()
-    like = PostLike.query.filter_by(user_id=current_user.id, post_id=post_id).first()
-
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-    else:
-        like = PostLike(user_id=current_user.id, post_id=post_id)
-        db.session.add(like)
-        db.session.commit()
-
-    return jsonify({"likes": len(post.likes), "liked": current_user.id in map(lambda x: x.user_id, post.likes)})
+    return jsonify(toggle_like(PostLike.__table__, Post.__table__, 'post_id', post_id))
 
 
 @posts.route("/like-comment/<int:comment_id>", methods=['POST'])
 @login_required
 def comment_like(comment_id):
-    comment = Comment.query.filter_by(id=comment_id).first_or_404()
-    like = CommentLike.query.filter_by(user_id=current_user.id, comment_id=comment_id).first()
-
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-    else:
-        like = CommentLike(user_id=current_user.id, comment_id=comment_id)
-        db.session.add(like)
-        db.session.commit()
-
-    return jsonify({"likes": len(comment.likes), "liked": current_user.id in map(lambda x: x.user_id, comment.likes)})
\ No newline at end of file
+    return jsonify(toggle_like(CommentLike.__table__, Comment.__table__, 'comment_id', comment_id, 'post_id'))
@@ -1,31 +1,128 @@
-import os
-import secrets
+from collections import namedtuple
 
-from PIL import Image
-from flask import current_app
+from flask import abort, current_app, get_template_attribute
 from flask_login import current_user
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from blog import db
+from blog.fragments import fragment_cache
+from blog.images import image_queue
+from blog.models import Post, Comment, PostLike, CommentLike, Tag, post_tags
+from blog.pagination import decode_cursor, encode_cursor
 
 
 def save_picture_post_author(form_picture, post):
-    random_hex = secrets.token_hex(16)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    full_path = os.path.join(current_app.root_path, 'static', 'profile_pics/', 'users/', current_user.username,
-                             'post_images')
+    # resized off the request; post.image_post changes once the picture is ready
+    image_queue.enqueue(post, 'post', form_picture, 500)
+
+
+def toggle_like(like_table, target_table, target_column, target_id, post_column='id'):
+    # delete the like if there is one, otherwise insert it, and move the denormalized counter
+    # by one - no like rows are loaded and the new total comes back with the counter update,
+    # along with the post whose page shows it
+    unliked = db.session.execute(delete(like_table).where(like_table.c.user_id == current_user.id,
+                                                          like_table.c[target_column] == target_id)).rowcount
+    row = db.session.execute(update(target_table)
+                             .where(target_table.c.id == target_id)
+                             .values(like_count=target_table.c.like_count + (-1 if unliked else 1))
+                             .returning(target_table.c.like_count, target_table.c[post_column])).first()
+    if row is None:
+        db.session.rollback()
+        abort(404)
+    likes, post_id = row
+    if not unliked:
+        db.session.execute(insert(like_table).values({'user_id': current_user.id, target_column: target_id}))
     try:
-        os.remove(
-            os.path.join(current_app.root_path,
-                         f'static/profile_pics/users/{current_user.username}/post_images/{post.image_post}'))
-    except:
-        print('The image was not found, it may have been deleted!')
-    if not os.path.exists(full_path):
-        os.mkdir(full_path)
-    picture_path = os.path.join(full_path, picture_fn)
-    output_size = (500, 500)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-    return picture_fn
+        db.session.commit()
+        fragment_cache.bump(f'likes:{post_id}')
+    except IntegrityError:
+        # a concurrent request from the same user liked it first
+        db.session.rollback()
+        likes = db.session.execute(select(target_table.c.like_count)
+                                   .where(target_table.c.id == target_id)).scalar_one()
+    return {"likes": likes, "liked": not unliked}
+
+
+PageLikes = namedtuple('PageLikes', 'liked_posts liked_comments post_counts comment_counts')
+PostFragments = namedtuple('PostFragments', 'author article tags comments')
+
+
+def post_fragments(post):
+    # the parts of a post page that look the same to every visitor; likes, views and the
+    # author's buttons are added around them by post.html
+    def macro(name):
+        return get_template_attribute('post/_fragments.html', name)
+
+    author = fragment_cache.fragment(f'author:{post.user_id}', [f'user:{post.user_id}'],
+                                     lambda: str(macro('author')(post)))
+    # the picture is part of the name, the image queue sets it with a bulk update
+    article = fragment_cache.fragment(f'article:{post.id}:{post.image_post}:{int(bool(post.image_processing))}',
+                                      [f'post:{post.id}'], lambda: str(macro('article')(post)))
+    tags = fragment_cache.fragment(f'tags:{post.id}', [f'tags:{post.id}'],
+                                   lambda: [{'id': tag.id, 'html': str(macro('tag')(tag))} for tag in post.tags])
+    return PostFragments(author, article, tags, comment_fragments(post.id))
+
+
+def comment_chunk(post_id, cursor=None):
+    # one chunk of a post's comments, newest first, and the cursor of the next one
+    per_page = current_app.config['POST_COMMENTS_PER_PAGE']
+    query = Comment.query.filter_by(post_id=post_id)
+    if cursor:
+        date_posted, comment_id, direction = decode_cursor(cursor)
+        if direction != 'next':
+            abort(404)
+        query = query.filter(or_(Comment.date_posted < date_posted,
+                                 and_(Comment.date_posted == date_posted, Comment.id < comment_id)))
+    comments = query.order_by(Comment.date_posted.desc(), Comment.id.desc()).limit(per_page + 1).all()
+    next_cursor = encode_cursor(comments[per_page - 1], 'next') if len(comments) > per_page else None
+    return comments[:per_page], next_cursor
+
+
+def comment_fragments(post_id, cursor=None):
+    # a rendered chunk of comments; every chunk of the post is dropped when one of its comments changes
+    def render():
+        macro = get_template_attribute('post/_fragments.html', 'comment')
+        comments, next_cursor = comment_chunk(post_id, cursor)
+        return {'comments': [{'id': comment.id, 'username': comment.username, 'html': str(macro(comment))}
+                             for comment in comments],
+                'next_cursor': next_cursor}
+
+    per_page = current_app.config['POST_COMMENTS_PER_PAGE']
+    return fragment_cache.fragment(f'comments:{post_id}:{per_page}:{cursor or ""}', [f'comments:{post_id}'], render)
+
+
+def page_likes(post_ids, comment_ids):
+    # one query per table: each item's like count plus whether the current user liked it
+    user_id = current_user.id if current_user.is_authenticated else None
+
+    def lookup(target, like, like_column, ids):
+        if not ids:
+            return set(), {}
+        rows = db.session.execute(select(target.id, target.like_count, like.id.isnot(None))
+                                  .outerjoin(like, and_(like_column == target.id, like.user_id == user_id))
+                                  .where(target.id.in_(ids))).all()
+        return {row[0] for row in rows if row[2]}, {row[0]: row[1] for row in rows}
+
+    liked_posts, post_counts = lookup(Post, PostLike, PostLike.post_id, post_ids)
+    liked_comments, comment_counts = lookup(Comment, CommentLike, CommentLike.comment_id, comment_ids)
+    return PageLikes(liked_posts, liked_comments, post_counts, comment_counts)
+
 
+def add_tags(post, tag_str):
+    # tags are shared between posts: reuse the existing rows and only create the missing names
+    names = list(dict.fromkeys(name.strip() for name in tag_str.split('/') if name.strip()))
+    if not names:
+        return
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
+    for name in names:
+        tag = tags.get(name) or Tag(name=name)
+        if tag not in post.tags:
+            post.tags.append(tag)
 
 
+def delete_orphan_tags(tags):
+    # a tag no post uses any more has no page to show; call after the post_tags rows are flushed
+    for tag in tags:
+        if db.session.query(post_tags.c.post_id).filter(post_tags.c.tag_id == tag.id).first() is None:
+            db.session.delete(tag)
@@ -0,0 +1,96 @@
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import or_, select, update
+
+from blog import db
+
+
+class TableQueue:
+    """Rows of a table worked off by background threads or by a CLI command.
+
+    The rows have status, attempts, run_after and started_at columns. A worker
+    claims due 'pending' rows by moving them to `claimed_status`, and work()
+    handles them. <config_prefix>_WORKERS threads start on the first commit
+    that calls _notify() and then look for due rows every
+    <config_prefix>_POLL_INTERVAL seconds or as soon as they are woken up.
+    Subclasses set the class attributes and implement _model() and work().
+    """
+
+    claimed_status = 'running'
+    config_prefix = None
+    thread_name = None
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._app = None
+
+    def work(self):
+        """Handle the due rows, return how many were handled."""
+        raise NotImplementedError
+
+    def _model(self):
+        raise NotImplementedError
+
+    def _setting(self, name, app=None):
+        return (app or current_app).config[f'{self.config_prefix}_{name}']
+
+    def _due(self, limit):
+        model = self._model()
+        return db.session.execute(select(model.id)
+                                  .where(model.status == 'pending',
+                                         or_(model.run_after.is_(None), model.run_after <= datetime.utcnow()))
+                                  .order_by(model.id)
+                                  .limit(limit)).scalars().all()
+
+    def _claim(self, row_ids):
+        model = self._model()
+        claimed = []
+        now = datetime.utcnow()
+        for row_id in row_ids:
+            # only one worker, thread or process, gets to move a row out of 'pending'
+            if db.session.execute(update(model)
+                                  .where(model.id == row_id, model.status == 'pending')
+                                  .values(status=self.claimed_status, attempts=model.attempts + 1,
+                                          started_at=now)).rowcount:
+                claimed.append(row_id)
+        db.session.commit()
+        return claimed
+
+    def _requeue_stale(self):
+        model = self._model()
+        # rows of a worker that died half way; one may be handled twice, none is lost
+        stale = datetime.utcnow() - timedelta(seconds=self._setting('STALE_AFTER'))
+        db.session.execute(update(model)
+                           .where(model.status == self.claimed_status, model.started_at < stale)
+                           .values(status='pending'))
+        db.session.commit()
+
+    def _wait(self):
+        self._wake.wait(self._setting('POLL_INTERVAL'))
+
+    def _notify(self):
+        self._start_workers()
+        self._wake.set()
+
+    def _start_workers(self):
+        workers = self._setting('WORKERS')
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for number in range(len(self._threads), workers):
+                thread = threading.Thread(target=self._run_worker, name=f'{self.thread_name}-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run_worker(self):
+        while True:
+            with self._app.app_context():
+                try:
+                    self.work()
+                except Exception:
+                    current_app.logger.exception('%s failed', threading.current_thread().name)
+            self._wake.wait(self._setting('POLL_INTERVAL', self._app))
+            self._wake.clear()
@@ -0,0 +1,393 @@
+import functools
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict, namedtuple
+from contextlib import closing
+
+import click
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.orm import joinedload
+
+from blog import db
+
+
+# matched words are wrapped in these by every backend and turned into <mark> after escaping
+MARK_START, MARK_END = '\x02', '\x03'
+ELLIPSIS = '…'
+
+SearchHit = namedtuple('SearchHit', 'post snippet comments')
+
+
+def tokenize(value):
+    return re.findall(r'\w+', value.lower())
+
+
+def render_snippet(snippet):
+    return Markup(str(escape(snippet)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+@functools.lru_cache(maxsize=None)
+def fts5_available():
+    # the SQLite library does not change while the process runs, so it is asked once
+    try:
+        with closing(sqlite3.connect(':memory:')) as connection:
+            connection.execute('CREATE VIRTUAL TABLE probe USING fts5(body)')
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+class SearchResults:
+    """One page of ranked search hits."""
+
+    def __init__(self, items, total, page, per_page):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+        self.pages = math.ceil(total / per_page) if total else 0
+        self.has_prev = page > 1
+        self.has_next = page < self.pages
+        self.prev_num = page - 1 if self.has_prev else None
+        self.next_num = page + 1 if self.has_next else None
+
+
+class SqliteBackend:
+    """FTS5 table keyed on the post id, ranked with bm25()."""
+
+    transactional = True
+
+    def create(self, connection):
+        if connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'post_search'").first():
+            return
+        connection.exec_driver_sql("CREATE VIRTUAL TABLE post_search USING fts5("
+                                   "title, content, tokenize = 'unicode61 remove_diacritics 2')")
+        connection.exec_driver_sql('INSERT INTO post_search (rowid, title, content) SELECT id, title, content FROM posts')
+
+    def drop(self, connection):
+        connection.exec_driver_sql('DROP TABLE IF EXISTS post_search')
+
+    def index(self, connection, documents):
+        if not documents:
+            return
+        self.remove(connection, [document['id'] for document in documents])
+        connection.execute(text('INSERT INTO post_search (rowid, title, content) VALUES (:id, :title, :content)'),
+                           documents)
+
+    def remove(self, connection, post_ids):
+        if post_ids:
+            connection.execute(text('DELETE FROM post_search WHERE rowid = :id'), [{'id': i} for i in post_ids])
+
+    def search(self, connection, terms, limit, offset):
+        match = ' '.join(f'"{term}"' for term in terms)
+        total = connection.execute(text('SELECT count(*) FROM post_search WHERE post_search MATCH :match'),
+                                   {'match': match}).scalar()
+        # a hit in the title weighs four times a hit in the content
+        rows = connection.execute(text("SELECT rowid, snippet(post_search, 1, :start, :end, :ellipsis, 24) "
+                                       "FROM post_search WHERE post_search MATCH :match "
+                                       "ORDER BY bm25(post_search, 4.0, 1.0) LIMIT :limit OFFSET :offset"),
+                                  {'match': match, 'start': MARK_START, 'end': MARK_END, 'ellipsis': ELLIPSIS,
+                                   'limit': limit, 'offset': offset}).all()
+        return total, rows
+
+
+class PostgresBackend:
+    """tsvector documents in post_search behind a GIN index, ranked with ts_rank()."""
+
+    transactional = True
+
+    def __init__(self, config):
+        self.config = config
+
+    def create(self, connection):
+        if connection.exec_driver_sql("SELECT to_regclass('post_search')").scalar():
+            return
+        connection.exec_driver_sql('CREATE TABLE post_search ('
+                                   'post_id INTEGER PRIMARY KEY REFERENCES posts (id) ON DELETE CASCADE, '
+                                   'document TSVECTOR NOT NULL)')
+        connection.exec_driver_sql('CREATE INDEX ix_post_search_document ON post_search USING GIN (document)')
+        connection.execute(text("INSERT INTO post_search (post_id, document) "
+                                "SELECT id, setweight(to_tsvector(CAST(:config AS regconfig), title), 'A') || "
+                                "setweight(to_tsvector(CAST(:config AS regconfig), content), 'B') FROM posts"),
+                           {'config': self.config})
+
+    def drop(self, connection):
+        connection.exec_driver_sql('DROP TABLE IF EXISTS post_search')
+
+    def index(self, connection, documents):
+        if not documents:
+            return
+        connection.execute(text("INSERT INTO post_search (post_id, document) "
+                                "VALUES (:id, setweight(to_tsvector(CAST(:config AS regconfig), :title), 'A') || "
+                                "setweight(to_tsvector(CAST(:config AS regconfig), :content), 'B')) "
+                                "ON CONFLICT (post_id) DO UPDATE SET document = excluded.document"),
+                           [dict(document, config=self.config) for document in documents])
+
+    def remove(self, connection, post_ids):
+        if post_ids:
+            connection.execute(text('DELETE FROM post_search WHERE post_id = :id'), [{'id': i} for i in post_ids])
+
+    def search(self, connection, terms, limit, offset):
+        parameters = {'config': self.config, 'query': ' '.join(terms), 'limit': limit, 'offset': offset,
+                      'options': f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=24, MinWords=12'}
+        total = connection.execute(text("SELECT count(*) FROM post_search "
+                                        "WHERE document @@ plainto_tsquery(CAST(:config AS regconfig), :query)"),
+                                   parameters).scalar()
+        # ts_headline is expensive, so it only runs on the rows of the page
+        rows = connection.execute(text("SELECT page.post_id, ts_headline(CAST(:config AS regconfig), posts.content, "
+                                       "plainto_tsquery(CAST(:config AS regconfig), :query), :options) "
+                                       "FROM (SELECT post_id, ts_rank(document, query) AS rank "
+                                       "      FROM post_search, plainto_tsquery(CAST(:config AS regconfig), :query) "
+                                       "      AS query WHERE document @@ query "
+                                       "      ORDER BY rank DESC, post_id DESC LIMIT :limit OFFSET :offset) AS page "
+                                       "JOIN posts ON posts.id = page.post_id ORDER BY page.rank DESC, page.post_id DESC"),
+                                  parameters).all()
+        return total, rows
+
+
+class MemoryBackend:
+    """Inverted index in process memory, ranked with BM25.
+
+    It is built from the posts table on first use and kept up to date by this
+    process only, so it suits development and single-process deployments.
+    """
+
+    transactional = False
+    k1 = 1.2
+    b = 0.75
+    title_weight = 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = defaultdict(dict)
+        self._terms = {}
+        self._lengths = {}
+        self._documents = {}
+        self.built = False
+
+    def create(self, connection):
+        if not self.built:
+            self.index(connection, [row._asdict() for row in
+                                    connection.execute(text('SELECT id, title, content FROM posts'))])
+            self.built = True
+
+    def drop(self, connection):
+        with self._lock:
+            self._postings.clear()
+            self._terms.clear()
+            self._lengths.clear()
+            self._documents.clear()
+            self.built = False
+
+    def index(self, connection, documents):
+        with self._lock:
+            for document in documents:
+                self._remove(document['id'])
+                frequencies = Counter(tokenize(document['content']))
+                for term in tokenize(document['title']):
+                    frequencies[term] += self.title_weight
+                for term, frequency in frequencies.items():
+                    self._postings[term][document['id']] = frequency
+                self._terms[document['id']] = set(frequencies)
+                self._lengths[document['id']] = sum(frequencies.values())
+                self._documents[document['id']] = document['content']
+
+    def remove(self, connection, post_ids):
+        with self._lock:
+            for post_id in post_ids:
+                self._remove(post_id)
+
+    def _remove(self, post_id):
+        if post_id not in self._documents:
+            return
+        del self._documents[post_id], self._lengths[post_id]
+        for term in self._terms.pop(post_id):
+            postings = self._postings[term]
+            del postings[post_id]
+            if not postings:
+                del self._postings[term]
+
+    def search(self, connection, terms, limit, offset):
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not all(postings):
+                return 0, []
+            matches = set.intersection(*(set(posting) for posting in postings))
+            count = len(self._lengths)
+            average = sum(self._lengths.values()) / count
+            scores = {}
+            for post_id in matches:
+                length = self._lengths[post_id]
+                score = 0.0
+                for posting in postings:
+                    frequency = posting[post_id]
+                    idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+                    score += idf * frequency * (self.k1 + 1) / \
+                        (frequency + self.k1 * (1 - self.b + self.b * length / average))
+                scores[post_id] = score
+            page = sorted(scores, key=lambda post_id: (-scores[post_id], -post_id))[offset:offset + limit]
+            return len(matches), [(post_id, highlight(self._documents[post_id], terms)) for post_id in page]
+
+
+def highlight(value, terms, size=24):
+    # re.split keeps the separators: parts alternate separator, word, separator, ...
+    parts = re.split(r'(\w+)', value)
+    words = parts[1::2]
+    first = next((i for i, word in enumerate(words) if word.lower() in terms), 0)
+    start = max(first - size // 4, 0)
+    end = min(start + size, len(words))
+    pieces = [ELLIPSIS] if start else []
+    for i in range(start, end):
+        if i > start:
+            pieces.append(parts[2 * i])
+        pieces.append(MARK_START + words[i] + MARK_END if words[i].lower() in terms else words[i])
+    if end < len(words):
+        pieces.append(ELLIPSIS)
+    return ''.join(pieces)
+
+
+class PostSearch:
+    """Full-text search over post titles and content.
+
+    SEARCH_BACKEND picks the index: 'sqlite' (FTS5), 'postgresql' (tsvector
+    with a GIN index), 'memory', or 'auto' to follow the database. Post
+    creates, updates and deletes reach the index with the flush that writes
+    them; `flask search rebuild` reindexes everything after bulk changes.
+    """
+
+    def __init__(self, app=None):
+        self._backends = {}
+        self._ready = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_BACKEND', 'auto')
+        app.config.setdefault('SEARCH_POSTGRES_CONFIG', 'simple')
+        app.extensions['post_search'] = self
+
+        if not event.contains(db.session, 'after_flush', self._collect):
+            event.listen(db.session, 'after_flush', self._collect)
+            event.listen(db.session, 'after_commit', self._apply)
+            event.listen(db.session, 'after_rollback', self._discard)
+            event.listen(db.metadata, 'after_create', self._create)
+            # the index goes first - on PostgreSQL it references posts
+            event.listen(db.metadata, 'before_drop', self._drop)
+
+        @app.cli.group('search')
+        def search_cli():
+            """Full-text search index."""
+
+        @search_cli.command('rebuild')
+        def rebuild_command():
+            """Reindex every post."""
+            self.rebuild()
+            click.echo(f'Search index rebuilt with the {current_app.config["SEARCH_BACKEND"]} backend.')
+
+    def backend(self, dialect_name=None):
+        name = current_app.config['SEARCH_BACKEND']
+        if name == 'auto':
+            name = dialect_name or db.engine.dialect.name
+            if name not in ('sqlite', 'postgresql') or (name == 'sqlite' and not fts5_available()):
+                name = 'memory'
+        if name not in self._backends:
+            if name == 'sqlite':
+                self._backends[name] = SqliteBackend()
+            elif name == 'postgresql':
+                self._backends[name] = PostgresBackend(current_app.config['SEARCH_POSTGRES_CONFIG'])
+            elif name == 'memory':
+                self._backends[name] = MemoryBackend()
+            else:
+                raise ValueError(f'Unknown search backend {name!r}')
+        return self._backends[name]
+
+    def search(self, query, page=1, per_page=10):
+        from blog.models import Post, Comment
+
+        terms = list(dict.fromkeys(tokenize(query or '')))[:16]
+        if not terms:
+            return SearchResults([], 0, page, per_page)
+
+        connection = db.session.connection()
+        backend = self._ensure(connection)
+        total, rows = backend.search(connection, terms, per_page, (page - 1) * per_page)
+
+        post_ids = [row[0] for row in rows]
+        posts = {post.id: post for post in Post.query.options(joinedload(Post.author)).filter(Post.id.in_(post_ids))}
+        comments = dict(db.session.query(Comment.post_id, func.count(Comment.id))
+                        .filter(Comment.post_id.in_(post_ids)).group_by(Comment.post_id))
+        # an index row can outlive its post when posts are deleted behind the ORM's back
+        items = [SearchHit(posts[post_id], render_snippet(snippet), comments.get(post_id, 0))
+                 for post_id, snippet in rows if post_id in posts]
+        return SearchResults(items, total, page, per_page)
+
+    def rebuild(self):
+        connection = db.session.connection()
+        backend = self.backend(connection.dialect.name)
+        backend.drop(connection)
+        self._ready.discard(backend)
+        self._ensure(connection)
+        db.session.commit()
+
+    def _ensure(self, connection):
+        backend = self.backend(connection.dialect.name)
+        if backend not in self._ready:
+            backend.create(connection)
+            self._ready.add(backend)
+        return backend
+
+    def _create(self, target, connection, **kwargs):
+        self._ensure(connection)
+
+    def _drop(self, target, connection, **kwargs):
+        backend = self.backend(connection.dialect.name)
+        backend.drop(connection)
+        self._ready.discard(backend)
+
+    def _collect(self, session, flush_context):
+        from blog.models import Post
+
+        documents, removed = [], []
+        for obj in session.new:
+            if isinstance(obj, Post):
+                documents.append({'id': obj.id, 'title': obj.title, 'content': obj.content})
+        for obj in session.dirty:
+            if isinstance(obj, Post) and any(inspect(obj).attrs[attr].history.has_changes()
+                                             for attr in ('title', 'content')):
+                documents.append({'id': obj.id, 'title': obj.title, 'content': obj.content})
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                removed.append(obj.id)
+        if not documents and not removed:
+            return
+
+        connection = session.connection()
+        backend = self.backend(connection.dialect.name)
+        if backend.transactional:
+            # written in the flush's own transaction, so the index commits and rolls back with the posts
+            self._ensure(connection)
+            backend.remove(connection, removed)
+            backend.index(connection, documents)
+        else:
+            pending = session.info.setdefault('search_pending', {})
+            pending.update((document['id'], document) for document in documents)
+            pending.update((post_id, None) for post_id in removed)
+
+    def _apply(self, session):
+        pending = session.info.pop('search_pending', None)
+        if not pending:
+            return
+        backend = self.backend()
+        if not backend.transactional and backend.built:
+            backend.remove(None, [post_id for post_id, document in pending.items() if document is None])
+            backend.index(None, [document for document in pending.values() if document is not None])
+
+    def _discard(self, session):
+        session.info.pop('search_pending', None)
+
+
+post_search = PostSearch()
@@ -31,4 +31,24 @@ function comment_like(commentId) {
       }
     })
     .catch((e) => alert("Could not like comment."));
-}
\ No newline at end of file
+}
+
+function more_comments(button) {
+  // the next chunk of comments replaces the button, with a button of its own if there are more
+  button.disabled = true;
+
+  fetch(button.dataset.url)
+    .then((res) => {
+      if (!res.ok) {
+        throw new Error(res.statusText);
+      }
+      return res.text();
+    })
+    .then((html) => {
+      button.outerHTML = html;
+    })
+    .catch((e) => {
+      button.disabled = false;
+      alert("Could not load comments.");
+    });
+}
@@ -0,0 +1,239 @@
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, redirect, send_from_directory, url_for
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class LocalStorage:
+    """Media files in a directory of this machine.
+
+    Files are handed to the WSGI server as file objects, so servers with
+    wsgi.file_wrapper (gunicorn, uWSGI) send them with sendfile(2) without
+    copying them through Python; with USE_X_SENDFILE the front server does.
+    A root inside the static folder is served by the static endpoint, any
+    other root by /media/<key>.
+    """
+
+    def __init__(self, root, endpoint='media'):
+        self.root = root
+        self.endpoint = endpoint
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def write(self, key, data, cache_control=None):
+        # written under a temporary name and renamed, so a half-written file is never served
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.part', path)
+
+    def read(self, key):
+        with open(self.path(key), 'rb') as file:
+            return file.read()
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        if os.path.isfile(self.path(key)):
+            os.remove(self.path(key))
+
+    def list(self, prefix):
+        directory = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+        folder = self.path(directory) if directory else self.root
+        if not os.path.isdir(folder):
+            return []
+        keys = []
+        for parent, _, names in os.walk(folder):
+            for name in names:
+                key = os.path.relpath(os.path.join(parent, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.part'):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete_prefix(self, prefix):
+        if prefix.endswith('/'):
+            shutil.rmtree(self.path(prefix.rstrip('/')), ignore_errors=True)
+            return
+        for key in self.list(prefix):
+            self.delete(key)
+
+    def rename_prefix(self, old, new):
+        # only whole folders are renamed, in one step unless the target folder exists already
+        source, target = self.path(old.rstrip('/')), self.path(new.rstrip('/'))
+        if not os.path.isdir(source):
+            return
+        if not os.path.isdir(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(source, target)
+            return
+        for key in self.list(old):
+            os.makedirs(os.path.dirname(self.path(new + key[len(old):])), exist_ok=True)
+            os.replace(self.path(key), self.path(new + key[len(old):]))
+        shutil.rmtree(source, ignore_errors=True)
+
+    def url(self, key):
+        return url_for(self.endpoint, filename=key)
+
+    def send(self, key, cache_control=None):
+        response = send_from_directory(self.root, key)
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        return response
+
+
+class S3Storage:
+    """Media files in a bucket of S3 or an S3-compatible service (MinIO, Ceph, R2).
+
+    With MEDIA_S3_PUBLIC_URL (a CDN or a public bucket) the pages link the
+    objects directly; otherwise /media/<key> redirects to a short-lived
+    presigned URL.
+    """
+
+    def __init__(self, client, bucket, prefix='', public_url=None, expires=3600):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.expires = expires
+
+    def write(self, key, data, cache_control=None):
+        extra = {'CacheControl': cache_control} if cache_control else {}
+        content_type, _ = mimetypes.guess_type(key)
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data,
+                               ContentType=content_type or 'application/octet-stream', **extra)
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def list(self, prefix):
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket,
+                                                                          Prefix=self.prefix + prefix):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return keys
+
+    def delete_prefix(self, prefix):
+        keys = self.list(prefix)
+        # DeleteObjects takes at most 1000 keys
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self.prefix + key} for key in keys[start:start + 1000]], 'Quiet': True})
+
+    def rename_prefix(self, old, new):
+        # S3 has no rename, every object is copied and the originals deleted
+        for key in self.list(old):
+            self.client.copy_object(Bucket=self.bucket, Key=self.prefix + new + key[len(old):],
+                                    CopySource={'Bucket': self.bucket, 'Key': self.prefix + key})
+        self.delete_prefix(old)
+
+    def url(self, key):
+        if self.public_url:
+            return f'{self.public_url}/{self.prefix}{key}'
+        return url_for('media', filename=key)
+
+    def send(self, key, cache_control=None):
+        return redirect(self.client.generate_presigned_url('get_object', ExpiresIn=self.expires,
+                                                           Params={'Bucket': self.bucket, 'Key': self.prefix + key}))
+
+
+class MediaStorage:
+    """Where avatars, post pictures and their variants are kept.
+
+    MEDIA_STORAGE picks the backend: 'local' keeps files under MEDIA_ROOT
+    (the static folder by default), 's3' in MEDIA_S3_BUCKET. Keys are
+    '/'-separated paths such as media/ab/<sha256>.png; everything else in
+    the application goes through this object rather than the filesystem.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MEDIA_STORAGE', 'local')
+        app.config.setdefault('MEDIA_ROOT', app.static_folder)
+        app.config.setdefault('MEDIA_S3_BUCKET', None)
+        app.config.setdefault('MEDIA_S3_PREFIX', '')
+        app.config.setdefault('MEDIA_S3_ENDPOINT_URL', None)
+        app.config.setdefault('MEDIA_S3_REGION', None)
+        app.config.setdefault('MEDIA_S3_PUBLIC_URL', None)
+        app.config.setdefault('MEDIA_S3_URL_EXPIRES', 3600)
+        app.extensions['media_storage'] = self
+        self.backend = self.create_backend(app)
+
+        if 'media' not in app.view_functions:
+            app.add_url_rule('/media/<path:filename>', endpoint='media', view_func=self._send)
+
+    def create_backend(self, app):
+        config = app.config
+        if config['MEDIA_STORAGE'] == 'local':
+            root = os.path.abspath(config['MEDIA_ROOT'])
+            return LocalStorage(root, 'static' if root == os.path.abspath(app.static_folder) else 'media')
+        if config['MEDIA_STORAGE'] == 's3':
+            import boto3
+            from botocore.config import Config
+
+            client = boto3.client('s3', endpoint_url=config['MEDIA_S3_ENDPOINT_URL'],
+                                  region_name=config['MEDIA_S3_REGION'],
+                                  config=Config(s3={'addressing_style': 'path'})
+                                  if config['MEDIA_S3_ENDPOINT_URL'] else None)
+            return S3Storage(client, config['MEDIA_S3_BUCKET'], config['MEDIA_S3_PREFIX'],
+                             config['MEDIA_S3_PUBLIC_URL'], config['MEDIA_S3_URL_EXPIRES'])
+        raise ValueError(f"Unknown MEDIA_STORAGE {config['MEDIA_STORAGE']!r}")
+
+    def cache_control(self, key):
+        # blobs and their variants never change under a name
+        folder = current_app.config.get('BLOB_STORE_FOLDER', 'media')
+        return IMMUTABLE if key.startswith(folder + '/') else None
+
+    def write(self, key, data):
+        self.backend.write(key, data, self.cache_control(key))
+
+    def read(self, key):
+        return self.backend.read(key)
+
+    def exists(self, key):
+        return self.backend.exists(key)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def list(self, prefix):
+        return self.backend.list(prefix)
+
+    def delete_prefix(self, prefix):
+        self.backend.delete_prefix(prefix)
+
+    def rename_prefix(self, old, new):
+        self.backend.rename_prefix(old, new)
+
+    def url(self, key):
+        return self.backend.url(key)
+
+    def _send(self, filename):
+        return self.backend.send(filename, self.cache_control(filename))
+
+
+storage = MediaStorage()
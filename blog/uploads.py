@@ -0,0 +1,91 @@
+import os
+import tempfile
+from collections import namedtuple
+
+from PIL import Image, UnidentifiedImageError
+from flask import current_app, request
+from wtforms.validators import StopValidation
+
+
+# leading bytes of every format a picture may be uploaded in
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+)
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif'}
+
+CHUNK_SIZE = 64 * 1024
+
+Upload = namedtuple('Upload', 'path extension format width height')
+
+
+class UploadRejected(ValueError):
+    pass
+
+
+def sniff(head):
+    for signature, image_format in SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    return None
+
+
+def ingest_upload(storage, formats=('JPEG', 'PNG')):
+    """Copy an uploaded picture to a temporary file and check it without decoding it.
+
+    The upload is read in chunks and given up on as soon as it is over
+    IMAGE_UPLOAD_MAX_BYTES or its first bytes are not one of `formats`. Only
+    the header is parsed to check the dimensions against IMAGE_UPLOAD_MAX_SIDE
+    and IMAGE_UPLOAD_MAX_PIXELS. The file lives in IMAGE_QUEUE_UPLOAD_FOLDER
+    and is removed at the end of the request unless it was moved on.
+    """
+    config = current_app.config
+    folder = config['IMAGE_QUEUE_UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    descriptor, path = tempfile.mkstemp(prefix='upload-', suffix='.part', dir=folder)
+    request.environ.setdefault('blog.image_uploads', []).append(path)
+
+    with os.fdopen(descriptor, 'wb') as file:
+        chunk = storage.stream.read(CHUNK_SIZE)
+        image_format = sniff(chunk)
+        if image_format not in formats:
+            raise UploadRejected('The file is not a ' + ' or '.join(formats) + ' picture')
+        written = 0
+        while chunk:
+            written += len(chunk)
+            if written > config['IMAGE_UPLOAD_MAX_BYTES']:
+                raise UploadRejected(f"The picture is larger than {config['IMAGE_UPLOAD_MAX_BYTES'] / 1024 / 1024:g} MB")
+            file.write(chunk)
+            chunk = storage.stream.read(CHUNK_SIZE)
+
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise UploadRejected('The picture cannot be read')
+    if max(width, height) > config['IMAGE_UPLOAD_MAX_SIDE'] or width * height > config['IMAGE_UPLOAD_MAX_PIXELS']:
+        raise UploadRejected(f'The picture is too large ({width}x{height})')
+    return Upload(path, EXTENSIONS[image_format], image_format, width, height)
+
+
+def discard_uploads(exception=None):
+    for path in request.environ.pop('blog.image_uploads', []):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+class PictureUpload:
+    """Form validator that ingests the file of a FileField and leaves an Upload in its data."""
+
+    def __init__(self, formats=('JPEG', 'PNG')):
+        self.formats = formats
+
+    def __call__(self, form, field):
+        if not field.data or isinstance(field.data, Upload) or not getattr(field.data, 'filename', None):
+            return
+        try:
+            field.data = ingest_upload(field.data, self.formats)
+        except UploadRejected as error:
+            raise StopValidation(str(error))
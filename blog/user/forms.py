@@ -5,6 +5,7 @@ from flask_wtf.file import FileAllowed
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, FileField, SelectField
 from wtforms.validators import DataRequired, EqualTo, Length, Email, ValidationError
 from blog.models import User
+from blog.uploads import PictureUpload
 
 
 class RegistrationForm(FlaskForm):
@@ -39,7 +40,7 @@ class LoginForm(FlaskForm):
 class UpdateAccountForm(FlaskForm):
     username = StringField('User name', validators=[DataRequired(), Length(min=4, max=20)])
     email = StringField('Email', validators=[DataRequired(), Email()])
-    picture = FileField('Image (png, jpg)', validators=[FileAllowed(['jpg', 'png']), ])
+    picture = FileField('Image (png, jpg)', validators=[FileAllowed(['jpg', 'png']), PictureUpload()])
     submit = SubmitField('Update')
 
     def validate_username(self, username):
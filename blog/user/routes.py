@@ -1,6 +1,3 @@
-import os
-import shutil
-
 from datetime import datetime
 
 import sqlalchemy
@@ -8,9 +5,13 @@ from flask import Blueprint, render_template, flash, url_for, request, abort
 from flask_login import current_user, logout_user, login_required, login_user
 from werkzeug.utils import redirect
 
-from blog import bcrypt, db
+from blog import db
+from blog.images import media_url, user_media_prefix
 from blog.models import User, Post
-from settings import UPLOAD_FOLDER
+from blog.page_cache import page_cache
+from blog.pagination import paginate_posts
+from blog.passwords import password_hasher
+from blog.storage import storage
 from blog.user.forms import RegistrationForm, LoginForm, UpdateAccountForm, ResetPasswordForm, RequestResetForm
 from blog.user.utils import save_picture, random_avatar, send_reset_email
 
@@ -29,7 +30,7 @@ def signup():
         return redirect(url_for('main.blog'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = password_hasher.hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data, password=hashed_password,
                     image_file=random_avatar(form.username.data), role=form.role.data)
         db.session.add(user)
@@ -53,9 +54,9 @@ def login():
 
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
-            # db.session.add(user)
-            # db.session.commit()
+        if user and password_hasher.verify(user, form.password.data):
+            # saves the password if it was rehashed at the configured cost
+            db.session.commit()
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             flash(f'You are logged in as a user {current_user.username}', 'info')
@@ -79,34 +80,27 @@ def profile():
         form.email.data = current_user.email
 
     elif form.validate_on_submit():
-        path_one = os.path.join(os.getcwd(), UPLOAD_FOLDER, user.username)
-        path_two = os.path.join(os.getcwd(), UPLOAD_FOLDER, form.username.data)
-        os.rename(path_one, path_two)
         current_user.username = form.username.data
         current_user.email = form.email.data
 
         if form.picture.data:
-            current_user.image_file = save_picture(form.picture.data)
+            save_picture(form.picture.data)
         else:
             form.picture.data = current_user.image_file
 
         db.session.commit()
         flash('Your profile was updated!', 'success')
         return redirect(url_for('users.profile'))
-    image_file = url_for('static',
-                         filename=f'profile_pics/' + '/users/' + current_user.username + '/profile_img/' +
-                                  current_user.image_file)
+    image_file = media_url(current_user.id, 'profile_img', current_user.image_file)
     return render_template('user/profile.html', title='Profile',
                            image_file=image_file, form_update=form, posts=posts, users=users, user=user)
 
 
 @users.route('/user/<string:username>')
+@page_cache.cached(newest=lambda username: Post.author.has(User.username == username))
 def user_posts(username):
-    page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    posts = Post.query.filter_by(author=user) \
-        .order_by(Post.date_posted.desc()) \
-        .paginate(page=page, per_page=3)
+    posts = paginate_posts(Post.query.filter_by(author=user), per_page=3, scope=('author', user.id))
 
     return render_template('user/user_posts.html', title='Blog', posts=posts, user=user)
 
@@ -120,9 +114,7 @@ def delete_user(username):
             db.session.delete(user)
             db.session.commit()
             flash(f'User {username} was deleted!', 'info')
-            user_path = os.path.join(os.getcwd(), UPLOAD_FOLDER, user.username)
-            full_path = user_path.replace("\\", "/")
-            shutil.rmtree(full_path)
+            storage.delete_prefix(user_media_prefix(user.id))
 
             return redirect(url_for('users.profile'))
 
@@ -135,38 +127,6 @@ def delete_user(username):
         flash('Admin cannot be deleted!', 'warning')
         return redirect(url_for('users.profile'))
 
-@users.route('/reset_password', methods=['GET', 'POST'])
-def reset_request():
-    if current_user.is_authenticated:
-        return redirect(url_for('main.blog'))
-    form = RequestResetForm()
-    if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
-        send_reset_email(user)
-        flash('Password recovery instructions were sent to the specified email.', 'info')
-        return redirect(url_for('users.login'))
-    return render_template('user/reset_request.html', form=form, title='Password reset')
-
-
-@users.route('/reset_password/<token>', methods=['GET', 'POST'])
-def reset_token(token):
-    if current_user.is_authenticated:
-        return redirect(url_for('main.blog'))
-    user = User.verify_reset_token(token)
-    if user is None:
-        flash('Incorrect or expired token', 'warning')
-        return redirect(url_for('users.reset_request'))
-    form = ResetPasswordForm()
-    if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
-        user.password = hashed_password
-        db.session.commit()
-        flash('Your password has been updated! You can login to the blog', 'success')
-        return redirect(url_for('users.login'))
-    return render_template('user/reset_token.html', form=form, title='Password reset')
-
-
-
 @users.route('/reset_password', methods=['GET', 'POST'])
 def reset_request():
     # if current_user.is_authenticated:
@@ -175,6 +135,7 @@ def reset_request():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         send_reset_email(user)
+        db.session.commit()
         flash('Password recovery instructions were sent to the specified email.', 'info')
         return redirect(url_for('users.login'))
     return render_template('user/reset_request.html', form_reset=form, title='Password reset')
@@ -190,8 +151,7 @@ def reset_token(token):
         return redirect(url_for('users.reset_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
-        user.password = hashed_password
+        user.password = password_hasher.hash(form.password.data)
         db.session.commit()
         flash('Your password has been updated! You can login to the blog', 'success')
         return redirect(url_for('users.login'))
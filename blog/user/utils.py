@@ -1,35 +1,17 @@
 import os
-import secrets
 import random
-import shutil
 
-from PIL import Image
 from flask import current_app, url_for
 from flask_login import current_user
 from flask_mail import Message
 
-from blog import mail
+from blog.images import image_queue, store_picture
+from blog.outbox import mail_outbox
 
 
 def save_picture(form_picture):
-    random_hex = secrets.token_hex(16)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    full_path = os.path.join(current_app.root_path, 'static', 'profile_pics/', 'users',  current_user.username, 'profile_img')
-    try:
-        os.remove(
-            os.path.join(current_app.root_path,
-                         f"static/profile_pics/users/{current_user.username}/profile_img/{current_user.image_file}"))
-    except:
-        print('The image was not found, it may have been deleted!')
-    if not os.path.exists(full_path):
-        os.mkdir(full_path)
-    picture_path = os.path.join(full_path, picture_fn)
-    output_size = (360, 360)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-    return picture_fn
+    # resized off the request; current_user.image_file changes once the picture is ready
+    image_queue.enqueue(current_user, 'avatar', form_picture, 360)
 
 
 # def save_picture_post(form_picture):
@@ -48,17 +30,13 @@ def save_picture(form_picture):
 
 
 def random_avatar(user):
-    full_path = os.path.join(os.getcwd(), 'blog/static', 'profile_pics', 'users',  user, 'profile_img')
-    if not os.path.exists(full_path):
-        os.makedirs(full_path)
-    full_path_avatar = os.path.join(os.getcwd(), 'blog/static/Avatars/')
+    # a stock avatar is stored once, every user who draws it links the same blob
+    full_path_avatar = os.path.join(current_app.root_path, 'static', 'Avatars')
     list_avatars = os.listdir(full_path_avatar)
     lst = random.choice(list_avatars)
-    random_image_file = os.path.join(full_path_avatar, lst)
-    # print('random_image_file', random_image_file)
-    shutil.copy(random_image_file, full_path)
-    # print('full_path', full_path)
-    return lst
+    _, extension = os.path.splitext(lst)
+    with open(os.path.join(full_path_avatar, lst), 'rb') as file:
+        return store_picture(file.read(), extension, 'profile_img')
 
 
 def send_reset_email(user):
@@ -75,4 +53,4 @@ def send_reset_email(user):
 
    There is no need to reply to this letter as it is generated automatically.
     """
-    mail.send(msg)
+    mail_outbox.enqueue(msg)
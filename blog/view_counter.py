@@ -0,0 +1,115 @@
+import atexit
+import threading
+from collections import Counter
+
+from flask import current_app, has_app_context, session
+from sqlalchemy import bindparam, event, func, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from blog import db
+
+
+class ViewCounter:
+    """Buffers post views in process and writes them to Post.views in batches.
+
+    A view only bumps an in-memory counter. A background thread writes the
+    buffer with one executemany UPDATE every VIEW_COUNTER_FLUSH_INTERVAL seconds,
+    or as soon as VIEW_COUNTER_FLUSH_SIZE views are pending, so reading a post
+    never waits on a write transaction. An interval of 0 disables the thread and
+    leaves flushing to explicit flush() calls and interpreter exit.
+    """
+
+    def __init__(self, app=None):
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('VIEW_COUNTER_FLUSH_SIZE', 100)
+        app.config.setdefault('VIEW_COUNTER_FLUSH_INTERVAL', 10)
+        app.config.setdefault('VIEW_COUNTER_ONCE_PER_SESSION', False)
+        app.extensions['view_counter'] = self
+        self._app = app
+        atexit.register(self.flush)
+
+        if not event.contains(db.metadata, 'after_drop', self._discard):
+            # buffered views of dropped tables have nowhere to go
+            event.listen(db.metadata, 'after_drop', self._discard)
+
+    def record(self, post_id):
+        if current_app.config['VIEW_COUNTER_ONCE_PER_SESSION']:
+            viewed = session.get('viewed_posts', [])
+            if post_id in viewed:
+                return
+            # keep the cookie small - only the most recent posts are remembered
+            session['viewed_posts'] = (viewed + [post_id])[-200:]
+
+        with self._lock:
+            self._pending[post_id] += 1
+            due = sum(self._pending.values()) >= current_app.config['VIEW_COUNTER_FLUSH_SIZE']
+
+        self._start_flusher()
+        if due:
+            self._wake.set()
+
+    def pending(self, post_id):
+        with self._lock:
+            return self._pending.get(post_id, 0)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return
+
+        if has_app_context():
+            self._write(pending)
+        else:
+            with self._app.app_context():
+                self._write(pending)
+
+    def _discard(self, *args, **kwargs):
+        with self._lock:
+            self._pending.clear()
+
+    def _write(self, pending):
+        from blog.models import Post
+
+        posts_table = Post.__table__
+        statement = update(posts_table) \
+            .where(posts_table.c.id == bindparam('post_id')) \
+            .values(views=func.coalesce(posts_table.c.views, 0) + bindparam('increment'))
+        try:
+            db.session.execute(statement, [{'post_id': post_id, 'increment': increment}
+                                           for post_id, increment in pending.items()])
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            # put the views back so that the next flush retries them
+            with self._lock:
+                self._pending.update(pending)
+            current_app.logger.exception('Could not write %d buffered post views', sum(pending.values()))
+
+    def _start_flusher(self):
+        interval = current_app.config['VIEW_COUNTER_FLUSH_INTERVAL']
+        if not interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run_flusher, args=(interval,),
+                                            name='view-counter-flusher', daemon=True)
+            self._thread.start()
+
+    def _run_flusher(self, interval):
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            self.flush()
+
+
+view_counter = ViewCounter()
@@ -0,0 +1,62 @@
+"""shared tags and the post_tags association
+
+Revision ID: 5c1d7e0a9b42
+Revises: f29dba04fecf
+Create Date: 2026-10-18 12:24:07.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1d7e0a9b42'
+down_revision = 'f29dba04fecf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_tags',
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('post_id', 'tag_id')
+    )
+    with op.batch_alter_table('post_tags', schema=None) as batch_op:
+        batch_op.create_index('ix_post_tags_tag_id_post_id', ['tag_id', 'post_id'], unique=False)
+
+    # every (name, post) row becomes a link to the oldest row of that name, the other rows go
+    op.execute('INSERT INTO post_tags (post_id, tag_id) '
+               'SELECT DISTINCT tags.post_id, kept.id FROM tags '
+               'JOIN (SELECT name, MIN(id) AS id FROM tags GROUP BY name) AS kept ON kept.name = tags.name')
+    op.execute('DELETE FROM tags WHERE id NOT IN (SELECT MIN(id) FROM tags GROUP BY name)')
+
+    with op.batch_alter_table('tags', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tags_post_id'))
+        batch_op.drop_index(batch_op.f('ix_tags_name'))
+        batch_op.create_index(batch_op.f('ix_tags_name'), ['name'], unique=True)
+        batch_op.drop_column('post_id')
+
+
+def downgrade():
+    with op.batch_alter_table('tags', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('post_id', sa.Integer(), nullable=True))
+        batch_op.drop_index(batch_op.f('ix_tags_name'))
+        batch_op.create_index(batch_op.f('ix_tags_name'), ['name'], unique=False)
+
+    # back to one row per (name, post); tags without posts had no row before
+    op.execute('INSERT INTO tags (name, post_id) '
+               'SELECT tags.name, post_tags.post_id FROM tags JOIN post_tags ON post_tags.tag_id = tags.id')
+    op.execute('DELETE FROM tags WHERE post_id IS NULL')
+
+    with op.batch_alter_table('tags', schema=None) as batch_op:
+        batch_op.alter_column('post_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_foreign_key('fk_tags_post_id_posts', 'posts', ['post_id'], ['id'], ondelete='CASCADE')
+        batch_op.create_index(batch_op.f('ix_tags_post_id'), ['post_id'], unique=False)
+
+    with op.batch_alter_table('post_tags', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_tags_tag_id_post_id')
+
+    op.drop_table('post_tags')
@@ -0,0 +1,55 @@
+"""like counters and one like per user
+
+Revision ID: 98bc81fea7fc
+Revises: 9ee2a854c73f
+Create Date: 2026-10-18 10:12:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '98bc81fea7fc'
+down_revision = '9ee2a854c73f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+
+    # keep the oldest of any duplicated likes before the unique constraints go in
+    op.execute('DELETE FROM post_likes WHERE id NOT IN '
+               '(SELECT MIN(id) FROM post_likes GROUP BY user_id, post_id)')
+    op.execute('DELETE FROM comment_likes WHERE id NOT IN '
+               '(SELECT MIN(id) FROM comment_likes GROUP BY user_id, comment_id)')
+
+    with op.batch_alter_table('post_likes', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_post_likes_user_post', ['user_id', 'post_id'])
+
+    with op.batch_alter_table('comment_likes', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_comment_likes_user_comment', ['user_id', 'comment_id'])
+
+    op.execute('UPDATE posts SET like_count = '
+               '(SELECT COUNT(*) FROM post_likes WHERE post_likes.post_id = posts.id)')
+    op.execute('UPDATE comments SET like_count = '
+               '(SELECT COUNT(*) FROM comment_likes WHERE comment_likes.comment_id = comments.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('comment_likes', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_comment_likes_user_comment', type_='unique')
+
+    with op.batch_alter_table('post_likes', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_post_likes_user_post', type_='unique')
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.drop_column('like_count')
+
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_column('like_count')
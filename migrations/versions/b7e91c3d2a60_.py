@@ -0,0 +1,38 @@
+"""full-text search index for posts
+
+Revision ID: b7e91c3d2a60
+Revises: 5c1d7e0a9b42
+Create Date: 2026-10-18 13:40:52.118307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e91c3d2a60'
+down_revision = '5c1d7e0a9b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE post_search USING fts5("
+                   "title, content, tokenize = 'unicode61 remove_diacritics 2')")
+        op.execute('INSERT INTO post_search (rowid, title, content) SELECT id, title, content FROM posts')
+    elif dialect == 'postgresql':
+        op.execute('CREATE TABLE post_search ('
+                   'post_id INTEGER PRIMARY KEY REFERENCES posts (id) ON DELETE CASCADE, '
+                   'document TSVECTOR NOT NULL)')
+        op.execute('CREATE INDEX ix_post_search_document ON post_search USING GIN (document)')
+        op.execute("INSERT INTO post_search (post_id, document) "
+                   "SELECT id, setweight(to_tsvector('simple', title), 'A') || "
+                   "setweight(to_tsvector('simple', content), 'B') FROM posts")
+    # other databases use the in-process index, which is built on first use
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE IF EXISTS post_search')
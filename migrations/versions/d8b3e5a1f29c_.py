@@ -0,0 +1,62 @@
+"""content-addressed blob store
+
+Revision ID: d8b3e5a1f29c
+Revises: c41f8d2e6a17
+Create Date: 2026-10-18 16:07:12.318274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8b3e5a1f29c'
+down_revision = 'c41f8d2e6a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blobs',
+    sa.Column('hash', sa.String(length=64), nullable=False),
+    sa.Column('extension', sa.String(length=10), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('refcount', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('released_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('hash')
+    )
+    with op.batch_alter_table('blobs', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_blobs_released_at'), ['released_at'], unique=False)
+
+    # blob names are a SHA-256 and an extension
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('image_file', existing_type=sa.String(length=20), type_=sa.String(length=80),
+                              existing_nullable=False)
+
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.alter_column('image_post', existing_type=sa.String(length=30), type_=sa.String(length=80),
+                              existing_nullable=True)
+
+    # the name of a queued picture is only known once it is stored
+    with op.batch_alter_table('image_jobs', schema=None) as batch_op:
+        batch_op.alter_column('filename', existing_type=sa.String(length=100), nullable=True)
+
+
+def downgrade():
+    op.execute("UPDATE image_jobs SET filename = '' WHERE filename IS NULL")
+    with op.batch_alter_table('image_jobs', schema=None) as batch_op:
+        batch_op.alter_column('filename', existing_type=sa.String(length=100), nullable=False)
+
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.alter_column('image_post', existing_type=sa.String(length=80), type_=sa.String(length=30),
+                              existing_nullable=True)
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('image_file', existing_type=sa.String(length=80), type_=sa.String(length=20),
+                              existing_nullable=False)
+
+    with op.batch_alter_table('blobs', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_blobs_released_at'))
+
+    op.drop_table('blobs')
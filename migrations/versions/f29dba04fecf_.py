@@ -0,0 +1,56 @@
+"""indexes for the listing, comment, tag and like lookups
+
+Revision ID: f29dba04fecf
+Revises: 98bc81fea7fc
+Create Date: 2026-10-18 11:02:19.731655
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f29dba04fecf'
+down_revision = '98bc81fea7fc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.create_index('ix_posts_date_posted_id', ['date_posted', 'id'], unique=False)
+        batch_op.create_index('ix_posts_category_date_posted_id', ['category', 'date_posted', 'id'], unique=False)
+        batch_op.create_index('ix_posts_user_id_date_posted_id', ['user_id', 'date_posted', 'id'], unique=False)
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.create_index('ix_comments_post_id_date_posted', ['post_id', 'date_posted'], unique=False)
+
+    with op.batch_alter_table('tags', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_tags_name'), ['name'], unique=False)
+        batch_op.create_index(batch_op.f('ix_tags_post_id'), ['post_id'], unique=False)
+
+    with op.batch_alter_table('post_likes', schema=None) as batch_op:
+        batch_op.create_index('ix_post_likes_post_id', ['post_id'], unique=False)
+
+    with op.batch_alter_table('comment_likes', schema=None) as batch_op:
+        batch_op.create_index('ix_comment_likes_comment_id', ['comment_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('comment_likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_comment_likes_comment_id')
+
+    with op.batch_alter_table('post_likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_likes_post_id')
+
+    with op.batch_alter_table('tags', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tags_post_id'))
+        batch_op.drop_index(batch_op.f('ix_tags_name'))
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.drop_index('ix_comments_post_id_date_posted')
+
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_index('ix_posts_user_id_date_posted_id')
+        batch_op.drop_index('ix_posts_category_date_posted_id')
+        batch_op.drop_index('ix_posts_date_posted_id')
@@ -17,6 +17,48 @@ class Config(object):
 
     REMEMBER_COOKIE_DURATION = timedelta(seconds=60)
 
+    # 'numbered' pages with a total, or 'keyset' cursors on (date_posted, id) for large tables
+    PAGINATION_MODE = os.environ.get('PAGINATION_MODE', default='numbered')
+    # comments inlined in a post page; index.js fetches the rest in chunks of the same size
+    POST_COMMENTS_PER_PAGE = 20
+    # seconds between full recounts of the cached post totals
+    POST_COUNTS_RECONCILE_INTERVAL = 300
+
+    # post views are buffered and written in batches of this size, or every interval (seconds);
+    # an interval of 0 turns the background writer off
+    VIEW_COUNTER_FLUSH_SIZE = 100
+    VIEW_COUNTER_FLUSH_INTERVAL = 10
+    VIEW_COUNTER_ONCE_PER_SESSION = False
+
+    # 'auto' follows the database: FTS5 on SQLite, tsvector on PostgreSQL, otherwise 'memory'
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', default='auto')
+    SEARCH_POSTGRES_CONFIG = 'simple'
+
+    # uploaded pictures are resized by background workers; 0 workers leaves it to `flask images work`
+    IMAGE_QUEUE_WORKERS = 2
+    IMAGE_QUEUE_UPLOAD_FOLDER = os.path.join(basedir, 'instance', 'image_uploads')
+    IMAGE_QUEUE_EAGER = False
+    # request bodies over MAX_CONTENT_LENGTH get a 413; a single picture may be at most
+    # IMAGE_UPLOAD_MAX_BYTES and is rejected from its header if it has too many pixels
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    IMAGE_UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+    IMAGE_UPLOAD_MAX_SIDE = 10000
+    IMAGE_UPLOAD_MAX_PIXELS = 40000000
+    # every picture is also rendered at these widths in WebP, and AVIF where Pillow can write it
+    IMAGE_VARIANT_WIDTHS = {'profile_img': (64, 128, 360), 'post_images': (160, 320, 500)}
+    # pictures are stored once per content under <BLOB_STORE_FOLDER>/ in the media storage;
+    # unreferenced ones are deleted after the grace period (seconds)
+    BLOB_STORE_FOLDER = 'media'
+    BLOB_STORE_GC_GRACE = 300
+    # 'local' keeps the media files in the static folder, 's3' in a bucket of S3 or an
+    # S3-compatible service; without a public URL they are served through presigned redirects
+    MEDIA_STORAGE = os.environ.get('MEDIA_STORAGE', default='local')
+    MEDIA_S3_BUCKET = os.environ.get('MEDIA_S3_BUCKET')
+    MEDIA_S3_PREFIX = os.environ.get('MEDIA_S3_PREFIX', default='')
+    MEDIA_S3_ENDPOINT_URL = os.environ.get('MEDIA_S3_ENDPOINT_URL')
+    MEDIA_S3_REGION = os.environ.get('MEDIA_S3_REGION')
+    MEDIA_S3_PUBLIC_URL = os.environ.get('MEDIA_S3_PUBLIC_URL')
+
     MAIL_USERNAME = os.environ.get('EMAIL_USER')
     MAIL_PASSWORD = os.environ.get('EMAIL_PASS')
 
@@ -24,6 +66,27 @@ class Config(object):
     MAIL_PORT = 465
     MAIL_USE_TLS = False
     MAIL_USE_SSL = True
+    # mail is sent from the mail_outbox table by background senders, a batch per SMTP connection;
+    # 0 senders leaves it to `flask outbox send`
+    MAIL_OUTBOX_WORKERS = 1
+    MAIL_OUTBOX_BATCH_SIZE = 50
+    MAIL_OUTBOX_MAX_ATTEMPTS = 5
+
+    # bcrypt cost factor, stored hashes of another cost are redone at the next login;
+    # hashing runs in that many worker processes instead of the request thread when above 0
+    PASSWORD_HASH_ROUNDS = int(os.environ.get('PASSWORD_HASH_ROUNDS', default=12))
+    PASSWORD_HASH_PROCESSES = int(os.environ.get('PASSWORD_HASH_PROCESSES', default=0))
+    # the logged-in user is resolved from a per-process cache of USER_CACHE_TTL seconds,
+    # and from Redis when USER_CACHE_REDIS_URL is set
+    USER_CACHE_TTL = 5
+    USER_CACHE_REDIS_URL = os.environ.get('USER_CACHE_REDIS_URL')
+    # rendered parts of post pages; set FRAGMENT_CACHE_REDIS_URL when running more than one process
+    FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    FRAGMENT_CACHE_REDIS_URL = os.environ.get('FRAGMENT_CACHE_REDIS_URL')
+    # public pages for visitors without a session: fresh for PAGE_CACHE_TTL seconds,
+    # then served stale while they are rendered again in the background
+    PAGE_CACHE_TTL = 30
+    PAGE_CACHE_STALE_WHILE_REVALIDATE = 300
 
 
 class ProductionConfig(Config):
@@ -39,5 +102,10 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URI',
                                         default=f"sqlite:///{os.path.join(basedir, 'instance', 'test.db')}")
     WTF_CSRF_ENABLED = False
+    VIEW_COUNTER_FLUSH_INTERVAL = 0
+    IMAGE_QUEUE_EAGER = True
+    BLOB_STORE_GC_GRACE = 0
+    MAIL_OUTBOX_WORKERS = 0
+    PASSWORD_HASH_ROUNDS = 4
     JWT_HEADER_TYPE = 'Bearer '
     JWT_BLACKLIST_ENABLED = False
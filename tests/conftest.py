@@ -1,10 +1,11 @@
 import os
-import shutil
 import pytest
-from blog import create_app, db, bcrypt
+from blog import create_app, db
 from blog.models import User, Post, Comment, PostLike, CommentLike, Tag
+from blog.images import user_media_prefix
+from blog.passwords import password_hasher
+from blog.storage import storage
 from blog.user.utils import random_avatar
-from settings import UPLOAD_FOLDER
 from pathlib import Path
 
 resources = Path(__file__).parent / "resources"
@@ -48,11 +49,11 @@ def init_database(test_client):
     db.create_all()
 
     # Insert user data
-    default_user = User(username='Olena', email='fake24@gmail.com', password=bcrypt.generate_password_hash('12345qwert').decode('utf-8'),image_file=random_avatar('Olena'), role='admin')
-    second_user = User(username='Nana', email='patrick@yahoo.com', password=bcrypt.generate_password_hash('Flask').decode('utf-8'), image_file=random_avatar('Nana'), role='user')
-    third_user = User(username='Ivan', email='ivan@mail.com', password=bcrypt.generate_password_hash('Ivan777').decode('utf-8'), image_file=random_avatar('Ivan'),  role='user')
-    fourth_user = User(username='Eva', email='eva21@mail.com', password=bcrypt.generate_password_hash('Eva21').decode('utf-8'), image_file=random_avatar('Eva'), role='user')
-    fifth_user = User(username='Vika', email='vika@mail.com', password=bcrypt.generate_password_hash('Vika77').decode('utf-8'), image_file=random_avatar('Vika'), role='admin')
+    default_user = User(username='Olena', email='fake24@gmail.com', password=password_hasher.hash('12345qwert'),image_file=random_avatar('Olena'), role='admin')
+    second_user = User(username='Nana', email='patrick@yahoo.com', password=password_hasher.hash('Flask'), image_file=random_avatar('Nana'), role='user')
+    third_user = User(username='Ivan', email='ivan@mail.com', password=password_hasher.hash('Ivan777'), image_file=random_avatar('Ivan'),  role='user')
+    fourth_user = User(username='Eva', email='eva21@mail.com', password=password_hasher.hash('Eva21'), image_file=random_avatar('Eva'), role='user')
+    fifth_user = User(username='Vika', email='vika@mail.com', password=password_hasher.hash('Vika77'), image_file=random_avatar('Vika'), role='admin')
     db.session.add(default_user)
     db.session.add(second_user)
     db.session.add(third_user)
@@ -133,17 +134,14 @@ def init_database(test_client):
     db.session.commit()
 
     # Insert tag data
-    tag1 = Tag(name='tag 1', post_id=post1.id)
-    tag2 = Tag(name='tag 2', post_id=post1.id)
-    tag3 = Tag(name='tag 1', post_id=post2.id)
-    tag4= Tag(name='tag 2', post_id=post4.id)
-    tag5 = Tag(name='tag 3', post_id=post5.id)
-
-    db.session.add(tag1)
-    db.session.add(tag2)
-    db.session.add(tag3)
-    db.session.add(tag4)
-    db.session.add(tag5)
+    tag1 = Tag(name='tag 1')
+    tag2 = Tag(name='tag 2')
+    tag3 = Tag(name='tag 3')
+
+    post1.tags = [tag1, tag2]
+    post2.tags = [tag1]
+    post4.tags = [tag2]
+    post5.tags = [tag3]
 
     # Commit the changes for the tags
     db.session.commit()
@@ -152,9 +150,8 @@ def init_database(test_client):
     users = User.query.all()
     # users = [second_user, fourth_user]
     for user in users:
-        user_path = os.path.join(os.getcwd(), UPLOAD_FOLDER, user.username)
-        full_path = user_path.replace("\\", "/")
-        shutil.rmtree(full_path)
+        storage.delete_prefix(user_media_prefix(user.id))
+    storage.delete_prefix(test_client.application.config['BLOB_STORE_FOLDER'] + '/')
 
     db.drop_all()
 
@@ -201,6 +198,42 @@ def log_in_fifth_user(test_client):
     # Log out the user
     test_client.get('/logout')
 
+
+@pytest.fixture(scope='function')
+def s3_storage(test_client):
+    # the media storage switched to a bucket on a local S3 stand-in
+    boto3 = pytest.importorskip('boto3')
+    from blog.storage import S3Storage
+    from tests.s3 import S3StandIn
+
+    server = S3StandIn().start()
+    client = boto3.client('s3', endpoint_url=server.endpoint_url, region_name='us-east-1',
+                          aws_access_key_id='test', aws_secret_access_key='test')
+    previous = storage.backend
+    storage.backend = S3Storage(client, 'blog-media', prefix='site/')
+    try:
+        yield server
+    finally:
+        storage.backend = previous
+        server.stop()
+
+@pytest.fixture(scope='function')
+def smtp_server(test_client):
+    # Flask-Mail pointed at a local SMTP stand-in instead of the real relay
+    from blog import mail
+    from tests.smtp import SMTPStandIn
+
+    server = SMTPStandIn().start()
+    extensions = test_client.application.extensions
+    previous = extensions['mail']
+    extensions['mail'] = mail.init_mail({'MAIL_SERVER': server.host, 'MAIL_PORT': server.port,
+                                         'MAIL_SUPPRESS_SEND': False})
+    try:
+        yield server
+    finally:
+        extensions['mail'] = previous
+        server.stop()
+
 # @pytest.fixture(scope='module')
 # def cli_test_client():
 #     # Set the Testing configuration prior to creating the Flask application
@@ -0,0 +1,153 @@
+"""
+This file (test_api_routes.py) contains the functional tests for the `api` blueprint.
+
+These tests use GETs to the /api/v1 URLs to check the JSON they return.
+"""
+from sqlalchemy import event
+
+from blog import db
+from blog.models import Post, Comment, Tag
+
+
+def test_api_list_posts(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN '/api/v1/posts' is requested (GET) page by page
+    THEN check every post comes once, newest first, with the listing fields
+    """
+    response = test_client.get('/api/v1/posts', query_string=dict(limit=2))
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert list(response.json['items'][0]) == ['id', 'slug', 'title', 'category', 'date_posted', 'author', 'image',
+                                               'like_count']
+
+    items = response.json['items']
+    while response.json['next_cursor']:
+        response = test_client.get('/api/v1/posts', query_string=dict(limit=2, cursor=response.json['next_cursor']))
+        assert len(response.json['items']) <= 2
+        items += response.json['items']
+
+    posts = Post.query.order_by(Post.date_posted.desc(), Post.id.desc()).all()
+    assert [item['slug'] for item in items] == [post.slug for post in posts]
+    title_1 = next(item for item in items if item['slug'] == 'title-1')
+    assert title_1['author'] == 'Olena'
+    assert title_1['image'].endswith('1.jpg')
+
+    response = test_client.get('/api/v1/posts', query_string=dict(category='Skincare', fields='slug'))
+    assert sorted(item['slug'] for item in response.json['items']) == ['title-2', 'title-4']
+    response = test_client.get('/api/v1/posts', query_string=dict(author='Nana', fields='slug'))
+    assert response.json['items'] == [{'slug': 'title-3'}]
+
+
+def test_api_sparse_fieldsets(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN '/api/v1/posts' is requested (GET) with ?fields=
+    THEN check only the requested columns are read and returned
+    """
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        response = test_client.get('/api/v1/posts', query_string=dict(fields='title,slug'))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    assert response.status_code == 200
+    assert all(list(item) == ['title', 'slug'] for item in response.json['items'])
+    assert len(statements) == 1
+    assert 'posts.content' not in statements[0]
+    assert 'users' not in statements[0]
+
+    response = test_client.get('/api/v1/posts', query_string=dict(fields='title,password'))
+    assert response.status_code == 400
+    assert 'password' in response.json['error']
+
+
+def test_api_get_post(test_client, init_database, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN '/api/v1/posts/<slug>' is requested (GET)
+    THEN check the post comes with its content, and an unknown slug is a JSON 404
+    """
+    response = test_client.get('/api/v1/posts/title-2')
+    assert response.status_code == 200
+    assert response.json['title'] == 'Title 2'
+    assert response.json['content'] == 'Content 2'
+    assert response.json['author'] == 'Olena'
+
+    response = test_client.get('/api/v1/posts/no-such-post')
+    assert response.status_code == 404
+    assert response.json == {'error': 'No such post.'}
+
+    response = test_client.get('/api/v1/posts', query_string=dict(category='Skincare', fields='slug,content'))
+    assert response.status_code == 200
+    assert {'slug': 'title-2', 'content': 'Content 2'} in response.json['items']
+
+
+def test_api_list_comments_and_tags(test_client, init_database, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the comments of a post and the tags are requested (GET)
+    THEN check the comments come newest first through cursors and the tags with their post counts
+    """
+    response = test_client.get('/api/v1/posts/title-1/comments', query_string=dict(limit=1, fields='body'))
+    assert response.status_code == 200
+    bodies = [item['body'] for item in response.json['items']]
+    response = test_client.get('/api/v1/posts/title-1/comments',
+                               query_string=dict(limit=1, fields='body', cursor=response.json['next_cursor']))
+    bodies += [item['body'] for item in response.json['items']]
+    assert response.json['next_cursor'] is None
+
+    post = Post.query.filter_by(slug='title-1').first()
+    comments = Comment.query.filter_by(post_id=post.id) \
+        .order_by(Comment.date_posted.desc(), Comment.id.desc()).all()
+    assert bodies == [comment.body for comment in comments]
+
+    response = test_client.get('/api/v1/tags')
+    assert response.status_code == 200
+    tags = {item['name']: item['post_count'] for item in response.json['items']}
+    assert tags == {tag.name: len(tag.posts) for tag in Tag.query.all()}
+
+
+def test_api_etags(test_client, init_database, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN an API URL is requested (GET) again with the ETag of the first response
+    THEN check it is answered with 304
+    """
+    response = test_client.get('/api/v1/posts/title-2')
+    etag = response.headers['ETag']
+
+    response = test_client.get('/api/v1/posts/title-2', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    response = test_client.get('/api/v1/posts/title-2', query_string=dict(fields='title'),
+                               headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+def test_api_post_and_comments_need_login(test_client, init_database):
+    """
+    GIVEN a client that is not logged in
+    WHEN a post or its comments are requested (GET) from the API
+    THEN check both are refused with a JSON 401, like the post page, while listings stay open
+    """
+    for url in ('/api/v1/posts/title-1', '/api/v1/posts/title-1/comments'):
+        response = test_client.get(url)
+        assert response.status_code == 401
+        assert response.json == {'error': 'Log in to read posts and comments.'}
+        assert b'Content 1' not in response.data
+
+    assert test_client.get('/api/v1/posts').status_code == 200
+    assert test_client.get('/api/v1/tags').status_code == 200
+
+    # a listing does not hand out the bodies either
+    response = test_client.get('/api/v1/posts', query_string=dict(fields='slug,content'))
+    assert response.status_code == 401
+    assert response.json == {'error': 'Log in to read posts and comments.'}
+    assert b'Content 1' not in response.data
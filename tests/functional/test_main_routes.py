@@ -4,8 +4,16 @@ This file (test_main_routes.py) contains the functional tests for the `main` blu
 These tests use GETs and POSTs to different URLs to check for the proper behavior
 of the `main` blueprint.
 """
+import gzip
+import re
+from datetime import datetime
+
+from sqlalchemy import event
+
 from blog import db
-from blog.models import Post
+from blog.counts import post_counts
+from blog.models import Post, User
+from blog.page_cache import page_cache
 
 
 def test_index_page(test_client):
@@ -50,10 +58,11 @@ def test_blog_first_page(test_client, init_database, log_in_default_user):
     assert b"Total articles:" in response.data
     assert b'Olena' in response.data
     assert b'Eva' in response.data
-    assert b'Title 1' in response.data
-    assert b'Title 2' in response.data
+    # newest first, and posts of the same moment by id, newest first
+    assert response.data.index(b'Title 5') < response.data.index(b'Title 4') \
+        < response.data.index(b'Title 3') < response.data.index(b'Title 2')
     assert b'Content 3' in response.data
-    assert b'Content 5' not in response.data
+    assert b'Title 1' not in response.data
     assert b'<a class="btn btn-info mb-4" href="/blog?page=1">1</a>' in response.data
     assert b'<a class="btn btn-outline-success mb-4" href="/blog?page=2">2</a>' in response.data
 
@@ -66,14 +75,179 @@ def test_blog_second_page(test_client, init_database, log_in_default_user):
     """
     response = test_client.get('/blog', query_string=dict(page="2"))
 
-    assert b'Eva' in response.data
+    assert b'Olena' in response.data
     assert response.status_code == 200
-    assert b'Title 5' in response.data
-    assert b'Content 5'in response.data
+    assert b'Title 1' in response.data
+    assert b'Content 1' in response.data
+    assert b'Title 5' not in response.data
     assert b'<a class="btn btn-info mb-4" href="/blog?page=2">2</a>' in response.data
     assert b'<a class="btn btn-outline-success mb-4" href="/blog?page=1">1</a>' in response.data
 
 
+def test_blog_page_query_count(test_client, init_database, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/blog' page is requested (GET)
+    THEN check the page is built with a fixed number of queries, whatever the number of authors and posts
+    """
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        response = test_client.get('/blog')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    assert response.status_code == 200
+    assert b'Olena</a>(2)' in response.data
+    assert b'Eva</a>(2)' in response.data
+    assert b'Nana</a>(1)' in response.data
+    assert b'Ivan</a>' not in response.data
+
+    # current user, page total, page of posts with authors, per-author counts
+    assert len(statements) <= 4
+
+
+def test_blog_page_conditional_get(test_client, init_database, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/blog' page is requested (GET) again with the ETag of the first response
+    THEN check it is answered with 304 without a query, until a post changes
+    """
+    # the first page after logging in shows a flash message and is not tagged
+    response = test_client.get('/blog')
+    assert 'ETag' not in response.headers
+    response = test_client.get('/blog')
+    etag = response.headers['ETag']
+    assert 'no-cache' in response.headers['Cache-Control']
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        response = test_client.get('/blog', headers={'If-None-Match': etag})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    assert response.status_code == 304
+    assert response.data == b''
+    assert statements == []
+
+    # another page has another tag
+    response = test_client.get('/blog', query_string=dict(page=2), headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+    post = Post.query.filter_by(title='Title 5').first()
+    try:
+        post.title = 'Title 5 edited'
+        db.session.commit()
+        response = test_client.get('/blog', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+    finally:
+        post.title = 'Title 5'
+        db.session.commit()
+
+
+def test_blog_keyset_pages(test_client, init_database, log_in_default_user):
+    """
+    GIVEN a Flask application configured for keyset pagination
+    WHEN the '/blog' pages are followed through their cursors (GET)
+    THEN check every article is shown once, newest first, and the cursors lead back
+    """
+    test_client.application.config['PAGINATION_MODE'] = 'keyset'
+    try:
+        response = test_client.get('/blog')
+        assert response.status_code == 200
+        assert b'Newer</a>' not in response.data
+        assert b'href="/blog?page=' not in response.data
+        assert b'Title 5' in response.data
+        assert b'Title 1' not in response.data
+
+        older = re.search(rb'href="(/blog\?cursor=[^"]+)">Older', response.data).group(1).decode()
+        response = test_client.get(older)
+        assert response.status_code == 200
+        assert b'Title 1' in response.data
+        assert b'Title 5' not in response.data
+        assert b'Older</a>' not in response.data
+
+        newer = re.search(rb'href="(/blog\?cursor=[^"]+)">Newer', response.data).group(1).decode()
+        response = test_client.get(newer)
+        assert response.status_code == 200
+        assert b'Title 5' in response.data
+        assert b'Title 2' in response.data
+        assert b'Title 1' not in response.data
+        assert b'Newer</a>' not in response.data
+
+        # a cursor that cannot be decoded is a missing page
+        response = test_client.get('/blog', query_string=dict(cursor='not-a-cursor'))
+        assert response.status_code == 404
+    finally:
+        test_client.application.config['PAGINATION_MODE'] = 'numbered'
+
+
+def test_post_counts_follow_commits(test_client, init_database, log_in_default_user):
+    """
+    GIVEN the cached post totals
+    WHEN posts are created, deleted, or written behind the ORM's back
+    THEN check committed changes adjust the totals and a reconcile fixes the drift
+    """
+    post_counts.reconcile()
+    total = post_counts.get(('all',))
+    skincare = post_counts.get(('category', 'Skincare'))
+
+    post = Post(title='Counted', content='Counted', category='Skincare', slug='counted', user_id=1)
+    db.session.add(post)
+    db.session.flush()
+    assert post_counts.get(('all',)) == total    # nothing is counted before the commit
+    db.session.commit()
+    assert post_counts.get(('all',)) == total + 1
+    assert post_counts.get(('category', 'Skincare')) == skincare + 1
+
+    response = test_client.get('/blog')
+    assert f'Total articles: {total + 1}'.encode() in response.data
+
+    db.session.delete(post)
+    db.session.commit()
+    assert post_counts.get(('all',)) == total
+    assert post_counts.get(('category', 'Skincare')) == skincare
+
+    # a bulk insert skips the session hooks until the next reconcile
+    db.session.execute(Post.__table__.insert().values(title='Bulk', content='Bulk', category='Skincare',
+                                                      slug='bulk', user_id=1, date_posted=post.date_posted))
+    db.session.commit()
+    assert post_counts.get(('all',)) == total
+    post_counts.reconcile()
+    assert post_counts.get(('all',)) == total + 1
+
+    # a bulk delete, of posts or of their author, drops the cached totals at once
+    db.session.execute(Post.__table__.delete().where(Post.slug == 'bulk'))
+    db.session.commit()
+    assert post_counts.get(('all',)) == total
+    assert post_counts.get(('category', 'Skincare')) == skincare
+
+    db.session.execute(Post.__table__.insert().values(title='Bulk', content='Bulk', category='Skincare',
+                                                      slug='bulk', user_id=1, date_posted=post.date_posted))
+    db.session.commit()
+    Post.query.filter_by(slug='bulk').delete()
+    db.session.commit()
+    assert post_counts.get(('all',)) == total
+    assert post_counts.get(('author', 1)) == Post.query.filter_by(user_id=1).count()
+
+    user = User(username='Counted', email='counted@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    post_counts.get(('all',))
+    db.session.delete(user)
+    db.session.commit()
+    assert ('all',) not in post_counts._counts
+
+
 def test_blog_no_articles_yet(test_client, log_in_default_user):
     """
     GIVEN a Flask application configured for testing
@@ -110,3 +284,187 @@ def test_category_page(test_client):
     assert b'Content 5' in response.data
     assert b"Skincare" not in response.data
 
+
+
+def test_category_page_cached_for_anonymous_visitors(test_client):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/category/Cosmetics novelty/' page is requested (GET) by a visitor without a session
+    THEN check repeated and conditional requests are answered from the page cache
+    """
+    page_cache.clear()
+    response = test_client.get('/category/Cosmetics novelty/')
+    assert response.status_code == 200
+    assert response.headers['X-Page-Cache'] == 'MISS'
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        response = test_client.get('/category/Cosmetics novelty/')
+        assert response.headers['X-Page-Cache'] == 'HIT'
+        assert b'Title 5' in response.data
+        response = test_client.get('/category/Cosmetics novelty/', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        response = test_client.get('/category/Cosmetics novelty/', headers={'If-Modified-Since': last_modified})
+        assert response.status_code == 304
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    assert statements == []
+
+    # another query string is another page
+    response = test_client.get('/category/Cosmetics novelty/', query_string=dict(page=1))
+    assert response.headers['X-Page-Cache'] == 'MISS'
+
+    # a committed change drops the cached pages
+    post = Post.query.filter_by(title='Title 5').first()
+    try:
+        post.title = 'Title 5 edited'
+        db.session.commit()
+        response = test_client.get('/category/Cosmetics novelty/', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['X-Page-Cache'] == 'MISS'
+        assert b'Title 5 edited' in response.data
+    finally:
+        post.title = 'Title 5'
+        db.session.commit()
+
+    # what a login or a logout writes to the user shows on no page and keeps them
+    test_client.get('/category/Cosmetics novelty/')
+    user = User.query.filter_by(username='Eva').first()
+    password = user.password
+    try:
+        user.last_seen = datetime.utcnow()
+        user.password = 'a rehashed password'
+        db.session.commit()
+        assert test_client.get('/category/Cosmetics novelty/').headers['X-Page-Cache'] == 'HIT'
+
+        user.username = 'Eva edited'
+        db.session.commit()
+        response = test_client.get('/category/Cosmetics novelty/')
+        assert response.headers['X-Page-Cache'] == 'MISS'
+        assert b'Eva edited' in response.data
+    finally:
+        user.username, user.password = 'Eva', password
+        db.session.commit()
+
+    """
+    GIVEN a cached page older than PAGE_CACHE_TTL
+    WHEN it is requested (GET)
+    THEN check the stale page is served at once and rendered again in the background
+    """
+    test_client.get('/category/Cosmetics novelty/')
+    test_client.application.config['PAGE_CACHE_TTL'] = 0
+    try:
+        response = test_client.get('/category/Cosmetics novelty/')
+        assert response.headers['X-Page-Cache'] == 'STALE'
+        assert b'Title 5' in response.data
+        page_cache.wait()
+    finally:
+        test_client.application.config['PAGE_CACHE_TTL'] = 30
+    response = test_client.get('/category/Cosmetics novelty/')
+    assert response.headers['X-Page-Cache'] == 'HIT'
+    assert b'Title 5' in response.data
+
+
+def test_category_page_not_cached_for_users(test_client, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/category/Cosmetics novelty/' page is requested (GET) by a logged-in user
+    THEN check the page is rendered for them
+    """
+    response = test_client.get('/category/Cosmetics novelty/')
+    assert response.status_code == 200
+    assert 'X-Page-Cache' not in response.headers
+
+
+def test_category_pages(test_client, init_database, log_in_default_user):
+    """
+    GIVEN a category with more articles than fit on one page
+    WHEN both category routes are requested, numbered and through keyset cursors (GET)
+    THEN check each page holds ten articles with their authors, built with a fixed number of queries
+    """
+    posts = [Post(title=f'Many {number}', content=f'Many content {number}', category='Many', slug=f'many-{number}',
+                  user_id=1, date_posted=datetime(2024, 1, number + 1)) for number in range(11)]
+    db.session.add_all(posts)
+    db.session.commit()
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    try:
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            response = test_client.get('/category/Many/')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        assert response.status_code == 200
+        assert b'Many 10' in response.data
+        assert b'Many 0<' not in response.data
+        assert b'Olena' in response.data
+        assert b'href="/category/Many/?page=2"' in response.data
+        # current user, page total, page of posts with authors
+        assert len(statements) <= 3
+
+        response = test_client.get('/posts/Many/', query_string=dict(page=2))
+        assert response.status_code == 200
+        assert b'Many 0<' in response.data
+        assert b'Many 1<' not in response.data
+
+        test_client.application.config['PAGINATION_MODE'] = 'keyset'
+        response = test_client.get('/posts/Many/')
+        older = re.search(rb'href="(/posts/Many/\?cursor=[^"]+)">Older', response.data).group(1).decode()
+        response = test_client.get(older)
+        assert response.status_code == 200
+        assert b'Many 0<' in response.data
+        assert b'Older</a>' not in response.data
+    finally:
+        test_client.application.config['PAGINATION_MODE'] = 'numbered'
+        for post in posts:
+            db.session.delete(post)
+        db.session.commit()
+
+
+def test_static_files_are_fingerprinted(test_client):
+    """
+    GIVEN the static asset pipeline
+    WHEN a page and the stylesheet it links are requested (GET), before and after `flask assets build`
+    THEN check the stylesheet URL carries its content hash and is cached for a year, compressed when accepted
+    """
+    response = test_client.get('/')
+    url = re.search(rb'href="(/static/css/style\.[0-9a-f]{12}\.css)"', response.data).group(1).decode()
+
+    response = test_client.get(url)
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    stylesheet = response.data
+
+    # a fingerprint of an older version still gets the file, but not for a year
+    response = test_client.get('/static/css/style.000000000000.css')
+    assert response.status_code == 200
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+
+    config = test_client.application.config
+    result = test_client.application.test_cli_runner().invoke(args=['assets', 'build'])
+    config['DEBUG'] = False
+    try:
+        assert result.exit_code == 0
+        response = test_client.get('/')
+        assert url.encode() in response.data
+
+        response = test_client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+        assert gzip.decompress(response.data) == stylesheet
+    finally:
+        config['DEBUG'] = True
+        test_client.application.test_cli_runner().invoke(args=['assets', 'clean'])
@@ -4,10 +4,30 @@ This file (test_user_routes.py) contains the functional tests for the `posts` bl
 These tests use GETs and POSTs to different URLs to check for the proper behavior
 of the `posts` blueprint.
 """
+import io
+import os
+import re
+import struct
+import zlib
+from datetime import datetime
+
+import pytest
+from PIL import Image
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+
 from tests.conftest import resources
-from blog.models import Post, Tag, Comment, PostLike, CommentLike
+from blog.models import Post, Tag, Comment, PostLike, CommentLike, ImageJob, Blob, User, post_tags
 from flask import url_for
+from blog import db
 from blog.errors import handlers
+from blog.counts import post_counts
+from blog.fragments import fragment_cache
+from blog.blobs import blob_store
+from blog.images import image_queue
+from blog.search import fts5_available, post_search
+from blog.storage import storage
+from blog.view_counter import view_counter
 
 
 def test_new_post_page(test_client, init_database, log_in_fourth_user):
@@ -37,7 +57,7 @@ def test_new_post_valid_with_image_and_one_tag(test_client, init_database, log_i
 
     post = Post.query.filter_by(title='Title 6').first()
     post_id = post.id
-    tag = Tag.query.filter_by(post_id=post_id).first()
+    tag = Tag.query.filter(Tag.posts.any(id=post_id)).first()
     image = post.image_post
 
     assert response.status_code == 200
@@ -52,7 +72,7 @@ def test_new_post_valid_with_image_and_one_tag(test_client, init_database, log_i
     assert tag is not None
     assert image is not None
     assert Post.query.count() == 6
-    assert Tag.query.filter_by(post_id=post_id).count() == 1
+    assert Tag.query.filter(Tag.posts.any(id=post_id)).count() == 1
 
     # make sure a slug was created and added in the database
     slug = post.slug
@@ -88,7 +108,7 @@ def test_new_post_valid_with_image_and_with_two_tags(test_client, log_in_default
     assert image is not None
     assert image.encode() in response.data
     assert Post.query.count() == 7
-    assert Tag.query.filter_by(post_id=post_id).count() == 2
+    assert Tag.query.filter(Tag.posts.any(id=post_id)).count() == 2
 
     # make sure a slug was created and added in the database
     slug = post.slug
@@ -118,7 +138,7 @@ def test_new_post_valid_without_image_and_any_tags(test_client, init_database,
     assert post is not None
     assert post.image_post is None
     assert Post.query.count() == 8
-    assert Tag.query.filter_by(post_id=post_id).count() == 0
+    assert Tag.query.filter(Tag.posts.any(id=post_id)).count() == 0
 
     # make sure a slug was created and added into the database
     slug = post.slug
@@ -195,7 +215,7 @@ def test_post_page(test_client, log_in_fourth_user):
 
     post = Post.query.filter_by(title='Title 6').first()
     post_id = post.id
-    tag = Tag.query.filter_by(post_id=post_id).first()
+    tag = Tag.query.filter(Tag.posts.any(id=post_id)).first()
     tag_name = tag.name
     image = post.image_post
 
@@ -211,6 +231,131 @@ def test_post_page(test_client, log_in_fourth_user):
     assert b'Delete' in response.data
 
 
+def test_post_page_like_state(test_client, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/post/title-2' page is requested (GET)
+    THEN check the like state of the post and its comments comes from one query per like table
+    """
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        response = test_client.get('/post/title-2')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    assert response.status_code == 200
+    # the post is liked by Eva only, its comment by the current user
+    assert b'<i class="fa-regular fa-heart" id="like-button-2"' in response.data
+    assert b'<span id="likes-count-2">1</span>' in response.data
+    assert b'<i class="fa-solid fa-heart" id="comment-like-button-4"' in response.data
+    assert b'<span id="comment-likes-count-4">1</span>' in response.data
+
+    assert len([statement for statement in statements if 'post_likes' in statement]) == 1
+    assert len([statement for statement in statements if 'comment_likes' in statement]) == 1
+
+
+def test_post_page_fragments_follow_changes(test_client, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/post/title-2' page is requested (GET) again, and after its rows change
+    THEN check the second request reuses the rendered article, tags and comments and a change shows at once
+    """
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    test_client.get('/post/title-2')
+    hits = fragment_cache.hits
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        response = test_client.get('/post/title-2')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    assert response.status_code == 200
+    assert fragment_cache.hits == hits + 4
+    # only the like counts are read, not the comments, tags or the author
+    assert not [statement for statement in statements if 'comments.body' in statement]
+    assert not [statement for statement in statements if 'FROM tags' in statement]
+    assert not [statement for statement in statements if 'FROM users' in statement]
+
+    post = Post.query.filter_by(slug='title-2').first()
+    comment = Comment.query.filter_by(post_id=post.id).first()
+    body, title = comment.body, post.title
+    try:
+        comment.body = 'A fresh comment body'
+        post.title = 'A fresh title'
+        db.session.commit()
+        response = test_client.get('/post/title-2')
+        assert b'A fresh comment body' in response.data
+        assert b'A fresh title' in response.data
+    finally:
+        comment.body = body
+        post.title = title
+        db.session.commit()
+
+    response = test_client.get('/post/title-2')
+    assert body.encode() in response.data
+    assert b'A fresh title' not in response.data
+
+    """
+    GIVEN a Flask application with the fragment cache disabled
+    WHEN the '/post/title-2' page is requested (GET)
+    THEN check it is rendered from the database
+    """
+    hits, misses = fragment_cache.hits, fragment_cache.misses
+    test_client.application.config['FRAGMENT_CACHE_ENABLED'] = False
+    try:
+        response = test_client.get('/post/title-2')
+    finally:
+        test_client.application.config['FRAGMENT_CACHE_ENABLED'] = True
+    assert response.status_code == 200
+    assert (fragment_cache.hits, fragment_cache.misses) == (hits, misses)
+
+
+def test_post_page_conditional_get(test_client, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/post/title-2' page is requested (GET) again with the ETag of the first response
+    THEN check it is answered with 304 without rendering, until its likes or comments change
+    """
+    # the first page after logging in shows a flash message and is not tagged
+    response = test_client.get('/post/title-2')
+    assert 'ETag' not in response.headers
+    response = test_client.get('/post/title-2')
+    etag = response.headers['ETag']
+    post = Post.query.filter_by(slug='title-2').first()
+    comment = Comment.query.filter_by(post_id=post.id).first()
+
+    view_counter.flush()
+    hits, misses = fragment_cache.hits, fragment_cache.misses
+    response = test_client.get('/post/title-2', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert (fragment_cache.hits, fragment_cache.misses) == (hits, misses)
+    # the revalidation still counts as a view
+    assert view_counter.pending(post.id) == 1
+
+    for like in (f'/like-comment/{comment.id}', f'/like-comment/{comment.id}'):
+        test_client.post(like)
+        response = test_client.get('/post/title-2', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+    test_client.post('/post/title-2', data={'body': 'A comment for the ETag'})
+    response = test_client.get('/post/title-2', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'A comment for the ETag' in response.data
+
+    Comment.query.filter_by(body='A comment for the ETag').delete()
+    db.session.commit()
+    view_counter.flush()
+
+
 def test_post_add_tags_valid(test_client, log_in_default_user):
     """
         GIVEN a Flask application configured for testing
@@ -227,8 +372,9 @@ def test_post_add_tags_valid(test_client, log_in_default_user):
     assert b'Tag test' in response.data
 
     # make sure the tag is in the database
+    view_counter.flush()
     post = Post.query.filter_by(slug='title-8').first()
-    tags = Tag.query.filter_by(tag_post=post).all()
+    tags = post.tags
     tag = Tag.query.filter_by(name="Tag test").first()
 
     assert tags is not None
@@ -248,8 +394,9 @@ def test_post_add_tags_valid(test_client, log_in_default_user):
     assert b'third_one' in response.data
 
     # make sure the tag is in the database
+    view_counter.flush()
     post = Post.query.filter_by(slug='title-8').first()
-    tags = Tag.query.filter_by(tag_post=post).all()
+    tags = post.tags
     tag1 = Tag.query.filter_by(name="One more").first()
     tag2 = Tag.query.filter_by(name="second").first()
     tag3 = Tag.query.filter_by(name="third_one").first()
@@ -276,8 +423,9 @@ def test_post_add_tag_not_author_invalid(test_client, log_in_fourth_user):
     assert b'Tag no author' not in response.data
 
     # make sure the tag is NOT in the database
+    view_counter.flush()
     post = Post.query.filter_by(slug='title-8').first()
-    tags = Tag.query.filter_by(tag_post=post).all()
+    tags = post.tags
     tag = Tag.query.filter_by(name="Tag no author").first()
 
     assert tag is None
@@ -300,6 +448,7 @@ def test_post_add_comment_valid(test_client, log_in_fourth_user):
     assert b'I added new comment' in response.data
 
     # make sure the comment is in the database
+    view_counter.flush()
     post = Post.query.filter_by(slug='title-7').first()
     comments = Comment.query.filter_by(comment_post=post).all()
     comment = Comment.query.filter_by(body="I added new comment").first()
@@ -315,6 +464,7 @@ def test_search_page(test_client):
     WHEN the '/post/search' page is requested (GET)
     THEN check the response is valid
     """
+    view_counter.flush()
     post = Post.query.filter_by(slug='title-1').first()
     comments = Comment.query.filter_by(comment_post=post).all()
 
@@ -323,12 +473,101 @@ def test_search_page(test_client):
     assert b'Olena' in response.data
     assert b'Eva' not in response.data
     assert b'Title 1' in response.data
-    assert b'Content 1' in response.data
+    assert b'Content <mark>1</mark>' in response.data
     assert b'Views 1 | 2 Comments' in response.data
     assert len(comments) == 2
     assert post.views == 1
 
 
+@pytest.mark.parametrize('backend', ['auto', 'memory'])
+def test_search_follows_post_changes(test_client, log_in_default_user, backend):
+    """
+    GIVEN a search backend
+    WHEN posts are created, renamed and deleted
+    THEN check the search results follow every committed change, ranked and paginated
+    """
+    test_client.application.config['SEARCH_BACKEND'] = backend
+    posts = [Post(title=f'Searchable {number}', content='zebra ' * number + 'grass ' * (12 - number) + 'savanna', category='Search',
+                  slug=f'searchable-{number}', user_id=1) for number in range(1, 13)]
+    try:
+        post_search.rebuild()
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # the more often a term occurs in a post of the same length, the higher it ranks
+        results = post_search.search('Zebra savanna', per_page=10)
+        assert results.total == 12
+        assert [hit.post.slug for hit in results.items][:2] == ['searchable-12', 'searchable-11']
+        assert results.has_next and not results.has_prev
+
+        response = test_client.get('/post/search', query_string=dict(q='zebra', page=2))
+        assert response.status_code == 200
+        assert b'Searchable 1<' in response.data
+        assert b'Searchable 12<' not in response.data
+        assert b'<mark>zebra</mark>' in response.data
+        assert b'Previous</a>' in response.data
+        assert b'Next</a>' not in response.data
+
+        posts[0].title = 'Renamed giraffe'
+        db.session.commit()
+        assert [hit.post.id for hit in post_search.search('giraffe').items] == [posts[0].id]
+        assert post_search.search('searchable').total == 11
+
+        db.session.delete(posts[1])
+        db.session.commit()
+        posts.pop(1)
+        assert post_search.search('zebra').total == 11
+        assert post_search.search('').total == 0
+        # 'auto' probes SQLite for FTS5 once per process, not per search or flush
+        assert fts5_available.cache_info().misses <= 1
+    finally:
+        for post in posts:
+            db.session.delete(post)
+        db.session.commit()
+        test_client.application.config['SEARCH_BACKEND'] = 'auto'
+        post_search.rebuild()
+
+
+def test_post_views_are_buffered(test_client, log_in_second_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/post/title-3' page is requested (GET) several times
+    THEN check the views are shown at once but written to the database in one batch
+    """
+    view_counter.flush()
+    post = Post.query.filter_by(slug='title-3').first()
+    views_before = post.views
+
+    for views in range(views_before + 1, views_before + 4):
+        response = test_client.get('/post/title-3')
+        assert response.status_code == 200
+        assert f'&#128065;{views}<'.encode() in response.data
+
+    # the requests did not write anything
+    db.session.expire(post)
+    assert post.views == views_before
+    assert view_counter.pending(post.id) == 3
+
+    view_counter.flush()
+    db.session.expire(post)
+    assert post.views == views_before + 3
+    assert view_counter.pending(post.id) == 0
+
+    """
+    GIVEN a Flask application that counts one view per session
+    WHEN the '/post/title-3' page is requested (GET) twice
+    THEN check only the first view is counted
+    """
+    test_client.application.config['VIEW_COUNTER_ONCE_PER_SESSION'] = True
+    try:
+        test_client.get('/post/title-3')
+        test_client.get('/post/title-3')
+    finally:
+        test_client.application.config['VIEW_COUNTER_ONCE_PER_SESSION'] = False
+    assert view_counter.pending(post.id) == 1
+    view_counter.flush()
+
+
 def test_update_post_page(test_client, log_in_default_user):
     """
     GIVEN a Flask application configured for testing
@@ -567,6 +806,28 @@ def test_get_tag_page(test_client, log_in_fifth_user):
     assert b'Eva' in response.data
 
 
+def test_tag_shared_between_posts(test_client, log_in_default_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN a tag that another post already has is added to '/post/title-8' (POST)
+    THEN check both posts share one tag and are listed on its page
+    """
+    assert post_counts.get(('tag', 'tag 3')) == 1
+
+    response = test_client.post('/post/title-8', data=dict(tag_form="tag 3/ tag 3"), follow_redirects=True)
+    assert response.status_code == 200
+    assert b'The tag has been added to the post.' in response.data
+
+    tag = Tag.query.filter_by(name='tag 3').one()
+    assert sorted(post.slug for post in tag.posts) == ['title-8', 'title-new-5']
+    assert post_counts.get(('tag', 'tag 3')) == 2
+
+    response = test_client.get('/tags/tag 3')
+    assert response.status_code == 200
+    assert b'Title new 5' in response.data
+    assert b'Title 8' in response.data
+
+
 def test_delete_comment_invalid(test_client, log_in_fourth_user):
     """
         GIVEN a Flask application configured for testing
@@ -645,14 +906,14 @@ def test_delete_comment_by_admin_valid(test_client, log_in_default_user):
 def test_delete_tag_invalid(test_client, log_in_fifth_user):
     """
         GIVEN a Flask application configured for testing
-        WHEN the '/post/tag/20/delete' page is requested (GET)
+        WHEN the '/post/title-7/tag/20/delete' page is requested (GET)
         THEN check the response is valid
         """
     # try to delete non-existent tag
-    response = test_client.get('/post/tag/20/delete')
+    response = test_client.get('/post/title-7/tag/20/delete')
 
     assert response.status_code == 404
-    assert response.request.path == '/post/tag/20/delete'
+    assert response.request.path == '/post/title-7/tag/20/delete'
     assert len(response.history) == 0
     assert handlers.error_404(FileNotFoundError)[0].encode() in response.data
     assert b'Oops... Page not found!(404)' in response.data
@@ -660,14 +921,25 @@ def test_delete_tag_invalid(test_client, log_in_fifth_user):
 
     """
         GIVEN a Flask application configured for testing
-        WHEN the '/post/tag/7/delete' page is requested (GET)
+        WHEN the '/post/title-6/tag/5/delete' page is requested (GET)
+        THEN check the response is valid
+        """
+    # try to delete a tag the post does not have
+    response = test_client.get('/post/title-6/tag/5/delete')
+
+    assert response.status_code == 404
+    assert response.request.path == '/post/title-6/tag/5/delete'
+
+    """
+        GIVEN a Flask application configured for testing
+        WHEN the '/post/title-7/tag/5/delete' page is requested (GET)
         THEN check the response is valid
         """
     # try to delete a tag when the user is not the author
-    response = test_client.get('/post/tag/7/delete')
+    response = test_client.get('/post/title-7/tag/5/delete')
 
     assert response.status_code == 403
-    assert response.request.path == '/post/tag/7/delete'
+    assert response.request.path == '/post/title-7/tag/5/delete'
     assert len(response.history) == 0
     assert handlers.error_403(FileNotFoundError)[0].encode() in response.data
     assert b"You don't have permission to do that (403)" in response.data
@@ -677,11 +949,11 @@ def test_delete_tag_invalid(test_client, log_in_fifth_user):
 def test_delete_tag_valid(test_client, log_in_default_user):
     """
         GIVEN a Flask application configured for testing
-        WHEN the '/post/tag/7/delete' page is requested (GET)
+        WHEN the '/post/title-7/tag/5/delete' page is requested (GET)
         THEN check the response is valid
         """
 
-    response = test_client.get('/post/tag/7/delete', follow_redirects=True)
+    response = test_client.get('/post/title-7/tag/5/delete', follow_redirects=True)
 
     assert response.status_code == 200
     assert response.request.path == '/post/title-7'
@@ -690,10 +962,12 @@ def test_delete_tag_valid(test_client, log_in_default_user):
     assert b'Test1' not in response.data
 
     # check if the tag was deleted  from the database
+    # no other post uses 'Test1', so the tag itself is gone as well
     post = Post.query.filter_by(slug='title-7').first()
-    tag = Tag.query.filter_by(id=7).first()
+    tag = Tag.query.filter_by(name='Test1').first()
     assert post is not None
     assert tag is None
+    assert [tag.name for tag in post.tags] == ['Test2']
 
 
 def test_delete_post_invalid(test_client, log_in_fifth_user):
@@ -734,6 +1008,11 @@ def test_delete_post_valid(test_client, log_in_default_user):
         WHEN the '/post/title-7/delete' page is requested (GET)
         THEN check the response is valid
         """
+    post = Post.query.filter_by(slug='title-7').first()
+    post_id = post.id
+    # 'tag 1' is shared with other posts, 'Test2' is only on this one
+    post.tags.append(Tag.query.filter_by(name='tag 1').one())
+    db.session.commit()
 
     response = test_client.get('/post/title-7/delete', follow_redirects=True)
 
@@ -745,10 +1024,12 @@ def test_delete_post_valid(test_client, log_in_default_user):
     # check if the article is deleted with all their comments and tags from the database
     post = Post.query.filter_by(slug='title-7').first()
     comments = Comment.query.filter_by(comment_post=post).all()
-    tags = Tag.query.filter_by(tag_post=post).all()
+    tags = db.session.query(post_tags).filter_by(post_id=post_id).all()
     assert post is None
     assert len(comments) == 0
     assert len(tags) == 0
+    assert Tag.query.filter_by(name='Test2').first() is None
+    assert Tag.query.filter_by(name='tag 1').one().posts
 
 
 def test_like_invalid_no_article(test_client, log_in_fifth_user):
@@ -877,3 +1158,351 @@ def test_comment_unlike_valid(test_client, log_in_fifth_user):
 
 
 
+
+
+def test_like_toggle_keeps_counter(test_client, log_in_fifth_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the "/like-post/1" and "/like-comment/1" pages are posted to twice (POST)
+    THEN check the responses and the denormalized counters match the like rows
+    """
+    response = test_client.post("/like-post/1")
+    assert response.json == {"likes": PostLike.query.filter_by(post_id=1).count(), "liked": True}
+    response = test_client.post("/like-post/1")
+    assert response.json == {"likes": PostLike.query.filter_by(post_id=1).count(), "liked": False}
+    assert db.session.scalar(select(Post.like_count).where(Post.id == 1)) == \
+           PostLike.query.filter_by(post_id=1).count()
+
+    response = test_client.post("/like-comment/1")
+    assert response.json == {"likes": CommentLike.query.filter_by(comment_id=1).count(), "liked": True}
+    assert db.session.scalar(select(Comment.like_count).where(Comment.id == 1)) == \
+           CommentLike.query.filter_by(comment_id=1).count()
+    test_client.post("/like-comment/1")
+
+    # one like per user and post
+    db.session.add(PostLike(user_id=1, post_id=3))
+    with pytest.raises(IntegrityError):
+        db.session.commit()
+    db.session.rollback()
+
+
+def png_header(width, height):
+    # a PNG signature, header and end, without any pixel data
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IEND', b'')
+
+
+def test_post_image_is_processed_off_request(test_client, log_in_fourth_user):
+    """
+    GIVEN the image queue with no background workers
+    WHEN an article with a picture is published (POST) and the queue is worked
+    THEN check the page shows a placeholder until a worker swaps the resized picture in
+    """
+    config = test_client.application.config
+    config['IMAGE_QUEUE_EAGER'], config['IMAGE_QUEUE_WORKERS'], config['IMAGE_QUEUE_MAX_ATTEMPTS'] = False, 0, 1
+    try:
+        response = test_client.post('/post/new', data=dict(title='Queued picture', content='Queued', category='Skincare',
+                                                         picture=(resources/'7.png').open('rb')),
+                                    follow_redirects=True)
+        assert response.status_code == 200
+        assert b'The article was published!' in response.data
+        assert url_for('static', filename='img/processing.svg').encode() in response.data
+
+        post = Post.query.filter_by(slug='queued-picture').first()
+        job = ImageJob.query.filter_by(kind='post', target_id=post.id).one()
+        source = os.path.join(config['IMAGE_QUEUE_UPLOAD_FOLDER'], job.source)
+        assert post.image_post is None
+        assert post.image_processing
+        assert job.status == 'pending'
+        assert os.path.isfile(source)
+
+        assert image_queue.work() == 1
+        assert job.status == 'done'
+        assert post.image_post == job.filename
+        assert not post.image_processing
+        assert not os.path.exists(source)
+        assert storage.exists(blob_store.key(post.image_post))
+
+        response = test_client.get('/post/queued-picture')
+        assert post.image_post.encode() in response.data
+        assert url_for('static', filename='img/processing.svg').encode() not in response.data
+
+        # a picture whose header is fine but whose pixels are missing fails the job and drops the placeholder
+        response = test_client.post('/post/queued-picture/update',
+                                    data=dict(title='Queued picture', content='Queued', category='Skincare',
+                                              picture=(io.BytesIO(png_header(100, 100)), 'broken.png')),
+                                    follow_redirects=True)
+        assert response.status_code == 200
+        assert image_queue.work() == 1
+        job = ImageJob.query.filter_by(kind='post', target_id=post.id).order_by(ImageJob.id.desc()).first()
+        assert job.status == 'failed'
+        assert job.error
+        assert post.image_post != job.filename
+        assert not post.image_processing
+    finally:
+        config['IMAGE_QUEUE_EAGER'], config['IMAGE_QUEUE_WORKERS'], config['IMAGE_QUEUE_MAX_ATTEMPTS'] = True, 2, 3
+        post = Post.query.filter_by(slug='queued-picture').first()
+        if post is not None:
+            db.session.delete(post)
+            db.session.commit()
+
+
+def test_post_image_variants(test_client, log_in_fourth_user):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN an article with a picture is published, re-pictured and deleted
+    THEN check the smaller WebP variants are rendered, offered in srcset and removed with the picture
+    """
+    def picture(colour):
+        # pictures no other test uploads, so no other post shares their blobs
+        file = io.BytesIO()
+        Image.new('RGB', (800, 600), colour).save(file, 'PNG')
+        file.seek(0)
+        return file, 'variant.png'
+
+    response = test_client.post('/post/new', data=dict(title='Variant picture', content='Variants', category='Skincare',
+                                                     picture=picture((12, 34, 56))),
+                                follow_redirects=True)
+    assert response.status_code == 200
+    post = Post.query.filter_by(slug='variant-picture').first()
+    stem, _ = os.path.splitext(blob_store.key(post.image_post))
+    for width in (160, 320, 500):
+        assert storage.exists(f'{stem}-{width}.webp')
+
+    # the feed shows the picture 160px wide, so 1x and 2x screens get the 160 and 320 variants
+    url, _ = os.path.splitext(storage.url(blob_store.key(post.image_post)))
+    assert b'<source type="image/webp" srcset="' in response.data
+    assert f'{url}-160.webp 1x, {url}-320.webp 2x'.encode() in response.data
+    assert post.image_post.encode() in response.data
+
+    # older pictures get their variants from the backfill command
+    storage.delete(f'{stem}-320.webp')
+    result = test_client.application.test_cli_runner().invoke(args=['images', 'variants'])
+    assert result.exit_code == 0
+    assert storage.exists(f'{stem}-320.webp')
+
+    response = test_client.post('/post/variant-picture/update',
+                                data=dict(title='Variant picture', content='Variants', category='Skincare',
+                                          picture=picture((65, 43, 21))),
+                                follow_redirects=True)
+    assert response.status_code == 200
+    assert not storage.exists(f'{stem}.png')
+    assert not storage.exists(f'{stem}-160.webp')
+
+    stem, _ = os.path.splitext(blob_store.key(post.image_post))
+    response = test_client.post('/post/variant-picture/delete', follow_redirects=True)
+    assert response.status_code == 200
+    assert not storage.exists(f'{stem}.png')
+    assert not storage.exists(f'{stem}-160.webp')
+
+
+def test_post_picture_in_s3_storage(test_client, log_in_fourth_user, s3_storage):
+    """
+    GIVEN the media storage on an S3-compatible bucket
+    WHEN an article with a picture is published, shown and deleted
+    THEN check the picture and its variants go to the bucket, are linked through /media and leave with the post
+    """
+    file = io.BytesIO()
+    Image.new('RGB', (640, 480), (90, 120, 150)).save(file, 'PNG')
+    file.seek(0)
+    response = test_client.post('/post/new', data=dict(title='Bucket picture', content='S3', category='Skincare',
+                                                     picture=(file, 'bucket.png')),
+                                follow_redirects=True)
+    assert response.status_code == 200
+    post = Post.query.filter_by(slug='bucket-picture').first()
+    key = blob_store.key(post.image_post)
+    stem, _ = os.path.splitext(key)
+    assert f'site/{key}' in s3_storage.keys('blog-media')
+    assert f'site/{stem}-160.webp' in s3_storage.keys('blog-media')
+    body, headers = s3_storage.objects['blog-media', f'site/{key}']
+    assert headers['Content-Type'] == 'image/png'
+    assert 'immutable' in headers['Cache-Control']
+    assert f'/media/{stem}-160.webp 1x'.encode() in response.data
+
+    # without a public URL the application redirects to a presigned one
+    response = test_client.get(f'/media/{key}')
+    assert response.status_code == 302
+    assert response.location.startswith(f'{s3_storage.endpoint_url}/blog-media/site/{key}?')
+    assert 'Signature' in response.location
+
+    response = test_client.post('/post/bucket-picture/delete', follow_redirects=True)
+    assert response.status_code == 200
+    assert not [name for name in s3_storage.keys('blog-media') if name.startswith(f'site/{stem}')]
+
+
+def test_identical_pictures_share_a_blob(test_client, log_in_fourth_user):
+    """
+    GIVEN the content-addressed blob store
+    WHEN two articles are published with the same picture and then deleted one by one
+    THEN check the picture is stored once and only removed with its last reference
+    """
+    for title in ('Same picture one', 'Same picture two'):
+        response = test_client.post('/post/new', data=dict(title=title, content='Same', category='Skincare',
+                                                         picture=(resources/'43.jpg').open('rb')),
+                                    follow_redirects=True)
+        assert response.status_code == 200
+    first = Post.query.filter_by(slug='same-picture-one').first()
+    second = Post.query.filter_by(slug='same-picture-two').first()
+    assert first.image_post == second.image_post
+    name = first.image_post
+    blob = db.session.get(Blob, name.split('.')[0])
+    assert blob.refcount == 2
+    assert blob.released_at is None
+
+    # the stock avatars are shared the same way
+    for user in User.query.all():
+        avatar = db.session.get(Blob, user.image_file.split('.')[0])
+        assert avatar.refcount == User.query.filter_by(image_file=user.image_file).count()
+
+    test_client.post('/post/same-picture-one/delete', follow_redirects=True)
+    db.session.refresh(blob)
+    assert blob.refcount == 1
+    assert storage.exists(blob_store.key(name))
+
+    test_client.post('/post/same-picture-two/delete', follow_redirects=True)
+    db.session.expire_all()
+    assert db.session.get(Blob, name.split('.')[0]) is None
+    assert not storage.exists(blob_store.key(name))
+
+
+def test_rolled_back_upload_keeps_a_committed_blob(test_client, init_database):
+    """
+    GIVEN a blob file written by a transaction that is rolled back
+    WHEN another transaction committed a reference to the same content meanwhile
+    THEN check the file stays, is removed once nothing references it, and a commit puts back a removed file
+    """
+    name = blob_store.put(b'shared upload', 'png')
+    db.session.commit()
+    blob = db.session.get(Blob, name.split('.')[0])
+    blob.refcount = 1
+    db.session.commit()
+
+    # the rolled back transaction had created the row itself
+    db.session.connection()
+    db.session.info['new_blobs'] = [name]
+    db.session.rollback()
+    assert storage.exists(blob_store.key(name))
+
+    blob.refcount = 0
+    db.session.commit()
+    db.session.connection()
+    db.session.info['new_blobs'] = [name]
+    db.session.rollback()
+    assert not storage.exists(blob_store.key(name))
+
+    # an upload whose file went away with someone else's rollback writes it again on commit
+    assert blob_store.put(b'shared upload', 'png') == name
+    storage.delete(blob_store.key(name))
+    db.session.commit()
+    assert storage.read(blob_store.key(name)) == b'shared upload'
+
+    db.session.delete(db.session.get(Blob, name.split('.')[0]))
+    db.session.commit()
+    blob_store.remove(name)
+
+
+def test_new_post_picture_is_checked_before_decoding(test_client, log_in_fourth_user):
+    """
+    GIVEN the upload limits
+    WHEN articles are posted with a fake picture, a huge picture header, a too big file and a too big body
+    THEN check each is turned down without keeping the upload around
+    """
+    config = test_client.application.config
+    uploads = config['IMAGE_QUEUE_UPLOAD_FOLDER']
+
+    def post(picture):
+        return test_client.post('/post/new', data=dict(title='Checked picture', content='Checked', category='Skincare',
+                                                     picture=picture),
+                                follow_redirects=True)
+
+    response = post((io.BytesIO(b'<?php echo "not a picture"; ?>'), 'fake.png'))
+    assert response.status_code == 200
+    assert b'Error: The file is not a JPEG or PNG picture' in response.data
+
+    # only the header is needed to tell the picture is 12000 pixels wide
+    response = post((io.BytesIO(png_header(12000, 1000)), 'huge.png'))
+    assert b'Error: The picture is too large (12000x1000)' in response.data
+
+    noise = io.BytesIO()
+    Image.frombytes('RGB', (800, 800), os.urandom(800 * 800 * 3)).save(noise, 'PNG')
+    noise.seek(0)
+    config['IMAGE_UPLOAD_MAX_BYTES'] = 1024 * 1024
+    try:
+        response = post((noise, 'noise.png'))
+        assert b'Error: The picture is larger than 1 MB' in response.data
+    finally:
+        config['IMAGE_UPLOAD_MAX_BYTES'] = 10 * 1024 * 1024
+
+    config['MAX_CONTENT_LENGTH'] = 1024
+    try:
+        response = post((resources/'7.png').open('rb'))
+        assert response.status_code == 413
+    finally:
+        config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+    assert Post.query.filter_by(title='Checked picture').first() is None
+    assert not [name for name in os.listdir(uploads) if name.startswith('upload-')]
+
+
+def test_post_comments_in_chunks(test_client, log_in_default_user):
+    """
+    GIVEN a post with more comments than POST_COMMENTS_PER_PAGE
+    WHEN the post page and then its next chunk of comments are requested (GET)
+    THEN check the page inlines the newest comments only and the chunk brings the rest with its likes
+    """
+    post = Post.query.order_by(Post.id).first()
+    added = [Comment(username='Olena', body=f'Chunked {number}', post_id=post.id, date_posted=datetime(2030, 1, number))
+             for number in (1, 2)]
+    db.session.add_all(added)
+    db.session.commit()
+    oldest, newest = added
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    test_client.application.config['POST_COMMENTS_PER_PAGE'] = 1
+    try:
+        response = test_client.get(f'/post/{post.slug}')
+        assert f'id="comment-likes-count-{newest.id}"'.encode() in response.data
+        assert f'id="comment-likes-count-{oldest.id}"'.encode() not in response.data
+        url = re.search(rb'data-url="([^"]+)">More comments', response.data).group(1).decode().replace('&amp;', '&')
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            response = test_client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+        assert response.status_code == 200
+        assert f'id="comment-likes-count-{oldest.id}">{oldest.like_count}<'.encode() in response.data
+        assert f'id="comment-likes-count-{newest.id}"'.encode() not in response.data
+        assert (b'More comments' in response.data) == (Comment.query.filter_by(post_id=post.id).count() > 2)
+        # the post, the chunk of comments, and the likes of the whole chunk
+        assert len(statements) <= 3
+        assert len([statement for statement in statements if 'comment_likes' in statement]) == 1
+
+        assert test_client.get(f'/post/{post.slug}/comments',
+                               query_string=dict(cursor='not-a-cursor')).status_code == 404
+        assert test_client.get('/post/no-such-post/comments').status_code == 404
+    finally:
+        test_client.application.config['POST_COMMENTS_PER_PAGE'] = 20
+        for comment in added:
+            db.session.delete(comment)
+        db.session.commit()
+
+
+def test_post_comments_need_login(test_client, init_database):
+    """
+    GIVEN a visitor who is not logged in
+    WHEN the post page or a chunk of its comments is requested (GET)
+    THEN check both send the visitor to the login page
+    """
+    post = Post.query.filter_by(slug='title-1').one()
+    assert post.comments
+    for url in (f'/post/{post.slug}', f'/post/{post.slug}/comments'):
+        response = test_client.get(url)
+        assert response.status_code == 302
+        assert response.location.startswith('/login')
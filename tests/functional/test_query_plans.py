@@ -0,0 +1,97 @@
+"""
+This file (test_query_plans.py) checks that the queries behind the hot routes are served by indexes.
+
+The SQLite plans are read from the test database. The PostgreSQL plans are read from the
+database in TEST_POSTGRES_URI and are skipped when it is not set.
+"""
+import os
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, delete, desc, select, text
+from sqlalchemy.orm import with_parent
+
+from blog import db
+from blog.main.utils import feed_query
+from blog.models import Post, Comment, Tag, PostLike, CommentLike, post_tags
+from blog.pagination import encode_cursor, keyset_query
+
+
+# a tag's posts are found through post_tags, so only that tag's rows are sorted by date
+SORTED_AFTER_SEARCH = {'tag posts'}
+KEYSET_PAGES = {'blog feed cursor', 'blog feed cursor back'}
+
+
+def hot_queries():
+    newest_first = (Post.date_posted.desc(), Post.id.desc())
+    # the pages after the first run the keyset predicate of blog.pagination on the cursor of a post
+    cursor_post = Post(id=3, date_posted=datetime(2024, 1, 1))
+    return {
+        'blog feed': feed_query().order_by(*newest_first).limit(4).statement,
+        'blog feed cursor': keyset_query(feed_query(), encode_cursor(cursor_post, 'next'))[0].limit(5).statement,
+        'blog feed cursor back': keyset_query(feed_query(), encode_cursor(cursor_post, 'prev'))[0].limit(5).statement,
+        'category': Post.query.filter_by(category='Skincare').order_by(*newest_first).limit(20).statement,
+        'user posts': Post.query.filter_by(user_id=1).order_by(*newest_first).limit(3).statement,
+        'post': Post.query.filter_by(slug='title-1').statement,
+        'post comments': Comment.query.filter_by(post_id=1).order_by(desc(Comment.date_posted)).statement,
+        'tag': Tag.query.filter(Tag.name == 'tag 1').statement,
+        'tag posts': feed_query().join(post_tags, post_tags.c.post_id == Post.id).filter(post_tags.c.tag_id == 1)
+                                 .order_by(*newest_first).limit(10).statement,
+        'post tags': select(Tag).where(with_parent(Post(id=1), Post.tags)),
+        'post like toggle': delete(PostLike).where(PostLike.user_id == 1, PostLike.post_id == 1),
+        'comment like toggle': delete(CommentLike).where(CommentLike.user_id == 1, CommentLike.comment_id == 1),
+    }
+
+
+def sqlite_plan(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect)
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), parameters)]
+
+
+def test_hot_queries_use_indexes_on_sqlite(test_client, init_database):
+    """
+    GIVEN the SQLite test database
+    WHEN the queries of the feed, category, author, post, tag and like routes are explained
+    THEN check no table is scanned in full, no result is sorted outside an index and the cursor pages seek
+    """
+    if db.engine.dialect.name != 'sqlite':
+        pytest.skip('the test database is not SQLite')
+
+    with db.engine.connect() as connection:
+        for name, statement in hot_queries().items():
+            plan = sqlite_plan(connection, statement)
+            for step in plan:
+                assert not (step.startswith('SCAN') and 'INDEX' not in step), (name, plan)
+                if name not in SORTED_AFTER_SEARCH:
+                    assert 'TEMP B-TREE' not in step, (name, plan)
+            if name in KEYSET_PAGES:
+                # the cursor predicate seeks into the (date_posted, id) index rather than walking it
+                assert plan[0].startswith('SEARCH posts USING INDEX ix_posts_date_posted_id'), (name, plan)
+
+
+@pytest.fixture(scope='module')
+def postgres_engine():
+    uri = os.getenv('TEST_POSTGRES_URI')
+    if not uri:
+        pytest.skip('TEST_POSTGRES_URI is not set')
+    engine = create_engine(uri)
+    db.metadata.create_all(engine)
+    yield engine
+    db.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def test_hot_queries_use_indexes_on_postgres(test_client, postgres_engine):
+    """
+    GIVEN a PostgreSQL database with the blog schema
+    WHEN the queries of the feed, category, author, post, tag and like routes are explained
+    THEN check every table is reached through an index
+    """
+    with postgres_engine.connect() as connection:
+        # empty tables are always cheapest to scan, so only ask whether an index path exists
+        connection.execute(text('SET enable_seqscan = off'))
+        for name, statement in hot_queries().items():
+            compiled = statement.compile(dialect=connection.dialect)
+            plan = [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + str(compiled), compiled.params)]
+            assert not any('Seq Scan' in step for step in plan), (name, plan)
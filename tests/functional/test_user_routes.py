@@ -5,8 +5,14 @@ These tests use GETs and POSTs to different URLs to check for the proper behavio
 of the `users` blueprint.
 """
 
-import os
-from blog.models import User, Post
+from blog.blobs import blob_store
+from blog.images import legacy_media_prefix, media_url, user_media_prefix
+from sqlalchemy import event
+
+from blog.models import User, Post, Comment, PostLike, CommentLike, OutboxMessage
+from blog.outbox import mail_outbox
+from blog.passwords import hash_rounds, password_hasher
+from blog.storage import storage
 from tests.conftest import resources
 from blog import db
 from blog.errors import handlers
@@ -100,6 +106,37 @@ def test_login_already_logged_in(test_client, log_in_default_user):
     assert b'SignUp' not in response.data
 
 
+def test_login_rehashes_password_at_configured_cost(test_client):
+    """
+    GIVEN a user whose password hash has another cost than PASSWORD_HASH_ROUNDS
+    WHEN the user logs in, also with the hashing done in a process pool
+    THEN check the password is rehashed at the configured cost and still works
+    """
+    config = test_client.application.config
+    ivan = User.query.filter_by(email='ivan@mail.com').first()
+    ivan.password = password_hasher.hash('Ivan777', rounds=5)
+    db.session.commit()
+    assert password_hasher.needs_rehash(ivan.password)
+
+    config['PASSWORD_HASH_PROCESSES'] = 1
+    try:
+        response = test_client.post('/login', data=dict(email='ivan@mail.com', password='Ivan777'),
+                                    follow_redirects=True)
+        assert b'You are logged in as a user Ivan' in response.data
+        test_client.get('/logout')
+    finally:
+        config['PASSWORD_HASH_PROCESSES'] = 0
+    db.session.refresh(ivan)
+    assert hash_rounds(ivan.password) == config['PASSWORD_HASH_ROUNDS']
+    assert not password_hasher.needs_rehash(ivan.password)
+    assert password_hasher.check(ivan.password, 'Ivan777')
+    assert not password_hasher.check(ivan.password, 'Ivan778')
+
+    result = test_client.application.test_cli_runner().invoke(args=['passwords', 'benchmark', '--seconds', '0.2'])
+    assert result.exit_code == 0
+    assert 'logins/s per core' in result.output
+
+
 def test_signup_invalid(test_client):
     """
     GIVEN a Flask application configured for testing
@@ -253,6 +290,14 @@ def test_user_delete_valid(test_client, log_in_default_user ):
     WHEN the '/user_delete/Paul' page  is requested (GET)
     THEN check the response is valid
     """
+    # Ivan liked an article and a comment
+    ivan = User.query.filter_by(username='Ivan').first()
+    post = Post.query.filter_by(slug='title-3').first()
+    comment = Comment.query.filter_by(post_id=post.id).first()
+    db.session.add(CommentLike(user_id=ivan.id, comment_id=comment.id))
+    db.session.commit()
+    post_likes, comment_likes = post.like_count, comment.like_count
+
     response = test_client.get('/user_delete/Ivan', follow_redirects=True)
     assert response.status_code == 200
     assert response.request.path == "/profile"
@@ -265,6 +310,59 @@ def test_user_delete_valid(test_client, log_in_default_user ):
     assert user is None
     assert User.query.count() == 5
 
+    # his likes went with him, and so did their share of the counters
+    db.session.expire_all()
+    assert PostLike.query.filter_by(user_id=ivan.id).count() == 0
+    assert post.like_count == post_likes - 1 == PostLike.query.filter_by(post_id=post.id).count()
+    assert comment.like_count == comment_likes - 1 == CommentLike.query.filter_by(comment_id=comment.id).count()
+
+    """
+    GIVEN like counters that drifted from the like tables
+    WHEN `flask likes recount` is run
+    THEN check every counter matches its likes again
+    """
+    post.like_count = 42
+    db.session.commit()
+    result = test_client.application.test_cli_runner().invoke(args=['likes', 'recount'])
+    assert result.exit_code == 0
+    assert '1 like counters corrected.' in result.output
+    db.session.expire_all()
+    assert post.like_count == PostLike.query.filter_by(post_id=post.id).count()
+
+
+def test_current_user_comes_from_the_user_cache(test_client, log_in_default_user):
+    """
+    GIVEN a logged in user
+    WHEN pages are requested and the user's name and role are changed
+    THEN check the user is resolved without reading the users table, nor ever the password, until it changes
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    olena = User.query.filter_by(email='fake24@gmail.com').first()
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        test_client.get('/reset_password')
+        assert not [statement for statement in statements if 'users.password' in statement]
+        statements.clear()
+        response = test_client.get('/reset_password')
+        assert b'Olena' in response.data
+        assert b'Admin' in response.data
+        assert not [statement for statement in statements if 'users' in statement]
+
+        olena.username, olena.role = 'Olenka', 'user'
+        db.session.commit()
+        response = test_client.get('/reset_password')
+        assert b'Olenka' in response.data
+        assert b'Admin' not in response.data
+        assert [statement for statement in statements if 'FROM users' in statement]
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+        olena.username, olena.role = 'Olena', 'admin'
+        db.session.commit()
+
 
 def test_profile_page(test_client, log_in_default_user):
     """
@@ -343,10 +441,9 @@ def test_update_user_profile_picture_when_previous_picture_was_deleted_valid(tes
     THEN check the response is valid
     """
 
-    # remove previous image and folder
+    # remove previous image
     vika = User.query.filter_by(email='vika@mail.com').first()
-    os.remove(os.path.join(os.getcwd(), 'blog/static', 'profile_pics', 'users', vika.username, 'profile_img', vika.image_file))
-    os.rmdir(os.path.join(os.getcwd(), 'blog/static', 'profile_pics', 'users', vika.username, 'profile_img'))
+    storage.delete(blob_store.key(vika.image_file))
 
     # try to update user picture
     response = test_client.post('/profile',
@@ -419,6 +516,37 @@ def test_update_user_profile_invalid_with_already_taken_email(test_client, log_i
     assert b'This username is already taken. Please choose different one' in response.data
 
 
+def test_rename_user_keeps_media(test_client, log_in_fourth_user):
+    """
+    GIVEN a user whose avatar is still in a media folder named after the username
+    WHEN the folders are relocated and the user is renamed
+    THEN check the avatar moves under the user id and keeps its URL through the rename
+    """
+    eva = User.query.filter_by(email='eva21@mail.com').first()
+    stock_avatar = eva.image_file
+    storage.write(legacy_media_prefix('Eva') + 'profile_img/legacy.png', (resources/'7.png').read_bytes())
+    eva.image_file = 'legacy.png'
+    db.session.commit()
+    try:
+        result = test_client.application.test_cli_runner().invoke(args=['images', 'relocate'])
+        assert result.exit_code == 0
+        assert '1 media folders moved' in result.output
+        assert not storage.list(legacy_media_prefix('Eva'))
+        assert storage.exists(user_media_prefix(eva.id) + 'profile_img/legacy.png')
+        url = media_url(eva.id, 'profile_img', 'legacy.png')
+
+        response = test_client.post('/profile', data=dict(username='Evelyn', email='eva21@mail.com'),
+                                    follow_redirects=True)
+        assert response.status_code == 200
+        assert b'Your profile was updated!' in response.data
+        assert url.encode() in response.data
+        assert storage.exists(user_media_prefix(eva.id) + 'profile_img/legacy.png')
+    finally:
+        eva.username, eva.image_file = 'Eva', stock_avatar
+        db.session.commit()
+        storage.delete_prefix(user_media_prefix(eva.id))
+
+
 def test_user_posts_page(test_client, log_in_default_user):
     """
     GIVEN a Flask application configured for testing
@@ -436,6 +564,25 @@ def test_user_posts_page(test_client, log_in_default_user):
     assert b'Back' in response.data
 
 
+def test_user_posts_page_keyset(test_client, log_in_default_user):
+    """
+    GIVEN a Flask application configured for keyset pagination
+    WHEN the '/user/Mike' page is requested (GET)
+    THEN check the posts are listed without numbered pages
+    """
+    test_client.application.config['PAGINATION_MODE'] = 'keyset'
+    try:
+        response = test_client.get('/user/Mike')
+    finally:
+        test_client.application.config['PAGINATION_MODE'] = 'numbered'
+
+    assert response.status_code == 200
+    assert b'Title 3' in response.data
+    assert b'page=1' not in response.data
+    assert b'Older</a>' not in response.data
+    assert b'Newer</a>' not in response.data
+
+
 def test_user_posts_second_page(test_client, log_in_default_user):
     """
     GIVEN a Flask application configured for testing
@@ -518,6 +665,45 @@ def test_reset_request_invalid(test_client):
     assert b'Reset password' in response.data
 
 
+def test_reset_email_is_sent_from_the_outbox(test_client, smtp_server):
+    """
+    GIVEN the mail outbox and a local SMTP server
+    WHEN password resets are requested and the outbox is sent
+    THEN check the requests only queue the mail and the sender delivers it in one connection, retrying refusals
+    """
+    smtp_server.refuse.add('vika@mail.com')
+    for email in ('fake24@gmail.com', 'vika@mail.com'):
+        response = test_client.post('/reset_password', data=dict(email=email), follow_redirects=True)
+        assert b'Password recovery instructions were sent to the specified email.' in response.data
+    assert not smtp_server.messages
+    queued = OutboxMessage.query.filter_by(status='pending').count()
+    assert queued >= 2
+
+    assert mail_outbox.send_pending() == queued - 1
+    assert len(smtp_server.messages) == queued - 1
+    assert smtp_server.connections == 1
+    assert smtp_server.messages[-1].recipients == ['fake24@gmail.com']
+    assert b'/reset_password/' in smtp_server.messages[-1].data
+
+    refused = OutboxMessage.query.filter_by(recipients='["vika@mail.com"]').one()
+    assert refused.status == 'pending'
+    assert refused.attempts == 1
+    assert refused.run_after > refused.created_at
+    stats = mail_outbox.stats()
+    assert stats['pending'] == 1
+    assert stats['sent'] >= queued - 1
+    assert stats['send_latency_avg'] is not None
+
+    # not due before its backoff is over
+    assert mail_outbox.send_pending() == 0
+    smtp_server.refuse.clear()
+    refused.run_after = None
+    db.session.commit()
+    assert mail_outbox.send_pending() == 1
+    assert smtp_server.messages[-1].recipients == ['vika@mail.com']
+    assert mail_outbox.stats()['pending'] == 0
+
+
 def test_reset_password_valid(test_client):
     """
     GIVEN a Flask application configured for testing and created token
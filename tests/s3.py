@@ -0,0 +1,126 @@
+"""
+A small in-memory stand-in for the S3 API, enough for blog.storage.S3Storage.
+
+It answers path-style requests (http://host/<bucket>/<key>) for PutObject,
+CopyObject, GetObject, HeadObject, DeleteObject, DeleteObjects and
+ListObjectsV2, and does not check signatures.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+class S3StandIn:
+
+    def __init__(self):
+        self.objects = {}  # (bucket, key) -> (body, headers)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def endpoint_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def keys(self, bucket):
+        return sorted(key for name, key in self.objects if name == bucket)
+
+    def _handler(self):
+        objects = self.objects
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _target(self):
+                url = urlsplit(self.path)
+                bucket, _, key = url.path.lstrip('/').partition('/')
+                return bucket, unquote(key), parse_qs(url.query, keep_blank_values=True)
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def _reply(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def _xml(self, body):
+                self._reply(200, ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode(),
+                            {'Content-Type': 'application/xml'})
+
+            def do_PUT(self):
+                bucket, key, _ = self._target()
+                body = self._body()
+                if not key:
+                    return self._reply(200)
+                source = self.headers.get('x-amz-copy-source')
+                if source:
+                    source_bucket, _, source_key = unquote(source).lstrip('/').partition('/')
+                    if (source_bucket, source_key) not in objects:
+                        return self._reply(404)
+                    objects[bucket, key] = objects[source_bucket, source_key]
+                    return self._xml('<CopyObjectResult><ETag>"0"</ETag></CopyObjectResult>')
+                headers = {name: self.headers[name] for name in ('Content-Type', 'Cache-Control') if self.headers[name]}
+                objects[bucket, key] = body, headers
+                self._reply(200, headers={'ETag': '"0"'})
+
+            def do_GET(self):
+                bucket, key, query = self._target()
+                if not key:
+                    prefix = query.get('prefix', [''])[0]
+                    contents = ''.join(f'<Contents><Key>{escape(name)}</Key><Size>{len(objects[bucket, name][0])}</Size>'
+                                       f'</Contents>'
+                                       for (owner, name) in sorted(objects) if owner == bucket and name.startswith(prefix))
+                    return self._xml(f'<ListBucketResult><Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>'
+                                     f'<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>')
+                if (bucket, key) not in objects:
+                    return self._reply(404, b'<Error><Code>NoSuchKey</Code></Error>', {'Content-Type': 'application/xml'})
+                body, headers = objects[bucket, key]
+                self._reply(200, body, headers)
+
+            def do_HEAD(self):
+                bucket, key, _ = self._target()
+                if (bucket, key) not in objects:
+                    return self._reply(404)
+                body, headers = objects[bucket, key]
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+
+            def do_DELETE(self):
+                bucket, key, _ = self._target()
+                objects.pop((bucket, key), None)
+                self._reply(204)
+
+            def do_POST(self):
+                bucket, _, query = self._target()
+                body = self._body()
+                if 'delete' not in query:
+                    return self._reply(501)
+                deleted = ''
+                for element in ElementTree.fromstring(body).iter():
+                    if element.tag.rsplit('}', 1)[-1] == 'Key':
+                        objects.pop((bucket, element.text), None)
+                        deleted += f'<Deleted><Key>{escape(element.text)}</Key></Deleted>'
+                self._xml(f'<DeleteResult>{deleted}</DeleteResult>')
+
+        return Handler
@@ -0,0 +1,91 @@
+"""
+A small SMTP stand-in that keeps the messages it receives in memory.
+
+It speaks enough plain SMTP (no TLS, no AUTH) for smtplib: HELO/EHLO, MAIL,
+RCPT, DATA, RSET, NOOP and QUIT. Recipients listed in `refuse` are
+rejected with a permanent error.
+"""
+import socketserver
+import threading
+from collections import namedtuple
+
+
+Received = namedtuple('Received', 'sender recipients data connection')
+
+
+class SMTPStandIn:
+
+    def __init__(self, refuse=()):
+        self.messages = []
+        self.connections = 0
+        self.refuse = set(refuse)
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write(line.encode() + b'\r\n')
+
+            def handle(self):
+                stand_in.connections += 1
+                connection = stand_in.connections
+                sender, recipients = None, []
+                self.reply('220 localhost SMTP stand-in')
+                for line in self.rfile:
+                    command = line.decode().rstrip('\r\n')
+                    verb = command.split(' ', 1)[0].upper()
+                    if verb == 'EHLO':
+                        self.reply('250-localhost')
+                        self.reply('250 8BITMIME')
+                    elif verb == 'HELO':
+                        self.reply('250 localhost')
+                    elif verb == 'MAIL':
+                        sender, recipients = command.split(':', 1)[1].split()[0].strip('<>'), []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        recipient = command.split(':', 1)[1].split()[0].strip('<>')
+                        if recipient in stand_in.refuse:
+                            self.reply('550 No such user')
+                            continue
+                        recipients.append(recipient)
+                        self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        lines = []
+                        for data in self.rfile:
+                            if data in (b'.\r\n', b'.\n'):
+                                break
+                            lines.append(data[1:] if data.startswith(b'..') else data)
+                        stand_in.messages.append(Received(sender, recipients, b''.join(lines), connection))
+                        self.reply('250 OK')
+                    elif verb in ('RSET', 'NOOP'):
+                        sender, recipients = (None, []) if verb == 'RSET' else (sender, recipients)
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Command not implemented')
+
+        return Handler
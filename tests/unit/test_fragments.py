@@ -0,0 +1,22 @@
+"""
+This file (test_fragments.py) contains the unit tests for the fragments.py file.
+"""
+from blog.fragments import LocalStore
+
+
+def test_local_store_versions_are_bounded():
+    """
+    GIVEN a local fragment store for two entries
+    WHEN the versions of more scopes are read and bumped
+    THEN check only the most recently used versions are kept, and an evicted one comes back as a new version
+    """
+    store = LocalStore(max_entries=2, max_bytes=1000)
+    first, = store.versions(['post:1'])
+    store.bump(['post:2'])
+    store.versions(['post:1'])
+    store.versions(['post:3'])
+
+    assert list(store._versions) == ['post:1', 'post:3']
+    assert store.versions(['post:1']) == [first]
+    assert store.versions(['post:2']) != [first]
+    assert len(store._versions) == 2
@@ -95,10 +95,10 @@ def test_new_tag():
     """
         GIVEN a Tag model
         WHEN a user creates a tag
-        THEN check the name and  post_id  are defined correctly
+        THEN check the name and  posts  are defined correctly
         """
 
-    tag = Tag(name='name 1', post_id='1')
+    tag = Tag(name='name 1')
     assert tag.name == 'name 1'
-    assert tag.post_id == '1'
+    assert tag.posts == []
 
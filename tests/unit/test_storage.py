@@ -0,0 +1,50 @@
+"""
+This file (test_storage.py) contains the unit tests for the storage.py file.
+"""
+import pytest
+
+from blog.storage import LocalStorage, S3Storage
+from tests.s3 import S3StandIn
+
+
+@pytest.fixture(params=['local', 's3'])
+def backend(request, tmp_path):
+    if request.param == 'local':
+        yield LocalStorage(str(tmp_path))
+        return
+    boto3 = pytest.importorskip('boto3')
+    server = S3StandIn().start()
+    client = boto3.client('s3', endpoint_url=server.endpoint_url, region_name='us-east-1',
+                          aws_access_key_id='test', aws_secret_access_key='test')
+    yield S3Storage(client, 'blog-media', prefix='site/')
+    server.stop()
+
+
+def test_storage_backends(backend):
+    """
+    GIVEN a local or an S3 media storage
+    WHEN files are written, listed, renamed and deleted
+    THEN check both backends behave the same
+    """
+    backend.write('profile_pics/users/Eva/profile_img/a.png', b'a')
+    backend.write('profile_pics/users/Eva/post_images/b.png', b'b')
+    backend.write('profile_pics/users/Eva/post_images/b-160.webp', b'c')
+    backend.write('profile_pics/users/Evan/profile_img/d.png', b'd')
+
+    assert backend.read('profile_pics/users/Eva/profile_img/a.png') == b'a'
+    assert backend.exists('profile_pics/users/Eva/post_images/b.png')
+    assert not backend.exists('profile_pics/users/Eva/post_images/missing.png')
+    assert backend.list('profile_pics/users/Eva/post_images/b-') == ['profile_pics/users/Eva/post_images/b-160.webp']
+    assert len(backend.list('profile_pics/users/Eva/')) == 3
+
+    backend.rename_prefix('profile_pics/users/Eva/', 'profile_pics/users/Eve/')
+    assert not backend.list('profile_pics/users/Eva/')
+    assert backend.read('profile_pics/users/Eve/post_images/b.png') == b'b'
+    assert backend.exists('profile_pics/users/Evan/profile_img/d.png')
+
+    backend.delete('profile_pics/users/Eve/profile_img/a.png')
+    backend.delete('profile_pics/users/Eve/profile_img/a.png')
+    assert not backend.exists('profile_pics/users/Eve/profile_img/a.png')
+
+    backend.delete_prefix('profile_pics/users/Eve/')
+    assert backend.list('profile_pics/users/') == ['profile_pics/users/Evan/profile_img/d.png']